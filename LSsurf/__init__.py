@@ -24,7 +24,9 @@ from LSsurf.grid_functions import setup_grids, \
 from LSsurf.calc_sigma_extra import calc_sigma_extra,\
     calc_sigma_extra_on_grid
 from LSsurf.unique_by_rows import unique_by_rows
+from LSsurf.solver_functions import solve_system, register_solver, SolverMemoryError
 from LSsurf.match_priors import match_tile_edges, match_prior_dz
+from LSsurf.tile_runner import run_tiles
 from LSsurf.hermite_poly_fit import *
 from LSsurf.get_pgc import *
 from LSsurf.setup_DEM_jitter_fit import *
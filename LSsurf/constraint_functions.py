@@ -14,13 +14,25 @@ Created on Thu May 26 13:34:24 2022
 import numpy as np
 from LSsurf.fd_grid import fd_grid
 from LSsurf.lin_op import lin_op
+from LSsurf.stencil_op import stencil_op
 from LSsurf.unique_by_rows import unique_by_rows
 import pointCollection as pc
 import scipy.sparse as sp
 
 
 
-def setup_smoothness_constraints(grids, constraint_op_list, E_RMS, mask_scale, scaling_masks=None):
+def build_op(op_class, grid, name, method, op_cache=None, **kwargs):
+    """
+    Build an operator as op_class(grid, name=name).method(**kwargs)
+
+    If op_cache (an op_cache object) is provided, the operator is read from
+    the cache if it is there, and is added to the cache otherwise.
+    """
+    if op_cache is None:
+        return getattr(op_class(grid, name=name), method)(**kwargs)
+    return op_cache.build(op_class, grid, name, method, **kwargs)
+
+def setup_smoothness_constraints(grids, constraint_op_list, E_RMS, mask_scale, scaling_masks=None, matrix_free=False, op_cache=None):
     """
     Setup the smoothness constraint operators for dz and z0
 
@@ -29,21 +41,27 @@ def setup_smoothness_constraints(grids, constraint_op_list, E_RMS, mask_scale, s
     constraint_op_list: (list) list of lin_op objects containing constraint equations that penalize the solution for roughness.
     E_RMS: (dict) constraint weights.  May have entries: 'd2z0_dx2', 'd2z0_dx2', 'd2z0_dx', 'd3z_dx2dt', 'd2z_dxdt', 'd2z_dt2'  Each specifies the penealty for each derivative of the DEM (z0), or the height changes(dz)
     mask_scale: (dict) mapping between mask values (in grids[].mask) and constraint weights.  Keys and values should be floats
+    matrix_free: (bool) if True, the derivative constraints are built as stencil_op objects, which are applied without building their matrices
+    op_cache: (op_cache) if specified, the derivative constraints (before weighting) are read from this cache, or added to it
 
     Outputs:
     None (appends to constraint_op_list)
     """
     if scaling_masks is None:
         scaling_masks={}
+    if matrix_free:
+        stencil_class=stencil_op
+    else:
+        stencil_class=lin_op
 
     # make the smoothness constraints for z0
     root_delta_A_z0=np.sqrt(np.prod(grids['z0'].delta))
-    grad2_z0=lin_op(grids['z0'], name='grad2_z0').grad2(DOF='z0')
+    grad2_z0=build_op(stencil_class, grids['z0'], 'grad2_z0', 'grad2', op_cache=op_cache, DOF='z0')
     grad2_z0.expected=E_RMS['d2z0_dx2']/root_delta_A_z0*grad2_z0.mask_for_ind0(mask_scale)
 
     constraint_op_list += [grad2_z0]
     if 'dz0_dx' in E_RMS:
-        grad_z0=lin_op(grids['z0'], name='grad_z0').grad(DOF='z0')
+        grad_z0=build_op(stencil_class, grids['z0'], 'grad_z0', 'grad', op_cache=op_cache, DOF='z0')
         grad_z0.expected=E_RMS['dz0_dx']/root_delta_A_z0*grad_z0.mask_for_ind0(mask_scale)
         constraint_op_list += [grad_z0]
 
@@ -55,14 +73,14 @@ def setup_smoothness_constraints(grids, constraint_op_list, E_RMS, mask_scale, s
     # make the smoothness constraints for dz
     root_delta_V_dz=np.sqrt(np.prod(grids['dz'].delta))
     if 'd3z_dx2dt' in E_RMS and E_RMS['d3z_dx2dt'] is not None:
-        grad2_dz=lin_op(grids['dz'], name='grad2_dzdt').grad2_dzdt(DOF='z', t_lag=1)
+        grad2_dz=build_op(stencil_class, grids['dz'], 'grad2_dzdt', 'grad2_dzdt', op_cache=op_cache, DOF='z', t_lag=1)
         grad2_dz.expected=E_RMS['d3z_dx2dt']/root_delta_V_dz*grad2_dz.mask_for_ind0(mask_scale)
         if 'd3z_dx2dt' in scaling_masks:
             grad2_dz.expected *= grad2_dz.mask_for_ind0(mask=scaling_masks['d3z_dx2dt'])
         constraint_op_list += [grad2_dz]
 
     if 'd2z_dxdt' in E_RMS and E_RMS['d2z_dxdt'] is not None:
-        grad_dzdt=lin_op(grids['dz'], name='grad_dzdt').grad_dzdt(DOF='z', t_lag=1)
+        grad_dzdt=build_op(stencil_class, grids['dz'], 'grad_dzdt', 'grad_dzdt', op_cache=op_cache, DOF='z', t_lag=1)
         grad_dzdt.expected=E_RMS['d2z_dxdt']/root_delta_V_dz*grad_dzdt.mask_for_ind0(mask_scale)
         for key in ['d2z_dx2dt','d3z_dx2dt']:
             if key in scaling_masks:
@@ -71,7 +89,7 @@ def setup_smoothness_constraints(grids, constraint_op_list, E_RMS, mask_scale, s
         constraint_op_list += [ grad_dzdt ]
 
     if 'd2z_dt2' in E_RMS and E_RMS['d2z_dt2'] is not None:
-        d2z_dt2=lin_op(grids['dz'], name='d2z_dt2').d2z_dt2(DOF='z')
+        d2z_dt2=build_op(stencil_class, grids['dz'], 'd2z_dt2', 'd2z_dt2', op_cache=op_cache, DOF='z')
         d2z_dt2.expected=np.zeros(d2z_dt2.N_eq) + E_RMS['d2z_dt2']/root_delta_V_dz
         constraint_op_list += [d2z_dt2]
 
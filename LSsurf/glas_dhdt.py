@@ -63,7 +63,7 @@ def glas_fit(xy0, W0, D=None, E_RMS=None, gI=None, giFile='/Data/glas/GL/rel_634
 
     G_data=lin_op(grids['z0'], name='interp_z').interp_mtx(D.coords()[0:2])
     G_dzdt=lin_op(grids['dzdt'], name='dzdt').interp_mtx(D.coords()[0:2])
-    G_dzdt.v *= (D.year[G_dzdt.r.astype(int)]-ctr['t'])
+    G_dzdt.v = G_dzdt.v*(D.year[G_dzdt.r.astype(int)]-ctr['t'])
     G_data.add(G_dzdt)
 
     grad2_z0=lin_op(grids['z0'], name='grad2_z0').grad2(DOF='z0')
@@ -191,7 +191,7 @@ def setup_averaging_ops(grid, col_N, args, cell_area=None):
                 # use this matrix to identify the cells that do not have first and last values
                 # within the mask
                 num_cells = temp.dot(grid.mask_3d.z.ravel().astype(float))
-                op.v[np.in1d(op.r, np.flatnonzero(num_cells<2))]=0
+                op.v=np.where(np.in1d(op.r, np.flatnonzero(num_cells<2)), 0., op.v)
                 # recreate the matrix with the updated operator:
                 temp=sp.coo_matrix((np.abs(op.v)*0.5*lag*grid.delta[2],(op.r, op.c-grid.col_0)), \
                                    shape=(np.prod(op.dst_grid.shape), grid.cell_area.size))
@@ -241,7 +241,7 @@ def setup_averaging_ops(grid, col_N, args, cell_area=None):
             op.normalize_by_unit_product()
         else:
             # divide the values by the kernel area in cells
-            op.v /= (kernel_N[0]*kernel_N[1])
+            op.v = op.v/(kernel_N[0]*kernel_N[1])
         op.dst_grid.cell_area = sum_cell_area(grid, op.dst_grid, sub0s=sub0s, cell_area_f=cell_area)
         ops[this_name]=op
 
@@ -271,16 +271,16 @@ def setup_averaging_ops(grid, col_N, args, cell_area=None):
                 #                                      time_step_overlap=2)
             else:
                 #2D mask: just use the mask as is
-                op=lin_op(grid, name=this_name, col_N=col_N)
-                row_N=np.max(op.r)
-                op.sum_to_grid3(kernel_N+1, sub0s=sub0s, lag=lag, taper=True)\
-                    .apply_2d_mask(mask=cell_area, row_N=row_N)
+                op=lin_op(grid, name=this_name, col_N=col_N)\
+                    .sum_to_grid3(kernel_N+1, sub0s=sub0s, lag=lag, taper=True)
+                row_N=np.max(op.r)+1
+                op.apply_2d_mask(mask=cell_area, row_N=row_N)
             if cell_area is not None:
                 # the appropriate weight is expected number of nonzero elements
                 # for each nonzero node, times the weight for each time step
                 op.normalize_by_unit_product( wt=2/(lag*grid.delta[2]))
             else:
-                op.v /= (kernel_N[0]*kernel_N[1])
+                op.v = op.v/(kernel_N[0]*kernel_N[1])
             ops[dz_name]=op
 
     return ops
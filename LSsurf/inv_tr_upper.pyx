@@ -1,5 +1,6 @@
 from __future__ import division
 cimport cython
+from cython.parallel cimport prange, threadid
 import numpy as np
 cimport numpy as np
 ITYPE=np.int32
@@ -8,85 +9,190 @@ LTYPE=np.int64
 ctypedef np.int64_t LTYPE_t
 FTYPE=np.float64
 ctypedef np.float64_t FTYPE_t
-from libc.math cimport abs
+from libc.math cimport fabs
 
 
+include "tr_upper_reach.pxi"
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-
-#def propagate_qz_errors(np.ndarray[ITYPE_t, ndim=1] indptr, np.ndarray[ITYPE_t, ndim=1] indices, np.ndarray[FTYPE_t, ndim=1] data, np.ndarray[FTYPE_t, ndim=1] E):
-def inv_tr_upper(R,  int nnz, float tol):
-    """
-    Solves the equation R Rinv = I for Rinv, calculates the row-wise RSS of Rinv
-    ----------
-    R : (M, M) sparse matrix
-        A sparse square upper triangular matrix. Should be in CSR format.
-
-    Returns
-    -------
-    Rinv, the approximate inverse of R
-
-    .. Derived from the spsolve_triangular function in scipy version:: 0.19.0
-    """
-    cdef Py_ssize_t i, indptr_start, indptr_stop, col, row, out_ind, max_ind, status
-    cdef Py_ssize_t A_off_diagonal_index_row_i, A_column_index_in_row_i  
-    
+cdef Py_ssize_t inv_tr_upper_block(ITYPE_t[:] indptr, ITYPE_t[:] indices, FTYPE_t[:] data,
+                                   ITYPE_t[:] Cp, ITYPE_t[:] Ci,
+                                   Py_ssize_t col_start, Py_ssize_t col_stop, FTYPE_t tol,
+                                   FTYPE_t[:] x, LTYPE_t[:] mark, LTYPE_t[:] stack,
+                                   LTYPE_t[:] pstack, LTYPE_t[:] xi,
+                                   ITYPE_t[:] out_rows, ITYPE_t[:] out_cols,
+                                   FTYPE_t[:] out_vals, Py_ssize_t out_start, Py_ssize_t out_stop,
+                                   LTYPE_t[:] N_out, Py_ssize_t block) nogil:
+    # calculate columns col_start to col_stop-1 of Rinv, writing the results
+    # into out_*[out_start:out_stop].  Returns the first column that was not
+    # calculated (col_stop if all were), and the number of values written in N_out[block]
+    cdef Py_ssize_t i, col, indptr_start, indptr_stop, out_ind, top, k, N
+    cdef Py_ssize_t A_off_diagonal_index_row_i, A_column_index_in_row_i
     cdef FTYPE_t this_x
-    # pull apart R and explicitly type the pieces
-    cdef np.ndarray[ITYPE_t, ndim=1] indptr=R.indptr    
-    cdef np.ndarray[ITYPE_t, ndim=1] indices=R.indices     
-    cdef np.ndarray[FTYPE_t, ndim=1] data=R.data
-
-    #if nnz == 0:
-    #    nnz=np.int(R.shape[0]*R.shape[1]/2)
-    # Result matrix
-    cdef np.ndarray[ITYPE_t, ndim=1] out_rows=np.zeros(nnz, dtype=ITYPE)
-    cdef np.ndarray[ITYPE_t, ndim=1] out_cols=np.zeros(nnz, dtype=ITYPE)
-    cdef np.ndarray[FTYPE_t, ndim=1] out_vals=np.zeros(nnz, dtype=FTYPE)    
-    # work matrix
-    cdef np.ndarray[FTYPE_t, ndim=1] x=np.zeros(R.shape[0], dtype=FTYPE) 
-    cdef Py_ssize_t N
-    N=R.shape[0]
-    out_ind=-1
-    status=0
-    max_ind=nnz-1
-    
-    # loop over the columns of I 
-    for col in range(N-1, -1, -1):
-        #print "%d\n", col
-        # make the current column of I, which will be turned into a column of Rinv
-        for row in range(N):
-            x[row]=0
-        x[col]=1
-        # Fill x iteratively.  All elements of Rinv[:,col] are zero up to 'col'
-        for i in range(col, -1, -1):
+    N=xi.shape[0]
+    out_ind=out_start
+    for col in range(col_start, col_stop):
+        # only the rows that can be reached from col are calculated
+        top=reach(Cp, Ci, col, mark, stack, pstack, xi)
+        if out_ind + N - top > out_stop:
+            # unmark the rows, so that the column can be repeated later
+            for k in range(top, N):
+                mark[xi[k]]=-1
+            N_out[block]=out_ind-out_start
+            return col
+        # Fill x iteratively.  Entries of x outside the reach are zero
+        for k in range(top, N):
+            i=xi[k]
             # Get indices for i-th row.
             indptr_start = indptr[i]
             indptr_stop = indptr[i+1]
- 
-            this_x=x[i]
+            # the current column of I
+            if i==col:
+                this_x=1
+            else:
+                this_x=0
             # Incorporate off-diagonal entries.
             for A_off_diagonal_index_row_i in range(indptr_start+1, indptr_stop):
                 A_column_index_in_row_i = indices[A_off_diagonal_index_row_i]
                 if A_column_index_in_row_i > col:
                     # we know that the entries of x for j > col are all zero,
-                    # so once we find one index that is > 'col', we quit 
+                    # so once we find one index that is > 'col', we quit
                     break
-                this_x -= data[A_off_diagonal_index_row_i]*x[A_column_index_in_row_i]
+                this_x = this_x - data[A_off_diagonal_index_row_i]*x[A_column_index_in_row_i]
             # Apply the diagonal entry
-            this_x /= data[indptr_start]
+            this_x = this_x / data[indptr_start]
             x[i]=this_x
             # write out the results
-            if i==col or abs(this_x) > tol:
-                #if out_ind > max_ind:
-                #    status=1
-                #    break
-                out_ind+=1
+            if i==col or fabs(this_x) > tol:
                 out_rows[out_ind]=i
                 out_cols[out_ind]=col
                 out_vals[out_ind]=this_x
-             
-             
-    return out_rows[0:out_ind+1], out_cols[0:out_ind+1], out_vals[0:out_ind+1], status 
-    
\ No newline at end of file
+                out_ind = out_ind + 1
+        # clear only the entries of x that were used
+        for k in range(top, N):
+            x[xi[k]]=0
+    N_out[block]=out_ind-out_start
+    return col_stop
+
+def inv_tr_upper(R,  int nnz, float tol, int n_threads=1, first_col=0, last_col=None):
+    """
+    Solves the equation R Rinv = I for Rinv, calculates the row-wise RSS of Rinv
+    ----------
+    R : (M, M) sparse matrix
+        A sparse square upper triangular matrix. Should be in CSR format.
+    nnz : int
+        initial number of nonzero values allocated for Rinv.  The allocation
+        grows if more values are needed.
+    tol : float
+        values of Rinv smaller than tol (other than the diagonal) are dropped
+    n_threads : int
+        number of threads.  The columns of Rinv are split into blocks of
+        roughly equal work, and the blocks are calculated in parallel, each
+        with its own workspace and output buffer.
+    first_col, last_col : int
+        if specified, only columns first_col to last_col-1 of Rinv are
+        calculated.  The default is all of the columns.
+
+    Returns
+    -------
+    Rinv, the approximate inverse of R, as rows, columns, values, and status (0)
+
+    Only the rows of each column of Rinv that can be nonzero (those reachable
+    from the column in the graph of R) are calculated, so the work scales with
+    the number of nonzeros in Rinv, not with the square of the size of R.
+
+    .. Derived from the spsolve_triangular function in scipy version:: 0.19.0
+    """
+    cdef Py_ssize_t N, N_blocks, block, tid
+    # pull apart R and explicitly type the pieces
+    cdef ITYPE_t[:] indptr=np.asarray(R.indptr, dtype=ITYPE)
+    cdef ITYPE_t[:] indices=np.asarray(R.indices, dtype=ITYPE)
+    cdef FTYPE_t[:] data=np.asarray(R.data, dtype=FTYPE)
+    # the column structure of R, for the reach calculation
+    R_csc=R.tocsc()
+    cdef ITYPE_t[:] Cp=np.asarray(R_csc.indptr, dtype=ITYPE)
+    cdef ITYPE_t[:] Ci=np.asarray(R_csc.indices, dtype=ITYPE)
+    N=R.shape[0]
+    n_threads=max(1, n_threads)
+
+    if last_col is None:
+        last_col=N
+    if last_col <= first_col:
+        return np.zeros(0, dtype=ITYPE), np.zeros(0, dtype=ITYPE), np.zeros(0, dtype=FTYPE), 0
+    # split the columns into blocks.  The work for column col is roughly
+    # proportional to the number of entries in rows 0 to col of R
+    work=np.cumsum(np.asarray(R.indptr[1:], dtype=float))
+    N_blocks=min(last_col-first_col, 4*n_threads) if n_threads > 1 else 1
+    N_blocks=max(N_blocks, 1)
+    work_0=work[first_col-1] if first_col > 0 else 0.
+    work_1=work[last_col-1]
+    edges=np.searchsorted(work, work_0+(work_1-work_0)*np.arange(1, N_blocks)/N_blocks)
+    edges=np.unique(np.r_[first_col, np.clip(edges, first_col, last_col), last_col])
+    N_blocks=edges.size-1
+    cdef LTYPE_t[:] col_start=edges[:-1].astype(LTYPE)
+    cdef LTYPE_t[:] col_stop=edges[1:].astype(LTYPE)
+    cdef LTYPE_t[:] next_col=np.zeros(N_blocks, dtype=LTYPE)
+    cdef LTYPE_t[:] N_out=np.zeros(N_blocks, dtype=LTYPE)
+    # one workspace per thread
+    cdef FTYPE_t[:, :] x=np.zeros((n_threads, N), dtype=FTYPE)
+    cdef LTYPE_t[:, :] mark=np.zeros((n_threads, N), dtype=LTYPE)-1
+    cdef LTYPE_t[:, :] stack=np.zeros((n_threads, N), dtype=LTYPE)
+    cdef LTYPE_t[:, :] pstack=np.zeros((n_threads, N), dtype=LTYPE)
+    cdef LTYPE_t[:, :] xi=np.zeros((n_threads, N), dtype=LTYPE)
+    cdef ITYPE_t[:] out_rows
+    cdef ITYPE_t[:] out_cols
+    cdef FTYPE_t[:] out_vals
+    cdef LTYPE_t[:] out_start
+    cdef LTYPE_t[:] out_stop
+
+    rows_list, cols_list, vals_list = [[], [], []]
+    todo=np.arange(N_blocks)
+    capacity=np.maximum(1, nnz)
+    while todo.size > 0:
+        # share the output buffer among the blocks in proportion to their work,
+        # making sure that each block has room for at least one column
+        block_work=np.array([work[col_stop[ii]-1]-(work[col_start[ii]-1] if col_start[ii] > 0 else 0)
+                             for ii in todo])
+        block_cap=np.maximum(capacity*block_work/np.sum(block_work), np.asarray(col_stop)[todo]).astype(LTYPE)
+        edges_out=np.r_[0, np.cumsum(block_cap)]
+        out_start=np.zeros(N_blocks, dtype=LTYPE)
+        out_stop=np.zeros(N_blocks, dtype=LTYPE)
+        for ii, block in enumerate(todo):
+            out_start[block]=edges_out[ii]
+            out_stop[block]=edges_out[ii+1]
+        out_rows=np.zeros(edges_out[-1], dtype=ITYPE)
+        out_cols=np.zeros(edges_out[-1], dtype=ITYPE)
+        out_vals=np.zeros(edges_out[-1], dtype=FTYPE)
+        blocks=np.asarray(todo, dtype=LTYPE)
+        run_blocks(blocks, n_threads, indptr, indices, data, Cp, Ci, col_start, col_stop, tol,
+                   x, mark, stack, pstack, xi, out_rows, out_cols, out_vals, out_start, out_stop, N_out, next_col)
+        for block in todo:
+            these=slice(out_start[block], out_start[block]+N_out[block])
+            rows_list.append(np.asarray(out_rows)[these].copy())
+            cols_list.append(np.asarray(out_cols)[these].copy())
+            vals_list.append(np.asarray(out_vals)[these].copy())
+            # the block will continue from the first column that did not fit
+            col_start[block]=next_col[block]
+        todo=np.array([block for block in todo if col_start[block] < col_stop[block]], dtype=int)
+        capacity *= 2
+    return np.concatenate(rows_list), np.concatenate(cols_list), np.concatenate(vals_list), 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void run_blocks(LTYPE_t[:] blocks, int n_threads, ITYPE_t[:] indptr, ITYPE_t[:] indices,
+                     FTYPE_t[:] data, ITYPE_t[:] Cp, ITYPE_t[:] Ci, LTYPE_t[:] col_start,
+                     LTYPE_t[:] col_stop, FTYPE_t tol, FTYPE_t[:, :] x, LTYPE_t[:, :] mark,
+                     LTYPE_t[:, :] stack, LTYPE_t[:, :] pstack, LTYPE_t[:, :] xi,
+                     ITYPE_t[:] out_rows, ITYPE_t[:] out_cols, FTYPE_t[:] out_vals,
+                     LTYPE_t[:] out_start, LTYPE_t[:] out_stop, LTYPE_t[:] N_out,
+                     LTYPE_t[:] next_col):
+    cdef Py_ssize_t ii, block, tid
+    for ii in prange(blocks.shape[0], nogil=True, num_threads=n_threads, schedule='dynamic'):
+        block=blocks[ii]
+        tid=threadid()
+        next_col[block]=inv_tr_upper_block(indptr, indices, data, Cp, Ci, col_start[block], col_stop[block],
+                                           tol, x[tid,:], mark[tid,:], stack[tid,:], pstack[tid,:],
+                                           xi[tid,:], out_rows, out_cols, out_vals,
+                                           out_start[block], out_stop[block], N_out, block)
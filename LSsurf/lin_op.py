@@ -6,13 +6,165 @@ Created on Tue Dec  5 09:25:46 2017
 """
 import numpy as np
 import scipy.sparse as sp
+import scipy.sparse.linalg as spl
+from concurrent.futures import ThreadPoolExecutor
 from LSsurf.fd_grid import fd_grid
 
 
+def index_dtype(N):
+    # the smaller of int32 and int64 that can hold the indices 0 to N-1
+    if N <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def read_only(arr):
+    # a view of an array that cannot be written to
+    if not isinstance(arr, np.ndarray):
+        return arr
+    view=arr.view()
+    view.flags.writeable=False
+    return view
+
+def read_only_sparse(A):
+    # make the arrays of a compressed sparse matrix read-only
+    for arr in (A.data, A.indices, A.indptr):
+        arr.flags.writeable=False
+    return A
+
+class index_ranges:
+    '''
+    Compact list of indices, stored as ranges of consecutive indices
+
+    index_ranges objects are used for the entries of lin_op.TOC.  They can be
+    used wherever an array of indices is expected (e.g. m0[G.TOC['cols']['z0']],
+    or np.concatenate): numpy converts them to an array of ints.  They also
+    support len(), iteration, and indexing, like a 1-D array.  A block of
+    consecutive indices is stored as a single (start, stop) pair, however
+    large it is.
+    '''
+    def __init__(self, starts=None, stops=None):
+        self.starts=np.atleast_1d(np.asarray([] if starts is None else starts, dtype=int))
+        self.stops=np.atleast_1d(np.asarray([] if stops is None else stops, dtype=int))
+
+    @classmethod
+    def from_array(cls, inds):
+        # encode an array of indices as ranges, keeping the order of the indices
+        inds=np.asarray(inds, dtype=int).ravel()
+        if inds.size==0:
+            return cls()
+        breaks=np.flatnonzero(np.diff(inds) != 1)+1
+        return cls(inds[np.r_[0, breaks]], inds[np.r_[breaks-1, inds.size-1]]+1)
+
+    @classmethod
+    def concatenate(cls, items):
+        # join lists of indices end to end, combining ranges that continue
+        # one another
+        items=[compact_index(item, always=True) for item in items]
+        starts=np.concatenate([np.zeros(0, dtype=int)]+[item.starts for item in items])
+        stops=np.concatenate([np.zeros(0, dtype=int)]+[item.stops for item in items])
+        nonempty=stops > starts
+        starts, stops = [starts[nonempty], stops[nonempty]]
+        if starts.size==0:
+            return cls()
+        new_range=np.r_[True, starts[1:] != stops[:-1]]
+        return cls(starts[new_range], stops[np.r_[new_range[1:], True]])
+
+    def __len__(self):
+        return int(np.sum(self.stops-self.starts))
+
+    @property
+    def size(self):
+        return len(self)
+
+    def __array__(self, dtype=None, copy=None):
+        lengths=self.stops-self.starts
+        first=np.r_[0, np.cumsum(lengths)[:-1]]
+        inds=np.repeat(self.starts-first, lengths)+np.arange(np.sum(lengths), dtype=int)
+        if dtype is not None:
+            inds=inds.astype(dtype)
+        return inds
+
+    def ravel(self):
+        return np.asarray(self)
+
+    def __add__(self, offset):
+        # shifting by a scalar keeps the ranges
+        if np.ndim(offset)==0:
+            return index_ranges(self.starts+offset, self.stops+offset)
+        return np.asarray(self)+offset
+
+    __radd__=__add__
+
+    def __iter__(self):
+        return iter(np.asarray(self))
+
+    def __getitem__(self, ind):
+        # index the list of indices like an array.  A slice of a single range
+        # is returned as a range, and an integer as an int
+        if isinstance(ind, slice) and self.starts.size <= 1 and ind.step in (None, 1):
+            first, last, _ = ind.indices(len(self))
+            start=self.starts[0] if self.starts.size==1 else 0
+            return index_ranges(start+first, start+max(first, last))
+        if np.ndim(ind)==0 and not isinstance(ind, slice) and not isinstance(ind, (bool, np.bool_)):
+            ind=int(ind)
+            N=len(self)
+            if ind < -N or ind >= N:
+                raise IndexError(f'index {ind} is out of bounds for index_ranges with size {N}')
+            ind=ind % N
+            # the range that contains the ind-th index
+            ends=np.cumsum(self.stops-self.starts)
+            which=np.searchsorted(ends, ind, side='right')
+            return int(self.stops[which]-(ends[which]-ind))
+        return np.asarray(self)[ind]
+
+    def __repr__(self):
+        return 'index_ranges('+', '.join(f'{start}:{stop}' for start, stop in zip(self.starts, self.stops))+')'
+
+def compact_index(inds, always=False):
+    # convert a list of indices (an array, range, or index_ranges) to an
+    # index_ranges, if that takes less space than an array (or if always is True)
+    if isinstance(inds, range) and inds.step==1:
+        return index_ranges(inds.start, max(inds.start, inds.stop))
+    if not isinstance(inds, index_ranges):
+        inds_r=index_ranges.from_array(inds)
+        if always or 2*inds_r.starts.size <= len(inds_r):
+            return inds_r
+        return np.asarray(inds, dtype=int).ravel()
+    if always or 2*inds.starts.size <= len(inds):
+        return inds
+    return np.asarray(inds)
+
+def col_union(col_lists):
+    # sorted union of a list of lists of column numbers.  Blocks of
+    # consecutive columns are combined as ranges, without sorting the columns
+    ranges, others = [[], []]
+    for cols in col_lists:
+        cols=compact_index(cols, always=True)
+        if cols.starts.size==1:
+            ranges.append([cols.starts[0], cols.stops[0]])
+        elif cols.starts.size > 1:
+            others.append(np.asarray(cols))
+    merged=[]
+    for start, stop in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1]=max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    result=index_ranges([start for start, _ in merged], [stop for _, stop in merged])
+    if len(others) > 0:
+        result=compact_index(np.union1d(np.asarray(result), np.concatenate(others)))
+    return result
+
 class lin_op:
-    def __init__(self, grid=None, row_0=0, col_N=None, col_0=None, name=None):
+    def __init__(self, grid=None, row_0=0, col_N=None, col_0=None, name=None, v_dtype=None):
         # a lin_op is an operator that represents a set of linear equations applied
         # to the nodes of a grid (defined in fd_grid.py)
+        # the entries of operators combined with add() are kept in _added until
+        # they are needed
+        self._added=[]
+        # The row and column indices are stored as int32 when the operator is
+        # small enough.  If v_dtype is specified (e.g. np.float32), the values
+        # are stored with that type.
         if col_0 is not None:
             self.col_0=col_0
         elif grid is not None:
@@ -38,6 +190,69 @@ class lin_op:
         self.prior=None
         self.shape=None
         self.size=None
+        self.v_dtype=v_dtype
+
+    # the sparse matrices made by toCSR and toCSC are kept until r, c, or v
+    # are set.  r, c, and v are returned as read-only views, so that their
+    # elements cannot be modified in place (e.g. with op.v[ind]=0 or
+    # op.v *= 2) without resetting the matrices: assign new arrays instead
+    # (e.g. op.v = op.v*2).
+    @property
+    def r(self):
+        self.__materialize__()
+        return read_only(self._r)
+
+    @r.setter
+    def r(self, val):
+        self.__materialize__()
+        self._r=val
+        self._csr={}
+
+    @property
+    def c(self):
+        self.__materialize__()
+        return read_only(self._c)
+
+    @c.setter
+    def c(self, val):
+        self.__materialize__()
+        self._c=val
+        self._csr={}
+
+    @property
+    def v(self):
+        self.__materialize__()
+        return read_only(self._v)
+
+    @v.setter
+    def v(self, val):
+        self.__materialize__()
+        self._v=val
+        self._csr={}
+
+    @property
+    def ind0(self):
+        self.__materialize__()
+        return read_only(self._ind0)
+
+    @ind0.setter
+    def ind0(self, val):
+        self.__materialize__()
+        self._ind0=val
+
+    def __materialize__(self):
+        # combine the entries of the operators that have been added to this
+        # one, with one concatenation for each array
+        added=getattr(self, '_added', [])
+        if len(added)==0:
+            return
+        self._added=[]
+        for ind, field in enumerate(['r', 'c', 'v', 'ind0']):
+            this=getattr(self, '_'+field)
+            parts=[] if this is None else [np.ravel(this)]
+            parts += [np.ravel(entries[ind]) for entries in added]
+            setattr(self, '_'+field, np.concatenate(parts))
+        self._csr={}
 
     def __update_size_and_shape__(self):
         self.shape = (self.N_eq, self.col_N)
@@ -104,21 +319,23 @@ class lin_op:
         if which_nodes is not None:
             temp_mask=np.in1d(self.grid.global_ind(sub0s), which_nodes)
             sub0s=[temp[temp_mask] for temp in sub0s]
-        self.r, self.c=[np.zeros((len(sub0s[0]), len(delta_subs[0])), dtype=int) for _ in range(2)]
-        self.v=np.zeros_like(self.r, dtype=float)
+        idx_dtype=index_dtype(max(self.row_0+len(sub0s[0]), self.grid.col_0+self.grid.N_nodes))
+        r, c=[np.zeros((len(sub0s[0]), len(delta_subs[0])), dtype=idx_dtype) for _ in range(2)]
+        v=np.zeros_like(r, dtype=self.__v_dtype__())
         self.N_eq=len(sub0s[0])
         # loop over offsets
         for ii in range(len(delta_subs[0])):
             # build a list of subscripts over dimensions
             this_sub=[sub0+delta[ii] for sub0, delta in zip(sub0s, delta_subs)]
-            self.r[:,ii]=self.row_0+np.arange(0, self.N_eq, dtype=int)
+            r[:,ii]=self.row_0+np.arange(0, self.N_eq, dtype=int)
             if valid_equations_only:
-                self.c[:,ii]=self.grid.global_ind(this_sub)
-                self.v[:,ii]=vals[ii].ravel()
+                c[:,ii]=self.grid.global_ind(this_sub)
+                v[:,ii]=vals[ii].ravel()
             else:
                 # need to remove out-of-bound subscripts
-                self.c[:,ii], valid_ind=self.grid.global_ind(this_sub, return_valid=True)
-                self.v[:,ii]=vals[ii].ravel()*valid_ind.ravel()
+                c[:,ii], valid_ind=self.grid.global_ind(this_sub, return_valid=True)
+                v[:,ii]=vals[ii].ravel()*valid_ind.ravel()
+        self.r, self.c, self.v = [r, c, v]
         #if not valid_equations_only: [Leave this commented until it causes a problem]
         #    # remove the elements that have v=0
         #    nonzero_v = self.v.ravel() != 0
@@ -126,8 +343,8 @@ class lin_op:
         #    self.c = self.c.ravel()[nonzero_v]
         #    self.v = self.v.ravel()[nonzero_v]
         self.ind0 = self.grid.global_ind(sub0s).ravel()
-        self.TOC['rows'] = {self.name:range(self.N_eq)}
-        self.TOC['cols'] = {self.grid.name:np.arange(self.grid.col_0, self.grid.col_0+self.grid.N_nodes)}
+        self.TOC['rows'] = {self.name:index_ranges(0, self.N_eq)}
+        self.TOC['cols'] = {self.grid.name:index_ranges(self.grid.col_0, self.grid.col_0+self.grid.N_nodes)}
         self.__update_size_and_shape__()
         return self
 
@@ -138,20 +355,16 @@ class lin_op:
         # table of contents for the operators.
         # if a list of operators is provided, all are added together, or a single
         # operator can be added to an existing operator.
+        # The entries of the operators are recorded when they are added (the
+        # entries are read-only, so the record is not affected by later
+        # changes to the operators), and are combined the next time the
+        # entries of this operator are needed.
         if isinstance(op, list) or isinstance(op, tuple):
             for this_op in op:
-                op.add(self, this_op)
+                self.add(this_op)
             return self
-        if self.r is not None:
-            self.r=np.append(self.r, op.r)
-            self.c=np.append(self.c, op.c)
-            self.v=np.append(self.v, op.v)
-            self.ind0=np.append(self.ind0, op.ind0)
-        else:
-            self.r=op.r
-            self.c=op.c
-            self.v=op.v
-            self.ind0=op.ind0
+        self._added.append([op.r, op.c, op.v, op.ind0])
+        self._csr={}
         # assume that the new op may have columns that aren't in self.cols, and
         # add any new columns to the table of contents
         for key in op.TOC['cols'].keys():
@@ -160,7 +373,7 @@ class lin_op:
         self.__update_size_and_shape__()
         return self
 
-    def interp_mtx(self, pts_in, xform=None, dims=None, bounds_error=True):
+    def interp_mtx(self, pts_in, xform=None, dims=None, bounds_error=True, chunk_size=None, n_threads=1):
         """
         Create a matrix that interpolates a grid to a set of points.
 
@@ -182,6 +395,14 @@ class lin_op:
             If True, an error will occur if interpolation values are requested
             for points outside the grid.  If False, the interpolation will
             return zero for points outside the grid.  The default is True
+        chunk_size: int, optional
+            If specified, the points are processed in blocks of chunk_size
+            points, and the entries for each block are written directly into
+            the arrays of the operator, so that the temporary arrays scale
+            with chunk_size instead of with the number of points.  The
+            default is None (all points in one block).
+        n_threads: int, optional
+            Number of threads used to process the blocks.  The default is 1
 
         Returns
         -------
@@ -193,25 +414,23 @@ class lin_op:
                 xform=self.grid.xform
         if dims is None:
             dims = np.arange(self.grid.N_dims, dtype=int)
-        if xform is not None:
-            pts = self.apply_xform(pts_in, xform, dims)
+        N_in=pts_in[0].size
+        if chunk_size is None:
+            chunks=[slice(0, N_in)]
         else:
-            pts = [jj.ravel() for jj in pts_in]
+            chunks=[slice(ind, min(ind+chunk_size, N_in)) for ind in range(0, N_in, int(chunk_size))]
         # get indices of valid points
-        row=np.flatnonzero(self.grid.validate_pts(pts))
-        if bounds_error and len(row) < len(pts[0]):
-            raise(ValueError(f'Found {len(pts[0])-len(row)} points out of bounds for grid {self.grid.name}'))
-        # subsample valid points.  row is now the index into the input arrays
-        pts =[temp[row] for temp in pts]
-        # Identify the nodes surrounding each data point
-        # The floating-point subscript expresses the point locations in terms
-        # of their grid positions
-        ii=self.grid.float_sub(pts)
-        cell_sub=self.grid.cell_sub_for_pts(pts)
-        # calculate the fractional part of each cell_sub
-        i_local=[a-b for a, b in zip(ii,cell_sub)]
-        # find the index of the node below each data point
-        global_ind=self.grid.global_ind(cell_sub)
+        valid=np.zeros(N_in, dtype=bool)
+        for chunk in chunks:
+            pts=self.__interp_pts__(pts_in, xform, dims, chunk)
+            valid[chunk]=self.grid.validate_pts(pts)
+        if len(chunks) > 1:
+            # the coordinates will be calculated again for each chunk
+            pts=None
+        row=np.flatnonzero(valid)
+        if bounds_error and len(row) < N_in:
+            raise(ValueError(f'Found {N_in-len(row)} points out of bounds for grid {self.grid.name}'))
+        idx_dtype=index_dtype(max(N_in, self.grid.col_0+self.grid.N_nodes))
         # make a list of dimensions based on the dimensions of the grid
         if self.grid.N_dims==1:
             list_of_dims=np.mgrid[0:2, 0:1]
@@ -222,18 +441,49 @@ class lin_op:
         delta_ind=np.c_[[kk.ravel() for kk in list_of_dims]]
         n_neighbors=delta_ind.shape[1]
         Npts=len(row)
-        rr=np.zeros([Npts, n_neighbors], dtype=int)
-        cc=np.zeros([Npts, n_neighbors], dtype=int)
-        vv= np.ones([Npts, n_neighbors], dtype=float)
-        # make lists of row and column indices and weights for the nodes
-        for ii in range(n_neighbors):
-            rr[:,ii]=row.copy()
-            cc[:,ii]=global_ind+np.sum(self.grid.stride*delta_ind[:,ii])
-            for dd in range(self.grid.N_dims):
-                if delta_ind[dd, ii]==0:
-                    vv[:,ii]*=(1.-i_local[dd])
-                else:
-                    vv[:,ii]*=i_local[dd]
+        rr=np.zeros([Npts, n_neighbors], dtype=idx_dtype)
+        cc=np.zeros([Npts, n_neighbors], dtype=idx_dtype)
+        vv= np.ones([Npts, n_neighbors], dtype=self.__v_dtype__())
+        # the rows of the operator for each chunk
+        out_0=np.searchsorted(row, [chunk.start for chunk in chunks]+[N_in])
+
+        def fill_chunk(ind):
+            out=slice(out_0[ind], out_0[ind+1])
+            if out.stop==out.start:
+                return
+            these_rows=row[out]
+            if pts is None:
+                chunk_pts=self.__interp_pts__(pts_in, xform, dims, chunks[ind])
+            else:
+                chunk_pts=pts
+            # subsample valid points.  these_rows is the index into the input arrays
+            chunk_pts=[temp[these_rows-chunks[ind].start] for temp in chunk_pts]
+            # Identify the nodes surrounding each data point
+            # The floating-point subscript expresses the point locations in terms
+            # of their grid positions
+            ii=self.grid.float_sub(chunk_pts)
+            cell_sub=self.grid.cell_sub_for_pts(chunk_pts)
+            # calculate the fractional part of each cell_sub
+            i_local=[a-b for a, b in zip(ii,cell_sub)]
+            # find the index of the node below each data point
+            global_ind=self.grid.global_ind(cell_sub)
+            # make lists of row and column indices and weights for the nodes
+            for ii in range(n_neighbors):
+                rr[out,ii]=these_rows
+                cc[out,ii]=global_ind+np.sum(self.grid.stride*delta_ind[:,ii])
+                for dd in range(self.grid.N_dims):
+                    if delta_ind[dd, ii]==0:
+                        vv[out,ii]*=(1.-i_local[dd])
+                    else:
+                        vv[out,ii]*=i_local[dd]
+
+        if n_threads > 1 and len(chunks) > 1:
+            # the chunks write to separate rows of rr, cc, and vv
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                list(pool.map(fill_chunk, range(len(chunks))))
+        else:
+            for ind in range(len(chunks)):
+                fill_chunk(ind)
         self.r=rr
         self.c=cc
         self.v=vv
@@ -241,11 +491,17 @@ class lin_op:
         # in this case, sub0s is the index of the data points
         self.ind0=np.arange(0, Npts, dtype='int')
         # report the table of contents
-        self.TOC['rows']={self.name:np.arange(self.N_eq, dtype='int')}
-        self.TOC['cols']={self.grid.name:np.arange(self.grid.col_0, self.grid.col_0+self.grid.N_nodes)}
+        self.TOC['rows']={self.name:index_ranges(0, self.N_eq)}
+        self.TOC['cols']={self.grid.name:index_ranges(self.grid.col_0, self.grid.col_0+self.grid.N_nodes)}
         self.__update_size_and_shape__()
         return self
 
+    def __interp_pts__(self, pts_in, xform, dims, chunk):
+        # coordinates of points pts_in[:][chunk] for interp_mtx
+        if xform is not None:
+            return self.apply_xform([jj.ravel()[chunk] for jj in pts_in], xform, dims)
+        return [jj.ravel()[chunk] for jj in pts_in]
+
     def one(self, DOF='z'):
         self.diff_op([[0], [0]], np.array([1.]))
         self.__update_size_and_shape__()
@@ -253,16 +509,16 @@ class lin_op:
 
     def grad(self, DOF='z'):
         coeffs=np.array([-1., 1.])/(self.grid.delta[0])
-        dzdx=lin_op(self.grid, name='d'+DOF+'_dx').diff_op(([0, 0],[-1, 0]), coeffs)
-        dzdy=lin_op(self.grid, name='d'+DOF+'_dy').diff_op(([-1, 0],[0, 0]), coeffs)
+        dzdx=self.__class__(self.grid, name='d'+DOF+'_dx').diff_op(([0, 0],[-1, 0]), coeffs)
+        dzdy=self.__class__(self.grid, name='d'+DOF+'_dy').diff_op(([-1, 0],[0, 0]), coeffs)
         self.vstack((dzdx, dzdy))
         self.__update_size_and_shape__()
         return self
 
     def grad_dzdt(self, DOF='z', t_lag=1):
         coeffs=np.array([-1., 1., 1., -1.])/(t_lag*self.grid.delta[0]*self.grid.delta[2])
-        d2zdxdt=lin_op(self.grid, name='d2'+DOF+'_dxdt').diff_op(([ 0, 0,  0, 0], [-1, 0, -1, 0], [-t_lag, -t_lag, 0, 0]), coeffs)
-        d2zdydt=lin_op(self.grid, name='d2'+DOF+'_dydt').diff_op(([-1, 0, -1, 0], [ 0, 0,  0, 0], [-t_lag, -t_lag, 0, 0]), coeffs)
+        d2zdxdt=self.__class__(self.grid, name='d2'+DOF+'_dxdt').diff_op(([ 0, 0,  0, 0], [-1, 0, -1, 0], [-t_lag, -t_lag, 0, 0]), coeffs)
+        d2zdydt=self.__class__(self.grid, name='d2'+DOF+'_dydt').diff_op(([-1, 0, -1, 0], [ 0, 0,  0, 0], [-t_lag, -t_lag, 0, 0]), coeffs)
         self.vstack((d2zdxdt, d2zdydt))
         self.__update_size_and_shape__()
         return self
@@ -284,25 +540,25 @@ class lin_op:
 
     def d2z_dt2(self, DOF='dz', t_lag=1):
         coeffs=np.array([-1, 2, -1])/((t_lag*self.grid.delta[2])**2)
-        self=lin_op(self.grid, name='d2'+DOF+'_dt2').diff_op(([0,0,0], [0,0,0], [-t_lag, 0, t_lag]), coeffs)
+        self=self.__class__(self.grid, name='d2'+DOF+'_dt2').diff_op(([0,0,0], [0,0,0], [-t_lag, 0, t_lag]), coeffs)
         self.__update_size_and_shape__()
         return self
 
     def grad2(self, DOF='z'):
         coeffs=np.array([-1., 2., -1.])/(self.grid.delta[0]**2)
-        d2zdx2=lin_op(self.grid, name='d2'+DOF+'_dx2').diff_op(([0, 0, 0],[-1, 0, 1]), coeffs)
-        d2zdy2=lin_op(self.grid, name='d2'+DOF+'_dy2').diff_op(([-1, 0, 1],[0, 0, 0]), coeffs)
-        d2zdxdy=lin_op(self.grid, name='d2'+DOF+'_dxdy').diff_op(([-1, -1, 1,1],[-1, 1, -1, 1]), 0.5*np.array([-1., 1., 1., -1])/(self.grid.delta[0]**2))
+        d2zdx2=self.__class__(self.grid, name='d2'+DOF+'_dx2').diff_op(([0, 0, 0],[-1, 0, 1]), coeffs)
+        d2zdy2=self.__class__(self.grid, name='d2'+DOF+'_dy2').diff_op(([-1, 0, 1],[0, 0, 0]), coeffs)
+        d2zdxdy=self.__class__(self.grid, name='d2'+DOF+'_dxdy').diff_op(([-1, -1, 1,1],[-1, 1, -1, 1]), 0.5*np.array([-1., 1., 1., -1])/(self.grid.delta[0]**2))
         self.vstack((d2zdx2, d2zdy2, d2zdxdy))
         self.__update_size_and_shape__()
         return self
 
     def grad2_dzdt(self, DOF='z', t_lag=1):
         coeffs=np.array([-1., 2., -1., 1., -2., 1.])/(t_lag*self.grid.delta[0]**2.*self.grid.delta[2])
-        d3zdx2dt=lin_op(self.grid, name='d3'+DOF+'_dx2dt').diff_op(([0, 0, 0, 0, 0, 0],[-1, 0, 1, -1, 0, 1], [-t_lag,-t_lag,-t_lag, 0, 0, 0]), coeffs)
-        d3zdy2dt=lin_op(self.grid, name='d3'+DOF+'_dy2dt').diff_op(([-1, 0, 1, -1, 0, 1], [0, 0, 0, 0, 0, 0], [-t_lag, -t_lag, -t_lag, 0, 0, 0]), coeffs)
+        d3zdx2dt=self.__class__(self.grid, name='d3'+DOF+'_dx2dt').diff_op(([0, 0, 0, 0, 0, 0],[-1, 0, 1, -1, 0, 1], [-t_lag,-t_lag,-t_lag, 0, 0, 0]), coeffs)
+        d3zdy2dt=self.__class__(self.grid, name='d3'+DOF+'_dy2dt').diff_op(([-1, 0, 1, -1, 0, 1], [0, 0, 0, 0, 0, 0], [-t_lag, -t_lag, -t_lag, 0, 0, 0]), coeffs)
         coeffs=np.array([-1., 1., 1., -1., 1., -1., -1., 1.])/(self.grid.delta[0]**2*self.grid.delta[2])
-        d3zdxdydt=lin_op(self.grid, name='d3'+DOF+'_dxdydt').diff_op(([-1, 0, -1, 0, -1, 0, -1, 0], [-1, -1, 0, 0, -1, -1, 0, 0], [-t_lag, -t_lag, -t_lag, -t_lag, 0, 0, 0, 0]),  coeffs)
+        d3zdxdydt=self.__class__(self.grid, name='d3'+DOF+'_dxdydt').diff_op(([-1, 0, -1, 0, -1, 0, -1, 0], [-1, -1, 0, 0, -1, -1, 0, 0], [-t_lag, -t_lag, -t_lag, -t_lag, 0, 0, 0, 0]),  coeffs)
         self.vstack((d3zdx2dt, d3zdy2dt, d3zdxdydt))
         self.__update_size_and_shape__()
         return self
@@ -317,7 +573,7 @@ class lin_op:
         norm = unit_op.toCSR(row_N=unit_op.N_eq).dot(np.ones(self.shape[1]))
         scale = np.zeros_like(norm)
         scale[norm>0] = 1./norm[norm>0]
-        self.v *= scale[self.r]*wt
+        self.v = self.v*scale[self.r]*wt
 
     def mean_of_bounds(self, bds, mask=None):
         # make a linear operator that calculates the mean of all points
@@ -514,8 +770,8 @@ class lin_op:
             self.v=np.ones_like(ind, dtype='float')
         else:
             self.v=val.ravel()
-        self.TOC['rows']={self.name:np.unique(self.r)}
-        self.TOC['cols']={self.name:np.unique(self.c)}
+        self.TOC['rows']={self.name:compact_index(np.unique(self.r))}
+        self.TOC['cols']={self.name:compact_index(np.unique(self.c))}
         self.N_eq=np.max(ind)+1
         self.__update_size_and_shape__()
         return self
@@ -538,17 +794,48 @@ class lin_op:
 
     def grid_error(self, Rinv, grid=None):
         # calculate the error estimate for an operator and map the result to a grid
+        return self.grid_error_from_variance(self.error_variance(Rinv), grid=grid)
+
+    def __error_ind0__(self):
+        # nodes of the output grid that correspond to the rows of the operator
+        if self.dst_ind0 is None:
+            return self.ind0
+        return self.dst_ind0
+
+    def error_variance(self, Rinv):
+        # calculate the variance of each row of the operator, given the
+        # inverse of the R factor (or a block of its columns, in which case
+        # the result is that block's contribution to the variance)
+        return np.asarray((self.toCSR(row_N=self.__error_ind0__().size, col_N=Rinv.shape[0]).dot(Rinv)).power(2).sum(axis=1)).ravel()
+
+    def error_variance_from_R(self, R, perm, Ip_c=None, N_batch=256):
+        # calculate the variance of each row of the operator from the R factor
+        # of the weighted system, for which R^T R is the normal matrix for the
+        # parameters ordered by perm.  The variance of row a is |R^-T a[perm]|^2,
+        # so batches of N_batch rows are found with triangular solves, and Rinv
+        # is not needed.  If specified, Ip_c maps the parameters of R to the
+        # columns of the operator
+        if Ip_c is None:
+            Ip_c=sp.eye(R.shape[0], format='csr')
+        A=self.toCSR(row_N=self.__error_ind0__().size, col_N=Ip_c.shape[0]).dot(Ip_c).tocsc()[:, perm]
+        A=A.T.tocsc()
+        RT=R.T.tocsr()
+        variance=np.zeros(A.shape[1])
+        for row_0 in range(0, A.shape[1], N_batch):
+            rows=np.arange(row_0, np.minimum(row_0+N_batch, A.shape[1]))
+            Y=spl.spsolve_triangular(RT, A[:, rows].toarray(), lower=True)
+            variance[rows]=np.sum(Y**2, axis=0)
+        return variance
+
+    def grid_error_from_variance(self, variance, grid=None):
+        # map the square root of the row variances to a grid
         if grid is None:
             if self.dst_grid is None:
                 grid=self.grid
             else:
                 grid=self.dst_grid
-        if self.dst_ind0 is None:
-            ind0=self.ind0
-        else:
-            ind0=self.dst_ind0
         E=np.zeros(self.col_N)+np.NaN
-        E[ind0]=np.sqrt((self.toCSR(row_N=ind0.size, col_N=Rinv.shape[0]).dot(Rinv)).power(2).sum(axis=1)).ravel()
+        E[self.__error_ind0__()]=np.sqrt(variance)
         return E[grid.col_0:grid.col_N].reshape(grid.shape)
 
     def vstack(self, ops, order=None, name=None, TOC_cols=None):
@@ -561,34 +848,44 @@ class lin_op:
             ops=(self, ops)
         if order is None:
             order=range(len(ops))
+        row_0s=self.__vstack_TOC__(ops, order, name=name, TOC_cols=TOC_cols)
+        # Combine the nonzero entries.  The row indices are converted to a
+        # type that can hold the row numbers for the whole stack
+        idx_dtype=index_dtype(self.N_eq)
+        self.r=np.concatenate([ops[ind].r.ravel().astype(np.promote_types(ops[ind].r.dtype, idx_dtype), copy=False)+row_0
+                               for ind, row_0 in zip(order, row_0s)])
+        self.c=np.concatenate([ops[ind].c.ravel() for ind in order])
+        self.v=np.concatenate([ops[ind].v.ravel() for ind in order])
+        self.__update_size_and_shape__()
+        return self
+
+    def __vstack_TOC__(self, ops, order, name=None, TOC_cols=None):
+        # build the table of contents, the expected values, and the central
+        # indices for a vertical stack of operators.  Returns the first row
+        # for each operator in the stack
         if name is not None:
             self.name=name
         if TOC_cols is None:
             TOC_cols=dict()
-            col_array=np.array([], dtype=int)
+            col_lists=[]
             for op in ops:
                 for key in op.TOC['cols'].keys():
                     TOC_cols[key]=op.TOC['cols'][key]
-                    col_array=np.append(col_array, op.TOC['cols'][key])
+                    col_lists.append(op.TOC['cols'][key])
             # add an entry for this entire operator
             if self.name is not None:
-                TOC_cols[self.name]=np.unique(col_array)
+                TOC_cols[self.name]=col_union(col_lists)
         if self.col_N is None:
             self.col_N=np.max(np.array([op.col_N for op in ops]))
 
         self.TOC['cols']=TOC_cols
-        # rr, cc, and vv are lists that will be populated with the nonzero
-        # entries for each matrix being combined.
-        rr=list()
-        cc=list()
-        vv=list()
+        # ee is a list that will be populated with the expected values for
+        # each matrix being combined.
         ee=list()
+        row_0s=list()
         last_row=0
         for ind in order:
-            # append the nonzero entries to the list of entries
-            rr.append(ops[ind].r.ravel()+last_row)
-            cc.append(ops[ind].c.ravel())
-            vv.append(ops[ind].v.ravel())
+            row_0s.append(last_row)
             if ops[ind].expected is not None:
                 ee.append(ops[ind].expected.ravel())
             # label these equations in the TOC
@@ -607,27 +904,22 @@ class lin_op:
             # shift the TOC entries and keep track of what sub-operators make up the current operator
             this_row_list=list()
             for key in ops[ind].TOC['rows'].keys():
-                these_rows=np.array(ops[ind].TOC['rows'][key], dtype='int')+last_row
+                these_rows=compact_index(ops[ind].TOC['rows'][key])+last_row
                 self.TOC['rows'][key]=these_rows
-                this_row_list.append(these_rows.ravel())
+                this_row_list.append(these_rows)
             # add a TOC entry for all of the sub operators together, if it's
             # not there already (which happens if we're concatenating composite operators)
             if this_name not in self.TOC['rows']:
-                self.TOC['rows'][this_name]=np.concatenate(this_row_list)
+                self.TOC['rows'][this_name]=compact_index(index_ranges.concatenate(this_row_list))
             last_row+=ops[ind].N_eq
-        # Combine the nonzero entries
         self.N_eq=last_row
-        self.r=np.concatenate(rr)
-        self.c=np.concatenate(cc)
-        self.v=np.concatenate(vv)
         if len(ee) > 0:
             self.expected=np.concatenate(ee)
 
         self.ind0=np.concatenate([op.ind0 for op in ops])
         if self.name is not None and len(self.name) >0:
-            self.TOC['rows'][self.name]=np.arange(0, last_row)
-        self.__update_size_and_shape__()
-        return self
+            self.TOC['rows'][self.name]=index_ranges(0, last_row)
+        return row_0s
 
     def mask_for_ind0(self,  mask_scale=None, mask=None):
         """
@@ -665,26 +957,21 @@ class lin_op:
         else:
             return temp
 
-    def apply_2d_mask(self, mask=None):
+    def apply_2d_mask(self, mask=None, row_N=None):
         # multiply array elements by the values in a mask
         # The mask must have dimensions equal to the first two dimensions of
         # self.grid
         # if no mask is specified, use self.grid.mask
         if mask is None:
             mask=self.grid.mask
-        csr=self.toCSR()
-
-        for row in range(csr.shape[0]):
-            # get the indices of the nonzero entries for the row
-            inds=csr[row,:].nonzero()[1]
-            # get the mask subscripts for the indices
-            subs=np.unravel_index(inds-self.grid.col_0, self.grid.shape)
-            # query the mask at those points
-            mask_ind=np.ravel_multi_index([subs[0], subs[1]], mask.shape)
-            # want to do: csr[row,inds] *= mask.ravel()[mask_ind]
-            # but need to add a toarray() step to avoid broadcasting rules
-            temp = csr[row, inds].toarray()
-            csr[row,inds] = temp.ravel()*mask.ravel()[mask_ind]
+        csr=self.toCSR(row_N=row_N).copy()
+        # the nonzero entries of the matrix
+        nz=np.flatnonzero(csr.data)
+        # get the mask subscripts for the entries
+        subs=np.unravel_index(csr.indices[nz]-self.grid.col_0, self.grid.shape)
+        # query the mask at those points
+        mask_ind=np.ravel_multi_index([subs[0], subs[1]], mask.shape)
+        csr.data[nz] = csr.data[nz]*mask.ravel()[mask_ind]
         temp=csr.tocoo()
         self.r, self.c, self.v=[temp.row, temp.col, temp.data]
         return self
@@ -695,37 +982,32 @@ class lin_op:
         # if no mask is specified, use self.grid.mask
         if mask is None:
             mask=self.grid.mask
-        csr=self.toCSR(row_N=row_N, col_N=self.col_N)
-
-        for row in range(csr.shape[0]):
-            # get the indices of the nonzero entries for the row
-            inds=csr[row,:].nonzero()[1]
-            # get the mask subscripts for the indices
-            subs=np.unravel_index(inds-self.grid.col_0, self.grid.shape)
-            # convert the subscripts into an index into the raveled mask
-            mask_ind=np.ravel_multi_index([*subs[0:mask.ndim]], mask.shape)
-            mask_sub = mask.ravel()[mask_ind]
-            if not np.any(mask_sub):
-                csr[row, inds]=0.
-                continue
-            if time_step_overlap > 1:
-                #Here, we ount the time steps overlapped for each 2-d grid cell
-                # First, find the 2D indices of each entry in the operator row
-                inds_2d = np.ravel_multi_index(subs[0:2],  mask.shape[0:2])
-                # build a matrix that maps the 3-D cells to the 2-D cells
-                twoD_to_3D = sp.coo_matrix((np.ones_like(inds), (inds_2d, inds-self.grid.col_0)),
-                                                 shape=(np.max(inds_2d)+1, mask.size))
-                # Multiplying this matrix by the mask counts the entries in the
-                # 3D mask included in each cell
-                enough_cells = twoD_to_3D.dot(mask.ravel()) >= time_step_overlap
-                # map the 2-D cells with enough 3D entries back to the 3-D index
-                overlap_mask = twoD_to_3D.T.dot(enough_cells.astype(float))
-            # want to do: csr[row,inds] *= mask.ravel()[mask_ind]
-            # but need to add a toarray() step to avoid broadcasting rules
-            temp = csr[row, inds].toarray()
-            if time_step_overlap > 1:
-                temp *= overlap_mask[inds-self.grid.col_0].ravel()
-            csr[row,inds] = temp.ravel()*mask_sub
+        csr=self.toCSR(row_N=row_N, col_N=self.col_N).copy()
+        # the nonzero entries of the matrix, and their rows
+        nz=np.flatnonzero(csr.data)
+        rows=np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))[nz]
+        inds=csr.indices[nz]-self.grid.col_0
+        vals=csr.data[nz]
+        # get the mask subscripts for the entries
+        subs=np.unravel_index(inds, self.grid.shape)
+        # convert the subscripts into an index into the raveled mask
+        mask_ind=np.ravel_multi_index([*subs[0:mask.ndim]], mask.shape)
+        mask_sub = mask.ravel()[mask_ind]
+        if time_step_overlap > 1:
+            # Here, we count the time steps overlapped for each 2-d grid cell
+            # in each row. First, find the 2D indices of each entry
+            inds_2d = np.ravel_multi_index(subs[0:2],  mask.shape[0:2])
+            # number the (row, 2-D cell) pairs
+            _, cell = np.unique(rows*np.prod(mask.shape[0:2]) + inds_2d, return_inverse=True)
+            # sum the entries in the 3D mask included in each cell
+            N_masked = np.bincount(cell.ravel(), weights=mask.ravel()[inds])
+            # keep the entries in the 2-D cells with enough 3D entries
+            vals = vals * (N_masked[cell.ravel()] >= time_step_overlap).astype(float)
+        vals = vals*mask_sub
+        # rows for which the mask is zero at every entry are set to zero
+        row_masked = np.bincount(rows, weights=mask_sub != 0, minlength=csr.shape[0]) > 0
+        vals[~row_masked[rows]] = 0.
+        csr.data[nz] = vals
         temp=csr.tocoo()
         self.r, self.c, self.v=[temp.row, temp.col, temp.data]
         return self
@@ -737,16 +1019,51 @@ class lin_op:
             for key in sorted(rc_min, key=rc_min.get):
                 print("\t%s\t%d : %d" % (key, np.min(self.TOC[rc][key]), np.max(self.TOC[rc][key])))
 
+    def __v_dtype__(self):
+        # the type used to build the values of the operator
+        if self.v_dtype is None:
+            return float
+        return self.v_dtype
+
     def fix_dtypes(self):
-        self.r=self.r.astype(int)
-        self.c=self.c.astype(int)
+        # convert the indices to the smallest integer type that can hold
+        # them, and the values to self.v_dtype (if specified)
+        N=max([self.col_N or 0]+[int(np.max(ii))+1 for ii in (self.r, self.c) if ii.size > 0])
+        idx_dtype=index_dtype(N)
+        # the arrays are only set (resetting the kept matrices) if their types change
+        if self.r.dtype != idx_dtype:
+            self.r=self.r.astype(idx_dtype)
+        if self.c.dtype != idx_dtype:
+            self.c=self.c.astype(idx_dtype)
+        if self.v_dtype is not None and self.v.dtype != self.v_dtype:
+            self.v=self.v.astype(self.v_dtype)
 
     def toCSR(self, col_N=None, row_N=None):
         # transform a linear operator to a sparse CSR matrix
+        # The matrix is kept, and is returned by later calls with the same
+        # col_N and row_N.  Its arrays are read-only, so it cannot be modified
+        # in place: use .copy() to get a matrix that can be modified.
+        if col_N is None:
+            col_N=self.col_N
+        key=(col_N, row_N)
+        if 'csr' not in self._csr or self._csr['csr'][0] != key:
+            self.fix_dtypes()
+            good=self.v.ravel() != 0
+            if row_N is None:
+                row_N=np.max(self.r.ravel()[good])+1
+            csr=sp.csr_matrix((self.v.ravel()[good],(self.r.ravel()[good], self.c.ravel()[good])), shape=(row_N, col_N))
+            # fix_dtypes can reset the kept matrices, so the matrix is stored
+            # afterwards.  Only the last CSR matrix is kept
+            self._csr['csr']=(key, read_only_sparse(csr))
+        return self._csr['csr'][1]
+
+    def toCSC(self, col_N=None, row_N=None):
+        # transform a linear operator to a sparse CSC matrix.  As with toCSR,
+        # the last CSC matrix is kept, and is read-only.
         if col_N is None:
             col_N=self.col_N
-        self.fix_dtypes()
-        good=self.v.ravel() != 0
-        if row_N is None:
-            row_N=np.max(self.r.ravel()[good])+1
-        return sp.csr_matrix((self.v.ravel()[good],(self.r.ravel()[good], self.c.ravel()[good])), shape=(row_N, col_N))
+        key=(col_N, row_N)
+        if 'csc' not in self._csr or self._csr['csc'][0] != key:
+            csc=self.toCSR(col_N=col_N, row_N=row_N).tocsc()
+            self._csr['csc']=(key, read_only_sparse(csc))
+        return self._csr['csc'][1]
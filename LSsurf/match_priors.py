@@ -30,7 +30,7 @@ def make_prior_op(grids, dz, src_name, ref_time=0, sigma_scale=1):
     m0 = lin_op(grids['dz'], name='prior_dz0_'+src_name)\
         .interp_mtx((dz.y, dz.x, np.zeros_like(dz.t)+ref_time))
     # invert the values of m1 (so that the reference epoch is subtracted)
-    m0.v *= -1
+    m0.v = -m0.v
     m1.add(m0)
     # set the expected misfit to sigma_scale*dz.sigma_d
     m1.expected=sigma_scale*dz.sigma_dz
@@ -100,7 +100,7 @@ def match_prior_dz(grids, dzs=None, filenames=None, ref_epoch=0, group='dz', fie
     return m_list
 
 
-def match_tile_edges(grids, ref_epoch, prior_dir=None,
+def match_tile_edges(grids, ref_epoch, prior_dir=None, prior_files=None,
                      tile_spacing=4.e4,
                      edge_include=3.e3,
                      group='dz', field_mapping=None, \
@@ -112,6 +112,7 @@ def match_tile_edges(grids, ref_epoch, prior_dir=None,
         grids (dict): dict containing LSsurf.fdgrid objects.  Must include a 'dz' entry
         xy0 (2-iterable) : center coordinates for the grid to be constrained
         prior_dir (str or iterable): directory containing tiles to be matched
+        prior_files (iterable) : if specified, only these files are matched, and prior_dir is ignored
         tile_W (scalar ) : Width of the tiles (default: 8e4)
         tile_spacing (scalar) : distance between tile centers
         edge_include (scalar) : Width of the constraining grids to include at the edges
@@ -128,7 +129,9 @@ def match_tile_edges(grids, ref_epoch, prior_dir=None,
     tile_W = np.diff(grids['z0'].bds[0])
 
     tile_re=re.compile('E(.*)_N(.*).h5')
-    if isinstance(prior_dir, (list, tuple)):
+    if prior_files is not None:
+        all_files = list(prior_files)
+    elif isinstance(prior_dir, (list, tuple)):
         all_files = []
         for thedir in prior_dir:
             all_files += glob.glob(thedir+'/E*N*.h5')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for the smoothness-constraint operators
+"""
+
+import os
+import pickle
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+from LSsurf.lin_op import lin_op
+
+''' On-disk cache for lin_op objects
+
+    Operators like the smoothness constraints depend only on the geometry of
+    the grid they are built on, so tiles with the same grid geometry build
+    identical operators.  An op_cache stores the operators in a directory,
+    one subdirectory per operator, named by a hash of the grid geometry and
+    of the method used to build the operator.  The r, c, v, and ind0 arrays
+    are stored as .npy files, and are memory mapped when they are read.
+
+    Contains:
+        op_cache
+'''
+
+class op_cache:
+    '''
+    Directory of lin_op objects, keyed by grid geometry and operator type
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory in which the operators are stored.  Created if it does not
+        exist.  The directory can be shared between processes.
+    max_bytes : int, optional
+        if specified, the least recently used operators are deleted when the
+        cache holds more than max_bytes.  The default is None (no limit).
+    '''
+    array_fields=['r', 'c', 'v', 'ind0']
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, grid, name, method, kwargs):
+        '''
+        Calculate the key for an operator
+
+        The key depends on the shape, spacing, first column, and name of the
+        grid (which determine the operator and its table of contents), on
+        the number of columns, and on the operator name, method, and arguments.
+        '''
+        desc=repr((tuple(int(N) for N in grid.shape),
+                   tuple(float(delta) for delta in grid.delta),
+                   int(grid.col_0), int(grid.col_N), grid.name,
+                   name, method, sorted(kwargs.items())))
+        return hashlib.sha1(desc.encode()).hexdigest()
+
+    def build(self, op_class, grid, name, method, **kwargs):
+        '''
+        Build an operator, or read it from the cache
+
+        Parameters
+        ----------
+        op_class : class
+            lin_op or a subclass.  Only lin_op objects are cached: subclasses
+            (e.g. stencil_op) are built directly.
+        grid : fd_grid
+            grid for the operator
+        name : str
+            name of the operator
+        method : str
+            name of the method that builds the operator
+        **kwargs :
+            keyword arguments for the method
+
+        Returns
+        -------
+        lin_op
+            the result of op_class(grid, name=name).method(**kwargs)
+        '''
+        if op_class is not lin_op:
+            return getattr(op_class(grid, name=name), method)(**kwargs)
+        entry=os.path.join(self.cache_dir, self.key(grid, name, method, kwargs))
+        op=self.__read__(entry, grid)
+        if op is None:
+            op=getattr(lin_op(grid, name=name), method)(**kwargs)
+            self.__write__(entry, op)
+        return op
+
+    def __read__(self, entry, grid):
+        # read an operator from an entry, or return None if it is not there.
+        # Entries that cannot be read (e.g. partly deleted entries, or entries
+        # whose metadata refer to classes that have changed since they were
+        # written) are deleted, so that they are built again
+        if not os.path.isdir(entry):
+            return None
+        try:
+            with open(os.path.join(entry, 'meta.pkl'),'rb') as fh:
+                meta=pickle.load(fh)
+            arrays={}
+            for field in self.array_fields:
+                filename=os.path.join(entry, field+'.npy')
+                # empty arrays cannot be memory mapped
+                mmap_mode='c' if os.path.getsize(filename) > 128 else None
+                arrays[field]=np.load(filename, mmap_mode=mmap_mode)
+            op=lin_op(grid, name=meta['name'], col_N=meta['col_N'])
+            for field, val in arrays.items():
+                setattr(op, field, val)
+            op.N_eq=meta['N_eq']
+            op.TOC=meta['TOC']
+            op.__update_size_and_shape__()
+            # mark the entry as recently used
+            os.utime(entry)
+        except (OSError, EOFError, ValueError, KeyError, AttributeError, ImportError, pickle.UnpicklingError):
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        return op
+
+    def __write__(self, entry, op):
+        # write the operator to a temporary directory, then rename it, so that
+        # other processes never see a partly written entry
+        temp_dir=tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            for field in self.array_fields:
+                np.save(os.path.join(temp_dir, field+'.npy'), np.asarray(getattr(op, field)))
+            with open(os.path.join(temp_dir, 'meta.pkl'),'wb') as fh:
+                pickle.dump({'name':op.name, 'N_eq':op.N_eq, 'TOC':op.TOC, 'col_N':op.col_N}, fh)
+            os.rename(temp_dir, entry)
+        except OSError:
+            # another process has written the entry
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        '''
+        Delete the least recently used entries until the cache fits in max_bytes
+        '''
+        if self.max_bytes is None:
+            return
+        entries=[]
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue
+            path=os.path.join(self.cache_dir, key)
+            try:
+                size=sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        total=sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
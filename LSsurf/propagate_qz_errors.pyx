@@ -4,13 +4,16 @@ import numpy as np
 cimport numpy as np
 ITYPE=np.int32
 ctypedef np.int32_t ITYPE_t
-FTYPE=np.float
-ctypedef np.float_t FTYPE_t
+LTYPE=np.int64
+ctypedef np.int64_t LTYPE_t
+FTYPE=np.float64
+ctypedef np.float64_t FTYPE_t
 cdef extern from "math.h":
     double sqrt(double x)
 
-@cython.boundscheck(False)
+include "tr_upper_reach.pxi"
 
+@cython.boundscheck(False)
 #def propagate_qz_errors(np.ndarray[ITYPE_t, ndim=1] indptr, np.ndarray[ITYPE_t, ndim=1] indices, np.ndarray[FTYPE_t, ndim=1] data, np.ndarray[FTYPE_t, ndim=1] E):
 def propagate_qz_errors(R):
     """
@@ -24,32 +27,45 @@ def propagate_qz_errors(R):
     E : (M,) 
         The RSS of Rinv, equal to the per-element error of R.
 
+    Only the rows of each column of Rinv that can be nonzero (those reachable
+    from the column in the graph of R) are calculated.
+
     .. Derived from the spsolve_triangular function in scipy version:: 0.19.0
     """
-    cdef Py_ssize_t i, indptr_start, indptr_stop, col, row
+    cdef Py_ssize_t i, k, top, N, indptr_start, indptr_stop, col
     cdef Py_ssize_t  A_off_diagonal_index_row_i, A_column_index_in_row_i
     cdef FTYPE_t this_x
     # pull apart R and explicitly type the pieces
-    cdef np.ndarray[ITYPE_t, ndim=1] indptr=R.indptr    
-    cdef np.ndarray[ITYPE_t, ndim=1] indices=R.indices
-    cdef np.ndarray[FTYPE_t, ndim=1] data=R.data
+    cdef np.ndarray[ITYPE_t, ndim=1] indptr=np.asarray(R.indptr, dtype=ITYPE)
+    cdef np.ndarray[ITYPE_t, ndim=1] indices=np.asarray(R.indices, dtype=ITYPE)
+    cdef np.ndarray[FTYPE_t, ndim=1] data=np.asarray(R.data, dtype=FTYPE)
+    # the column structure of R, for the reach calculation
+    R_csc=R.tocsc()
+    cdef ITYPE_t[:] Cp=np.asarray(R_csc.indptr, dtype=ITYPE)
+    cdef ITYPE_t[:] Ci=np.asarray(R_csc.indices, dtype=ITYPE)
+    N=R.shape[0]
     # Result matrix
-    cdef np.ndarray[FTYPE_t, ndim=1] E=np.zeros(R.shape[0])
-    # work matrix
-    cdef np.ndarray[FTYPE_t, ndim=1] x=np.zeros(R.shape[0]) 
+    cdef np.ndarray[FTYPE_t, ndim=1] E=np.zeros(N)
+    # work matrices
+    cdef np.ndarray[FTYPE_t, ndim=1] x=np.zeros(N)
+    cdef LTYPE_t[:] mark=np.zeros(N, dtype=LTYPE)-1
+    cdef LTYPE_t[:] stack=np.zeros(N, dtype=LTYPE)
+    cdef LTYPE_t[:] pstack=np.zeros(N, dtype=LTYPE)
+    cdef LTYPE_t[:] xi=np.zeros(N, dtype=LTYPE)
     # loop over the columns of I 
-    for col in range(len(E)-1, -1, -1):
-        # make the current column of I, which will be turned into a column of Rinv
-        for row in range(len(E)):
-            x[row]=0
-        x[col]=1
-        # Fill x iteratively.  All elements of Rinv[:,col] are zero up to 'col'
-        for i in range(col, -1, -1):
+    for col in range(N-1, -1, -1):
+        top=reach(Cp, Ci, col, mark, stack, pstack, xi)
+        # Fill x iteratively.  Entries of x outside the reach are zero
+        for k in range(top, N):
+            i=xi[k]
             # Get indices for i-th row.
             indptr_start = indptr[i]
             indptr_stop = indptr[i+1]
- 
-            this_x=x[i]
+            # the current column of I
+            if i==col:
+                this_x=1
+            else:
+                this_x=0
             # Incorporate off-diagonal entries.
             for A_off_diagonal_index_row_i in range(indptr_start+1, indptr_stop):
                 A_column_index_in_row_i = indices[A_off_diagonal_index_row_i]
@@ -58,12 +74,15 @@ def propagate_qz_errors(R):
                     # so once we find one index that is > 'col', we quit 
                     break
                 this_x -= data[A_off_diagonal_index_row_i]*x[A_column_index_in_row_i]
-                # Apply the diagonal entry
+            # Apply the diagonal entry
             this_x /= data[indptr_start]
             x[i]=this_x
             # add the square of the current value of x to E
             E[i] += this_x*this_x
+        # clear only the entries of x that were used
+        for k in range(top, N):
+            x[xi[k]]=0
     # not sure why np.sqrt[E] doesn't work here, but this sure dones
-    for i in range(len(E)):
+    for i in range(N):
         E[i]=sqrt(E[i])
-    return E
\ No newline at end of file
+    return E
@@ -0,0 +1,137 @@
+from __future__ import division
+cimport cython
+import numpy as np
+cimport numpy as np
+import scipy.sparse as sp
+LTYPE=np.int64
+ctypedef np.int64_t LTYPE_t
+FTYPE=np.float64
+ctypedef np.float64_t FTYPE_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def selected_inverse(R):
+    """
+    Calculate the entries of (R^T R)^-1 on the filled sparsity pattern of R
+
+    Uses the Takahashi recurrence: if Z=(R^T R)^-1, then R Z = R^-T, and the
+    entries of Z in row i depend only on the entries of Z in the rows of R that
+    appear in row i of R.  Working from the last row to the first, only the
+    entries of Z within the (filled) pattern of R are needed.  The pattern of R
+    is first completed with the fill that a Cholesky factorization would
+    produce, so that the recurrence never needs an entry outside it.
+
+    Parameters
+    ----------
+    R : (M, M) sparse matrix
+        A sparse square upper triangular matrix with a nonzero diagonal.
+
+    Returns
+    -------
+    Z : (M, M) scipy.sparse.csr_matrix
+        the upper triangle of (R^T R)^-1, on the filled pattern of R.  The
+        variances are Z.diagonal()
+    """
+    cdef Py_ssize_t N, i, j, k, c, p, q, a, b, nnz, row_start, row_N, capacity
+    cdef FTYPE_t r_ii, z, temp
+
+    R=sp.csr_matrix(R)
+    R.sum_duplicates()
+    cdef np.ndarray[LTYPE_t, ndim=1] R_indptr=R.indptr.astype(LTYPE)
+    cdef np.ndarray[LTYPE_t, ndim=1] R_indices=R.indices.astype(LTYPE)
+    cdef np.ndarray[FTYPE_t, ndim=1] R_data=R.data.astype(FTYPE)
+    N=R.shape[0]
+
+    # symbolic step: the filled pattern of row i is the pattern of R[i,:],
+    # combined with the patterns of its children in the elimination tree.
+    # The diagonal is stored first in each row
+    capacity=2*R_indptr[N]+N
+    cdef np.ndarray[LTYPE_t, ndim=1] U_indptr=np.zeros(N+1, dtype=LTYPE)
+    cdef np.ndarray[LTYPE_t, ndim=1] U_indices=np.zeros(capacity, dtype=LTYPE)
+    cdef np.ndarray[LTYPE_t, ndim=1] mark=np.zeros(N, dtype=LTYPE)-1
+    cdef np.ndarray[LTYPE_t, ndim=1] first_child=np.zeros(N, dtype=LTYPE)-1
+    cdef np.ndarray[LTYPE_t, ndim=1] next_child=np.zeros(N, dtype=LTYPE)-1
+    nnz=0
+    for i in range(N):
+        row_start=nnz
+        # the row can have at most N-i entries
+        if nnz+N-i > capacity:
+            capacity=np.maximum(2*capacity, nnz+N-i)
+            U_indices=np.concatenate([U_indices, np.zeros(capacity-U_indices.shape[0], dtype=LTYPE)])
+        U_indices[nnz]=i
+        mark[i]=i
+        nnz += 1
+        for p in range(R_indptr[i], R_indptr[i+1]):
+            j=R_indices[p]
+            if j > i and mark[j] != i:
+                mark[j]=i
+                U_indices[nnz]=j
+                nnz += 1
+        c=first_child[i]
+        while c >= 0:
+            for p in range(U_indptr[c]+1, U_indptr[c+1]):
+                j=U_indices[p]
+                if mark[j] != i:
+                    mark[j]=i
+                    U_indices[nnz]=j
+                    nnz += 1
+            c=next_child[c]
+        U_indptr[i+1]=nnz
+        # the parent of row i is its first off-diagonal column
+        if nnz > row_start+1:
+            j=N
+            for p in range(row_start+1, nnz):
+                if U_indices[p] < j:
+                    j=U_indices[p]
+            next_child[i]=first_child[j]
+            first_child[j]=i
+    U_indices=U_indices[0:nnz].copy()
+
+    # scatter the values of R onto the filled pattern
+    cdef np.ndarray[FTYPE_t, ndim=1] U_data=np.zeros(nnz, dtype=FTYPE)
+    cdef np.ndarray[LTYPE_t, ndim=1] pos=np.zeros(N, dtype=LTYPE)-1
+    for i in range(N):
+        for p in range(U_indptr[i], U_indptr[i+1]):
+            pos[U_indices[p]]=p
+        for p in range(R_indptr[i], R_indptr[i+1]):
+            if R_indices[p] >= i:
+                U_data[pos[R_indices[p]]] += R_data[p]
+        for p in range(U_indptr[i], U_indptr[i+1]):
+            pos[U_indices[p]]=-1
+
+    # numeric step
+    cdef np.ndarray[FTYPE_t, ndim=1] Z=np.zeros(nnz, dtype=FTYPE)
+    cdef np.ndarray[FTYPE_t, ndim=1] acc=np.zeros(N, dtype=FTYPE)
+    for i in range(N-1, -1, -1):
+        row_start=U_indptr[i]
+        row_N=U_indptr[i+1]-row_start
+        r_ii=U_data[row_start]
+        # local index of each off-diagonal column in the row
+        for a in range(1, row_N):
+            pos[U_indices[row_start+a]]=a
+            acc[a]=0
+        # acc[b] = sum_k R[i,k] Z[k, j_b], for k and j_b in the row.  Each pair
+        # of columns (k <= j) is found once, in row k of Z
+        for a in range(1, row_N):
+            k=U_indices[row_start+a]
+            for q in range(U_indptr[k], U_indptr[k+1]):
+                j=U_indices[q]
+                b=pos[j]
+                if b < 0:
+                    continue
+                z=Z[q]
+                acc[b] += U_data[row_start+a]*z
+                if j != k:
+                    acc[a] += U_data[row_start+b]*z
+        temp=0
+        for a in range(1, row_N):
+            Z[row_start+a] = -acc[a]/r_ii
+            temp += U_data[row_start+a]*Z[row_start+a]
+            pos[U_indices[row_start+a]]=-1
+        Z[row_start]=(1./r_ii - temp)/r_ii
+
+    Zmat=sp.csr_matrix((Z, U_indices, U_indptr), shape=(N, N))
+    Zmat.sort_indices()
+    return Zmat
@@ -6,7 +6,9 @@ Created on Mon Dec  4 15:27:38 2017
 """
 import numpy as np
 import re
+import warnings
 from LSsurf.lin_op import lin_op
+from LSsurf.stencil_op import stencil_op, weighted_linear_operator
 import scipy.sparse as sp
 from LSsurf.data_slope_bias import data_slope_bias
 from LSsurf.setup_sensor_grid_bias import setup_sensor_grid_bias,\
@@ -18,14 +20,18 @@ from LSsurf.RDE import RDE
 import pointCollection as pc
 from scipy.stats import scoreatpercentile
 from LSsurf.inv_tr_upper import inv_tr_upper
+from LSsurf.selected_inverse import selected_inverse
+from LSsurf.spsolve_tr_upper import spsolve_tr_upper
 from LSsurf.bias_functions import assign_bias_ID, setup_bias_fit, parse_biases
 from LSsurf.grid_functions import setup_grids, \
                                     setup_averaging_ops, setup_avg_mask_ops,\
                                     validate_by_dz_mask, setup_mask
+from LSsurf.op_cache import op_cache
 from LSsurf.constraint_functions import setup_smoothness_constraints, \
                                         build_reference_epoch_matrix
 from LSsurf.match_priors import match_prior_dz,  match_tile_edges
 from LSsurf.calc_sigma_extra import calc_sigma_extra, calc_sigma_extra_on_grid
+from LSsurf.solver_functions import fit_system, nuisance_columns
 
 def check_data_against_DEM(in_TSE, data, m0, G_data, DEM_tol):
     m1 = m0.copy()
@@ -97,9 +103,21 @@ def edit_by_bias(data, m0, in_TSE, iteration, bias_model, args):
     return  ~np.all(bias_model['bias_param_dict']['edited'] == last_edit)
 
 def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
-                grids, bias_model=None, sigma_extra_masks=None):
-    cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
-    E_all = 1/TCinv.diagonal()
+                grids, bias_model=None, sigma_extra_masks=None, m0_init=None,
+                constraint_op=None, factorization=None):
+    '''
+    iterate the solution and the editing of the data
+
+    If factorization is a dict, the factor of the weighted system from the
+    final solution, with the data errors augmented by sigma_extra, is stored
+    in it under 'R', 'perm', and 'rows' (see fit_system.R_factor), if the
+    solver provides one.  The normal-equation solvers refactor the system
+    for the new weights, reusing the symbolic analysis, and the 'spqr'
+    solver factors the reweighted normal equations instead of repeating the
+    QR factorization.  For the 'schur' solver, the columns and errors of the
+    nuisance parameters are stored under 'nuisance_sigma' (see
+    fit_system.nuisance_sigma).
+    '''
 
     # run edit_by_bias to zero out the edited IDs
     edit_by_bias(data, np.zeros(Ip_c.shape[0]), in_TSE, -1, bias_model, args)
@@ -114,28 +132,49 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
         N_editable=data.size
 
     sigma_extra=0
-    N_eq = Gcoo.shape[0]
     last_iteration = False
-    m0 = np.zeros(Ip_c.shape[0])
+    min_iterations=args['min_iterations']
+    if m0_init is None:
+        m0 = np.zeros(Ip_c.shape[0])
+    else:
+        # the editing has already been iterated on a coarser grid
+        m0 = m0_init.copy()
+        min_iterations=args['fine_min_iterations']
+    if args['solver_args'] is None:
+        solver_args={}
+    else:
+        solver_args=args['solver_args']
+    nuisance_cols=None
+    if args['solver']=='schur':
+        # bias parameters (everything but the surface grids) are eliminated
+        surface_cols=np.concatenate([G_data.TOC['cols'][key] for key in ['z0', 'dz', 'lagrangian_dz']
+                                     if key in G_data.TOC['cols']])
+        nuisance_cols=nuisance_columns(Ip_c, surface_cols)
+    # weight the system once.  Between iterations, only the selection of data
+    # rows changes, so the solver can keep its ordering and symbolic analysis
+    system=fit_system(Gcoo, rhs, TCinv, G_data.N_eq, solver=args['solver'],
+                      edit_mode=args['edit_mode'], warm_start=args['warm_start'],
+                      max_memory=args['max_solve_memory'],
+                      nuisance_cols=nuisance_cols, constraint_op=constraint_op,
+                      keep_factorization=factorization is not None,
+                      **solver_args)
+    if m0_init is not None:
+        # start the iterative solvers from the initial model
+        system.x_last=Ip_c.T.dot(m0_init)
     for iteration in range(args['max_iterations']):
 
-        # augment the errors on the shelf
-        E2_plus=E_all**2
-        TCinv=sp.dia_matrix((1./np.sqrt(E2_plus),0), shape=(N_eq, N_eq))
-
-        # build the parsing matrix that removes invalid rows
-        Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.sum()), \
-                            (np.arange(Gc.N_eq+in_TSE.sum()), \
-                             np.concatenate((np.flatnonzero(in_TSE), cov_rows)))), \
-                           shape=(Gc.N_eq+in_TSE.sum(), Gcoo.shape[0])).tocsc()
-
         if args['VERBOSE']:
-            print("starting qr solve for iteration %d at %s" % (iteration, ctime()), flush=True)
+            print("starting %s solve for iteration %d at %s" % (args['solver'], iteration, ctime()), flush=True)
         # solve the equations
-        tic=time();
         m0_last=m0
-        m0=Ip_c.dot(sparseqr.solve(Ip_r.dot(TCinv.dot(Gcoo)).tocoo(), Ip_r.dot(TCinv.dot(rhs))))#, tolerance=-2))
-        timing['sparseqr_solve']=time()-tic
+        rtol=None
+        if args['warm_start'] and iteration > 0:
+            # the solution only needs to be accurate to a fraction of the
+            # convergence tolerance, relative to the size of the dz values.
+            # LSMR ignores this, and only uses the warm start (see fit_system.solve)
+            dz_scale=np.maximum(np.max(np.abs(m0_last[Gc.TOC['cols']['dz']])), args['converge_tol_dz'])
+            rtol=args['warm_start_tol_scale']*args['converge_tol_dz']/dz_scale
+        m0=Ip_c.dot(system.solve(in_TSE, timing=timing, rtol=rtol))
 
         # calculate the full data residual
         r_data=data.z-G_data.toCSR().dot(m0)
@@ -167,13 +206,13 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
             in_TSE = check_data_against_DEM(in_TSE, data, m0, G_data, args['DEM_tol'])
 
         # quit if the solution is too similar to the previous solution
-        if (np.max(np.abs((m0_last-m0)[Gc.TOC['cols']['dz']])) < args['converge_tol_dz']) and (iteration > args['min_iterations']):
+        if (np.max(np.abs((m0_last-m0)[Gc.TOC['cols']['dz']])) < args['converge_tol_dz']) and (iteration > min_iterations):
             if args['VERBOSE']:
                 print("Solution identical to previous iteration with tolerance %3.1f, exiting after iteration %d" % (args['converge_tol_dz'], iteration))
             last_iteration = True
         # select the data that are within 3*sigma of the solution
         if args['VERBOSE']:
-            print('found %d in TSE, dt=%3.0f' % ( in_TSE.sum(), timing['sparseqr_solve']), flush=True)
+            print('found %d in TSE, dt=%3.0f' % ( in_TSE.sum(), timing['solve']), flush=True)
             if sigma_extra_masks is None:
                 print(f'\t median(sigma_extra)={np.median(sigma_extra):3.4f}')
             else:
@@ -189,7 +228,7 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
                     print("filtering unchanged with tolerance %3.5f, will exit after iteration %d"
                           % (args['converge_tol_frac_TSE'], iteration+1))
                 last_iteration=True
-        if iteration >= np.maximum(args['min_iterations'], args['bias_nsigma_iteration']+1):
+        if iteration >= np.maximum(min_iterations, args['bias_nsigma_iteration']+1):
             if np.all(sigma_extra < 0.5 * np.min(data.sigma[in_TSE])) and not bias_editing_changed:
                 if args['VERBOSE']:
                     print("sigma_extra is small, performing one additional iteration", flush=True)
@@ -197,28 +236,364 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
         if iteration==args['max_iterations']-2:
             last_iteration=True
 
-    return m0, sigma_extra, in_TSE, rs_data
-
-def calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, avg_ops, bias_model, bias_params, dzdt_lags=None, timing={}, error_res_scale=None):
-    tic=time()
-    # take the QZ transform of Gcoo  # TEST WHETHER rhs can just be a vector of ones
-    z, R, perm, rank=sparseqr.rz(Ip_r.dot(TCinv.dot(Gcoo)), Ip_r.dot(TCinv.dot(rhs)))
-    z=z.ravel()
-    R=R.tocsr()
-    R.sort_indices()
-    R.eliminate_zeros()
-    timing['decompose_qz']=time()-tic
+    if factorization is not None:
+        # the errors are calculated with the data errors augmented by sigma_extra
+        factor=system.R_factor(rows=in_TSE, row_scale=data.sigma/np.sqrt(data.sigma**2+sigma_extra**2))
+        if factor is not None:
+            factorization.update(zip(['R', 'perm', 'rows'], factor))
+            if system.solver=='schur':
+                factorization['nuisance_sigma']=system.nuisance_sigma()
 
-    E0=np.zeros(R.shape[0])
+    return m0, sigma_extra, in_TSE, rs_data
 
+def calc_Rinv(R, perm, timing, n_threads=1):
     # compute Rinv for use in propagating errors.
     # what should the tolerance be?  We will eventually square Rinv and take its
     # row-wise sum.  We care about errors at the cm level, so
     # size(Rinv)*tol^2 = 0.01 -> tol=sqrt(0.01/size(Rinv))~ 1E-4
-    tic=time(); RR, CC, VV, status=inv_tr_upper(R, int(np.prod(R.shape)/4), 1.e-5);
+    tic=time(); RR, CC, VV, status=inv_tr_upper(R, int(np.prod(R.shape)/4), 1.e-5, n_threads);
+    check_Rinv_block(RR, CC, VV, status, 0, R.shape[0])
     # save Rinv as a sparse array.  The syntax perm[RR] undoes the permutation from QZ
     Rinv=sp.coo_matrix((VV, (perm[RR], CC)), shape=R.shape).tocsr(); timing['Rinv_cython']=time()-tic;
-    tic=time(); E0=np.sqrt(Rinv.power(2).sum(axis=1)); timing['propagate_errors']=time()-tic;
+    return Rinv
+
+def check_Rinv_block(RR, CC, VV, status, col_0, col_1):
+    # check that inv_tr_upper returned all of columns col_0 to col_1-1 of Rinv.
+    # Each column has a diagonal entry, 1/R[col, col], so a column without one
+    # was not calculated, and would otherwise add nothing to the variances
+    on_diag=RR==CC
+    complete=status==0 and np.all(np.isfinite(VV)) and \
+        np.all((CC >= col_0) & (CC < col_1)) and \
+        np.array_equal(np.sort(CC[on_diag]), np.arange(col_0, col_1))
+    if not complete:
+        raise RuntimeError(f"inv_tr_upper did not return columns {col_0} to {col_1-1} of Rinv (status={status})")
+
+# record type for the entries of Rinv written by stream_Rinv_errors
+Rinv_dtype=np.dtype([('row', np.int32), ('col', np.int32), ('val', np.float64)])
+
+def stream_Rinv_errors(R, perm, Ip_c, avg_ops, timing, max_memory=None, n_threads=1, Rinv_file=None):
+    '''
+    calculate the parameter and averaging-operator variances from blocks of columns of Rinv
+
+    The variances are sums of squares over the columns of Rinv (or of the
+    averaging operators times Rinv), so they are accumulated one block of
+    columns at a time, and Rinv is never held in memory as a whole.  The
+    number of columns in each block is chosen so that the block takes up
+    roughly max_memory bytes, based on the fraction of the possible entries
+    that were nonzero in the previous block.
+
+    Parameters
+    ----------
+    R : scipy.sparse.csr_matrix
+        upper-triangular factor of the weighted system
+    perm : numpy array
+        column ordering of R
+    Ip_c : scipy.sparse matrix
+        matrix that maps the reduced parameters to the full parameters
+    avg_ops : dict
+        averaging operators (lin_ops) whose errors are calculated
+    timing : dict
+        the time taken is reported in timing['Rinv_stream']
+    max_memory : float, optional
+        approximate memory limit for each block, in bytes.  If None, all the
+        columns are calculated in one block.
+    n_threads : int, optional
+        number of threads used to calculate each block (see inv_tr_upper)
+    Rinv_file : str, optional
+        if specified, the entries of Rinv are written to this file as records
+        of type Rinv_dtype, with rows in the (reduced) parameter order.  The
+        file can be read with np.memmap(Rinv_file, dtype=Rinv_dtype, mode='r')
+
+    Returns
+    -------
+    E0_2 : numpy array
+        variance of each (reduced) parameter
+    avg_var : dict
+        variance of each row of each averaging operator
+
+    Raises
+    ------
+    RuntimeError
+        if inv_tr_upper reports an error, or does not return every column of
+        a block, so that a failed block cannot leave zeros in the variances
+    '''
+    tic=time()
+    N=R.shape[0]
+    E0_2=np.zeros(N)
+    avg_var={key:np.zeros(0) for key in avg_ops}
+    # bytes for each entry of a block, including the copies made to use it
+    entry_bytes=64
+    if max_memory is None:
+        max_nnz=np.prod(R.shape)/4
+    else:
+        # a block contains at least one full column
+        max_nnz=np.maximum(max_memory/entry_bytes, N)
+    # largest possible number of entries in columns 0 to col
+    max_entries=np.cumsum(np.arange(1, N+1, dtype=float))
+    fill=1.
+    fh=None
+    if Rinv_file is not None:
+        fh=open(Rinv_file, 'wb')
+    try:
+        col_0=0
+        while col_0 < N:
+            base=max_entries[col_0-1] if col_0 > 0 else 0.
+            if max_memory is None:
+                col_1=N
+            else:
+                col_1=int(np.clip(np.searchsorted(max_entries, base+max_nnz/fill, side='right'), col_0+1, N))
+            RR, CC, VV, status = inv_tr_upper(R, int(max_nnz), 1.e-5, n_threads,
+                                              first_col=col_0, last_col=col_1)
+            check_Rinv_block(RR, CC, VV, status, col_0, col_1)
+            # perm[RR] undoes the permutation from QZ
+            rows=perm[RR]
+            E0_2 += np.bincount(rows, weights=VV**2, minlength=N)
+            if len(avg_ops) > 0:
+                block=Ip_c.dot(sp.coo_matrix((VV, (rows, CC-col_0)), shape=(N, col_1-col_0)).tocsr())
+                for key, op in avg_ops.items():
+                    if avg_var[key].size==0:
+                        avg_var[key]=op.error_variance(block)
+                    else:
+                        avg_var[key] += op.error_variance(block)
+            if fh is not None:
+                records=np.zeros(VV.size, dtype=Rinv_dtype)
+                records['row']=rows
+                records['col']=CC
+                records['val']=VV
+                records.tofile(fh)
+            # fraction of the possible entries that were nonzero, with a margin
+            fill=np.clip(1.25*VV.size/(max_entries[col_1-1]-base), 1./N, 1.)
+            col_0=col_1
+    finally:
+        if fh is not None:
+            fh.close()
+    timing['Rinv_stream']=time()-tic
+    return E0_2, avg_var
+
+def color_columns(R, seed=0):
+    '''
+    color the columns of R so that no two columns that share a row of R
+    (i.e. that are coupled in R^T R) have the same color
+
+    The columns are colored in vectorized rounds: in each round, every
+    uncolored column tries the smallest color that none of its colored
+    neighbors has, and keeps it unless an uncolored neighbor with a higher
+    (random) priority tries the same color.
+    '''
+    A=abs(R)
+    A=(A.T.dot(A)).tocsr()
+    A.setdiag(0)
+    A.eliminate_zeros()
+    N=A.shape[0]
+    # the neighbors of each column are the entries of its row of A
+    rows=np.repeat(np.arange(N), np.diff(A.indptr))
+    cols=A.indices
+    priority=np.random.default_rng(seed).permutation(N)
+    colors=np.zeros(N, dtype=int)-1
+    while np.any(colors < 0):
+        # only the rows of the uncolored columns are needed
+        keep=colors[rows] < 0
+        rows, cols = rows[keep], cols[keep]
+        uncolored=colors < 0
+        # the sorted, unique colors of the colored neighbors of each uncolored column
+        these=np.flatnonzero(colors[cols] >= 0)
+        key=np.unique(rows[these].astype(np.int64)*N + colors[cols[these]])
+        node, color = key//N, key % N
+        # each column tries the first color that is missing from its list, or
+        # the number of colors in its list if none is missing
+        first=np.flatnonzero(np.r_[True, node[1:] != node[:-1]])
+        rank=np.arange(node.size)-np.repeat(first, np.diff(np.r_[first, node.size]))
+        trial=np.bincount(node, minlength=N)
+        gap=np.flatnonzero(color != rank)
+        gap_node, ind=np.unique(node[gap], return_index=True)
+        trial[gap_node]=rank[gap[ind]]
+        # a trial color is kept unless an uncolored neighbor with a higher
+        # priority is trying the same color
+        conflict=uncolored[cols] & (trial[rows]==trial[cols]) & (priority[cols] > priority[rows])
+        keep=uncolored.copy()
+        keep[rows[conflict]]=False
+        colors[keep]=trial[keep]
+    return colors
+
+def estimate_Rinv_probes(R, perm, timing, Ip_c=None, avg_ops=None, n_probes=16,
+                         probe_type='random', rtol=None, max_probes=None, seed=0):
+    '''
+    estimate the row-wise sums of squares of Rinv from probe vectors
+
+    For a random vector w with independent +/-1 entries, the expected value
+    of (Rinv w)_i^2 is the sum of the squares of row i of Rinv, so the
+    variances of the parameters can be estimated from a set of solutions of
+    R x = w, without calculating Rinv.  The variance of one sample is
+    2*(C_ii^2 - sum_j Rinv_ij^4) <= 2*C_ii^2, where C_ii is the variance of
+    parameter i, so after n sets of probes the relative standard error of
+    the estimate of sigma_i is at most sqrt(1/(2n)): about 18% for 16
+    probes, and 10% for 50.  The errors are largest for parameters that are
+    strongly correlated with many others.  The variances of the rows of
+    the averaging operators are estimated from the same solutions.
+
+    probe_type selects the probe vectors:
+        'random' : n_probes vectors of random signs
+        'colored' : for each of n_probes sets of random signs, one vector
+                    for each color of a coloring of the columns of R (see
+                    color_columns), containing the signs of the columns of that
+                    color.  The errors from the largest correlations are
+                    removed, at a cost of one solve per color per set.
+
+    If rtol is specified, sets of n_probes probes are added until the
+    largest estimated relative standard error of sigma is less than rtol,
+    or until max_probes sets have been used.  The default for max_probes
+    is the number of sets for which the bound above equals rtol.  A
+    RuntimeWarning is issued if the estimated error is still larger than
+    rtol.
+
+    Returns
+    -------
+    E0_2 : numpy array
+        estimated variance of each parameter
+    E0_2_var : numpy array
+        variance of the estimates in E0_2 (NaN if only one set of probes is used)
+    avg_var : dict
+        estimated variance of each row of each averaging operator
+    '''
+    tic=time()
+    rng=np.random.default_rng(seed)
+    N=R.shape[0]
+    if avg_ops is None:
+        avg_ops={}
+    if Ip_c is None:
+        Ip_c=sp.eye(N, format='csr')
+    if probe_type=='colored':
+        colors=color_columns(R)
+        N_colors=colors.max()+1
+    elif probe_type=='random':
+        colors=np.zeros(N, dtype=int)
+        N_colors=1
+    else:
+        raise ValueError(f"probe_type={probe_type} not understood, options are: ['random', 'colored']")
+    if rtol is not None and max_probes is None:
+        max_probes=int(np.ceil(1./(2*rtol**2)))
+    if rtol is None or max_probes < n_probes:
+        max_probes=n_probes
+    # sums of the samples of the sums of squares, and of their squares
+    sum_E0_2=np.zeros(N)
+    sum_E0_2_sq=np.zeros(N)
+    avg_var={key:0. for key in avg_ops}
+    X=np.zeros((N, N_colors))
+    count=0
+    while count < max_probes:
+        for probe in range(np.minimum(n_probes, max_probes-count)):
+            signs=rng.choice([-1., 1.], size=N)
+            for color in range(N_colors):
+                # the rows of R correspond to the permuted parameters
+                X[perm, color]=spsolve_tr_upper(R, signs*(colors==color))
+            # each set of probes gives one sample of the sums of squares
+            sample=np.sum(X**2, axis=1)
+            sum_E0_2 += sample
+            sum_E0_2_sq += sample**2
+            if len(avg_ops) > 0:
+                block=sp.csr_matrix(Ip_c.dot(X))
+                for key, op in avg_ops.items():
+                    avg_var[key] = avg_var[key] + op.error_variance(block)
+            count += 1
+        E0_2=sum_E0_2/count
+        if count > 1:
+            E0_2_var=np.maximum(sum_E0_2_sq/count-E0_2**2, 0)*count/(count-1)/count
+        else:
+            E0_2_var=np.zeros(N)+np.NaN
+        if rtol is None or count < 2:
+            break
+        # relative standard error of the estimates of sigma
+        nonzero=E0_2 > 0
+        rse=np.max(np.sqrt(E0_2_var[nonzero])/(2*E0_2[nonzero]), initial=0)
+        if rse < rtol:
+            break
+    if rtol is not None and count > 1 and rse >= rtol:
+        warnings.warn(f"estimate_Rinv_probes: the largest relative error in sigma is {rse:.3g} "+\
+                      f"after {count} sets of probes, more than rtol={rtol}", RuntimeWarning)
+    avg_var={key:val/count for key, val in avg_var.items()}
+    timing['Rinv_probes']=time()-tic
+    return E0_2, E0_2_var, avg_var
+
+def calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, avg_ops, bias_model, bias_params, dzdt_lags=None, timing={}, error_res_scale=None, method='full', n_threads=1, n_probes=16, probe_type='random', probe_rtol=None, max_probes=None, factorization=None, max_memory=None, Rinv_file=None):
+    '''
+    calculate the formal errors in the model parameters
+
+    method selects how the parameter variances are calculated:
+        'full' : the inverse of R is calculated with inv_tr_upper, and
+                 its rows are squared and summed
+        'selected' : only the entries of (R^T R)^-1 on the pattern of R are
+                 calculated (see selected_inverse).  The averaging-operator
+                 errors are calculated by solving R^T y = a for each row a of
+                 each operator (see lin_op.error_variance_from_R), so the
+                 inverse of R is never calculated.
+        'estimate' : the variances and the averaging-operator errors are
+                 estimated from sets of n_probes probe vectors of type
+                 probe_type, until the relative error of the estimates is
+                 less than probe_rtol, or max_probes sets have been used
+                 (see estimate_Rinv_probes).  The variance of the estimate of
+                 each sigma is reported in the sigma_z0_estimator_var and
+                 sigma_dz_estimator_var fields.
+    n_threads sets the number of threads used to calculate the inverse of R.
+    If factorization contains the factor of the same weighted system (see
+    iterate_fit), it is used instead of a new QR factorization.  If it also
+    contains 'nuisance_sigma' (from the 'schur' solver), the factor only
+    gives the errors of the surface parameters, and the errors of the
+    nuisance parameters (e.g. the biases) are taken from nuisance_sigma.
+    If max_memory or Rinv_file is specified, Rinv (for method='full') is
+    calculated in blocks of columns of about max_memory bytes, and the
+    variances are accumulated block by block (see stream_Rinv_errors).  If
+    Rinv_file is specified, the entries of Rinv are saved to it.
+    '''
+    if factorization is not None and 'R' in factorization:
+        R, perm = factorization['R'], factorization['perm']
+    else:
+        tic=time()
+        # take the QZ transform of Gcoo  # TEST WHETHER rhs can just be a vector of ones
+        z, R, perm, rank=sparseqr.rz(Ip_r.dot(TCinv.dot(Gcoo)), Ip_r.dot(TCinv.dot(rhs)))
+        z=z.ravel()
+        R=R.tocsr()
+        R.sort_indices()
+        R.eliminate_zeros()
+        timing['decompose_qz']=time()-tic
+
+    E0=np.zeros(R.shape[0])
+
+    Rinv=None
+    E0_var=None
+    avg_var=None
+    stream = max_memory is not None or Rinv_file is not None
+    if method=='estimate':
+        E0_2, E0_2_var, avg_var = estimate_Rinv_probes(R, perm, timing, Ip_c=Ip_c, avg_ops=avg_ops,
+                                                       n_probes=n_probes, probe_type=probe_type,
+                                                       rtol=probe_rtol, max_probes=max_probes)
+        E0=np.sqrt(E0_2)
+        # variance of the estimate of E0, from that of E0^2.  Parameters whose
+        # estimated variance is zero (e.g. parameters that no probe reaches)
+        # have a zero estimator variance
+        E0_var=np.divide(E0_2_var, 4*E0_2, out=np.zeros_like(E0_2), where=E0_2 > 0)
+    elif method=='selected':
+        tic=time()
+        # the rows and columns of (R^T R)^-1 correspond to the permuted parameters
+        E0[perm]=np.sqrt(selected_inverse(R).diagonal())
+        timing['selected_inverse']=time()-tic
+        tic=time()
+        avg_var={key:op.error_variance_from_R(R, perm, Ip_c=Ip_c) for key, op in avg_ops.items()}
+        timing['avg_op_errors']=time()-tic
+    elif not stream:
+        Rinv=calc_Rinv(R, perm, timing, n_threads=n_threads)
+        tic=time(); E0=np.sqrt(Rinv.power(2).sum(axis=1)); timing['propagate_errors']=time()-tic;
+    else:
+        E0_2, avg_var = stream_Rinv_errors(R, perm, Ip_c, avg_ops, timing, max_memory=max_memory,
+                                           n_threads=n_threads, Rinv_file=Rinv_file)
+        E0=np.sqrt(E0_2)
+
+    if factorization is not None and 'nuisance_sigma' in factorization:
+        # the nuisance-parameter errors found by back-substitution
+        nuisance_cols, nuisance_sigma = factorization['nuisance_sigma']
+        E0=np.array(E0).ravel()
+        E0[nuisance_cols]=nuisance_sigma
+        if E0_var is not None:
+            E0_var[nuisance_cols]=0.
 
     # generate the full E vector.  E0 appears to be an ndarray,
     E0=np.array(Ip_c.dot(E0)).ravel()
@@ -229,13 +604,21 @@ def calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, av
                                      'y':grids['dz'].ctrs[0],\
                                     'time':grids['dz'].ctrs[2],\
                                     'sigma_dz': np.reshape(E0[Gc.TOC['cols']['dz']], grids['dz'].shape)})
+    if E0_var is not None:
+        E0_var=np.array(Ip_c.dot(E0_var)).ravel()
+        E['sigma_z0'].assign({'sigma_z0_estimator_var':np.reshape(E0_var[Gc.TOC['cols']['z0']], grids['z0'].shape)})
+        E['sigma_dz'].assign({'sigma_dz_estimator_var':np.reshape(E0_var[Gc.TOC['cols']['dz']], grids['dz'].shape)})
 
     # generate the lagged dz errors: [CHECK THIS]
     for key, op in avg_ops.items():
+        if avg_var is not None:
+            sigma=op.grid_error_from_variance(avg_var[key])
+        else:
+            sigma=op.grid_error(Ip_c.dot(Rinv))
         E['sigma_'+key] = pc.grid.data().from_dict({'x':op.dst_grid.ctrs[1], \
                                           'y':op.dst_grid.ctrs[0], \
                                         'time': op.dst_grid.ctrs[2], \
-                                            'sigma_'+key: op.grid_error(Ip_c.dot(Rinv))})
+                                            'sigma_'+key: sigma})
 
     # generate the grid-mean error for zero lag
     if len(bias_model.keys()) >0:
@@ -290,10 +673,13 @@ def parse_model(m, m0, data, R, RMS, G_data, averaging_ops, Gc, Ec, grids, bias_
     # parse the resduals to assess the contributions of the total error:
     # Make the C matrix for the constraints
     TCinv_cov=sp.dia_matrix((1./Ec, 0), shape=(Gc.N_eq, Gc.N_eq))
-    # scaled residuals
-    rc=TCinv_cov.dot(Gc.toCSR().dot(m0))
     # unscaled residuals
-    ru=Gc.toCSR().dot(m0)
+    if isinstance(Gc, stencil_op):
+        ru=Gc.matvec(m0)
+    else:
+        ru=Gc.toCSR().dot(m0)
+    # scaled residuals
+    rc=TCinv_cov.dot(ru)
     for eq_type in ['d2z_dt2','grad2_z0','grad2_dzdt','grad2_PS']:
         if eq_type in Gc.TOC['rows']:
             R[eq_type]=np.sum(rc[Gc.TOC['rows'][eq_type]]**2)
@@ -316,6 +702,139 @@ def parse_model(m, m0, data, R, RMS, G_data, averaging_ops, Gc, Ec, grids, bias_
             m[ff].assign({'misfit_notide_scaled_rms':np.sqrt(G_data.toCSR()[:,G_data.TOC['cols'][ff]][data.three_sigma_edit,:].T.dot(r_notide_scaled**2)\
                                         .reshape(grids[ff].shape)/m[ff].count)})
 
+def coarse_initial_model(data, in_TSE, grids, N_cols, args):
+    '''
+    Solve the fit on coarser grids to initialize the model and the editing
+
+    The problem is solved with the z0 and dz spacings (but not the time
+    spacing) multiplied by args['coarse_scale'], and the coarse z0 and dz
+    grids are interpolated to the nodes of the fine grids.
+
+    Parameters
+    ----------
+    data : pointCollection.data
+        data for the fine fit
+    in_TSE : numpy array
+        boolean array, True for data that are initially selected
+    grids : dict
+        fd_grid objects for the fine fit
+    N_cols : int
+        number of columns in the fine model vector
+    args : dict
+        arguments for the fine fit
+
+    Returns
+    -------
+    m0 : numpy array
+        initial model vector for the fine fit.  Parameters other than z0 and dz are zero.
+    in_TSE : numpy array
+        boolean array, True for data selected by the coarse fit
+    '''
+    coarse_args=args.copy()
+    coarse_args['spacing']={key: val*args['coarse_scale'] if key != 'dt' else val
+                            for key, val in args['spacing'].items()}
+    coarse_args.update({'coarse_scale':None, 'compute_E':False, 'mask_update_function':None})
+    if args['sigma_extra_masks'] is not None:
+        # the masks have already been subset to the fine-fit data
+        coarse_args['sigma_extra_masks']={key:val.copy() for key, val in args['sigma_extra_masks'].items()}
+    coarse_data=data.copy()
+    coarse_data.assign({'three_sigma_edit':in_TSE.copy(), 'fine_index':np.arange(data.size)})
+    coarse_args['data']=coarse_data
+    if args['VERBOSE']:
+        print(f"smooth_fit: solving for the initial model with spacing {coarse_args['spacing']}", flush=True)
+    coarse=smooth_fit(**coarse_args)
+
+    m0=np.zeros(N_cols)
+    if coarse['data'] is None or 'all' not in coarse['m']:
+        return m0, in_TSE
+    # prolong the coarse model onto the nodes of the fine grids
+    for key in ['z0', 'dz']:
+        nodes=np.meshgrid(*grids[key].ctrs, indexing='ij')
+        P=lin_op(coarse['grids'][key]).interp_mtx(nodes, bounds_error=False)
+        m0[grids[key].col_0:grids[key].col_0+grids[key].N_nodes] = \
+            P.toCSR(col_N=coarse['m']['all'].size, row_N=grids[key].N_nodes).dot(coarse['m']['all'])
+
+    # use the coarse editing for the data in the coarse fit
+    in_TSE=in_TSE.copy()
+    in_TSE_coarse=in_TSE.copy()
+    in_TSE_coarse[coarse['data'].fine_index]=coarse['data'].three_sigma_edit
+    if 'editable' in data.fields:
+        in_TSE[data.editable != 0]=in_TSE_coarse[data.editable != 0]
+    else:
+        in_TSE=in_TSE_coarse
+    return m0, in_TSE
+
+def coarse_errors(E, data, grids, avg_ops, args):
+    '''
+    Calculate the errors on coarser grids
+
+    The error calculation is repeated with the z0 and dz spacings (but not
+    the time spacing) multiplied by args['error_res_scale'], using the data
+    editing and sigma_extra values from the fine fit.  The constraint
+    weights are normalized by the cell areas (see setup_smoothness_constraints),
+    so they are consistent between the two resolutions.
+
+    The coarse sigma_z0 and sigma_dz maps are interpolated to the nodes of
+    the fit grids, and are returned in E['sigma_z0'] and E['sigma_dz'].  A
+    coarse node is better determined than a fine node, and there is no
+    simple scaling between the two, so the interpolated maps are not scaled:
+    they are the errors of the coarse model, sampled at the fine nodes.  The
+    coarse-node maps (and those of averaging operators whose output grids
+    have the dz spacing) are also returned, with '_coarse' appended to their
+    keys.  The errors of averaging operators with coarser output grids, and
+    of the biases, do not depend on the node spacing and keep their keys.
+
+    Parameters
+    ----------
+    E : dict
+        the errors are added to this dict
+    data : pointCollection.data
+        data for the fine fit, with three_sigma_edit and sigma_extra fields
+    grids : dict
+        fd_grid objects for the fine fit
+    avg_ops : dict
+        averaging operators for the fine fit
+    args : dict
+        arguments for the fine fit
+    '''
+    scale=args['error_res_scale']
+    coarse_args=args.copy()
+    coarse_args['spacing']={key: val*scale if key != 'dt' else val
+                            for key, val in args['spacing'].items()}
+    # the editing is taken from the fine fit, so no iterations are needed
+    coarse_args.update({'error_res_scale':None, 'coarse_scale':None, 'max_iterations':0,
+                        'mask_update_function':None})
+    if args['sigma_extra_masks'] is not None:
+        coarse_args['sigma_extra_masks']={key:val.copy() for key, val in args['sigma_extra_masks'].items()}
+    coarse_args['data']=data.copy()
+    if args['VERBOSE']:
+        print(f"smooth_fit: calculating errors with spacing {coarse_args['spacing']}", flush=True)
+    coarse=smooth_fit(**coarse_args)
+
+    node_keys=['sigma_z0', 'sigma_dz']
+    for key, op in avg_ops.items():
+        if np.allclose(op.dst_grid.delta[0:2], grids['dz'].delta[0:2]):
+            node_keys += ['sigma_'+key]
+    for key, E_c in coarse['E'].items():
+        if key in node_keys:
+            E[key+'_coarse']=E_c
+        else:
+            E[key]=E_c
+    # interpolate the coarse node errors to the nodes of the fit grids
+    for key in ['z0', 'dz']:
+        field='sigma_'+key
+        if field not in coarse['E']:
+            continue
+        grid_c=coarse['grids'][key]
+        nodes=np.meshgrid(*grids[key].ctrs, indexing='ij')
+        P=lin_op(grid_c).interp_mtx(nodes, bounds_error=False)
+        P=P.toCSR(col_N=grid_c.col_0+grid_c.N_nodes, row_N=grids[key].N_nodes)[:, grid_c.col_0:]
+        out={'x':grids[key].ctrs[1], 'y':grids[key].ctrs[0]}
+        if key=='dz':
+            out['time']=grids[key].ctrs[2]
+        out[field]=np.reshape(P.dot(np.asarray(getattr(coarse['E'][field], field)).ravel()), grids[key].shape)
+        E[field]=pc.grid.data().from_dict(out)
+
 def smooth_fit(**kwargs):
     required_fields=('data','W','ctr','spacing','E_RMS')
     args={'reference_epoch':0,
@@ -325,8 +844,28 @@ def smooth_fit(**kwargs):
     'mask_update_function':None,
     'mask_scale':None,
     'compute_E':False,
+    'n_threads':1,
+    'E_probes':16,
+    'E_probe_type':'random',
+    'E_probe_rtol':0.1,
+    'E_max_probes':48,
+    'E_max_memory':None,
+    'E_Rinv_file':None,
+    'solver':'spqr',
+    'solver_args':None,
+    'edit_mode':'select',
+    'warm_start':False,
+    'warm_start_tol_scale':0.001,
+    'max_solve_memory':None,
+    'matrix_free':False,
+    'data_op_float32':False,
+    'interp_chunk_size':None,
+    'op_cache_dir':None,
+    'op_cache_max_bytes':None,
     'max_iterations':10,
     'min_iterations':2,
+    'coarse_scale':None,
+    'fine_min_iterations':0,
     'sigma_extra_bin_spacing':None,
     'sigma_extra_max':None,
     'sigma_extra_keys':None,
@@ -418,11 +957,15 @@ def smooth_fit(**kwargs):
         return {'m':m, 'E':E, 'data':data, 'grids':grids, 'valid_data': valid_data, 'TOC':{},'R':{}, 'RMS':{}, 'timing':timing,'E_RMS':args['E_RMS']}
 
     # define the interpolation operator, equal to the sum of the dz and z0 operators
-    G_data=lin_op(grids['z0'], name='interp_z').interp_mtx(data.coords()[0:2])
-    G_data.add(lin_op(grids['dz'], name='interp_dz').interp_mtx(data.coords()))
+    # optionally, its values are stored in single precision, and the data are
+    # processed in chunks of interp_chunk_size points
+    v_dtype=np.float32 if args['data_op_float32'] else None
+    interp_args={'chunk_size':args['interp_chunk_size'], 'n_threads':args['n_threads']}
+    G_data=lin_op(grids['z0'], name='interp_z', v_dtype=v_dtype).interp_mtx(data.coords()[0:2], **interp_args)
+    G_data.add(lin_op(grids['dz'], name='interp_dz', v_dtype=v_dtype).interp_mtx(data.coords(), **interp_args))
     if args['lagrangian_coords'] is not None:
-        G_data.add(lin_op(grids['lagrangian_dz'], name='interp_lagrangian_dz').interp_mtx(
-            [getattr(data, field) for field in args['lagrangian_coords']], bounds_error=False))
+        G_data.add(lin_op(grids['lagrangian_dz'], name='interp_lagrangian_dz', v_dtype=v_dtype).interp_mtx(
+            [getattr(data, field) for field in args['lagrangian_coords']], bounds_error=False, **interp_args))
 
     if args['constraint_scaling_maps'] is None:
         constraint_scaling_masks=None
@@ -438,10 +981,15 @@ def smooth_fit(**kwargs):
 
     # define the smoothness constraints
     constraint_op_list=[]
+    constraint_op_cache=None
+    if args['op_cache_dir'] is not None:
+        constraint_op_cache=op_cache(args['op_cache_dir'], max_bytes=args['op_cache_max_bytes'])
     print(f"smooth_fit: E_RMS={args['E_RMS']}")
     setup_smoothness_constraints(grids, constraint_op_list, args['E_RMS'],
                                  args['mask_scale'],
-                                 scaling_masks = constraint_scaling_masks)
+                                 scaling_masks = constraint_scaling_masks,
+                                 matrix_free=args['matrix_free'],
+                                 op_cache=constraint_op_cache)
 
     ### NB: NEED TO MAKE THIS WORK WITH SETUP_GRID_BIAS
     #if args['E_RMS_d2x_PS_bias'] is not None:
@@ -543,7 +1091,12 @@ def smooth_fit(**kwargs):
             op.prior=np.zeros_like(op.expected)
 
     # put the equations together
-    Gc = lin_op(None, name='constraints').vstack(constraint_op_list)
+    if args['matrix_free']:
+        if args['solver'] != 'lsmr':
+            raise ValueError("matrix_free requires the lsmr solver")
+        Gc = stencil_op(None, name='constraints').vstack(constraint_op_list)
+    else:
+        Gc = lin_op(None, name='constraints').vstack(constraint_op_list)
 
     N_eq=G_data.N_eq+Gc.N_eq
 
@@ -574,14 +1127,21 @@ def smooth_fit(**kwargs):
     rhs[0:data.size]=data.z.ravel()
     rhs[data.size:]=np.concatenate([op.prior for op in constraint_op_list])
 
-    # put the fit and constraint matrices together
-    Gcoo=sp.vstack([G_data.toCSR(), Gc.toCSR()]).tocoo()
-
     # define the matrix that sets dz[reference_epoch]=0 by removing columns from the solution:
     Ip_c = build_reference_epoch_matrix(G_data, Gc, grids, args['reference_epoch'])
 
-    # eliminate the columns for the model variables that are set to zero
-    Gcoo=Gcoo.dot(Ip_c)
+    constraint_op=None
+    if args['matrix_free']:
+        # only the data equations are built as a matrix.  The constraints
+        # are applied by the solver without building their matrix
+        Gcoo=G_data.toCSR().dot(Ip_c).tocoo()
+        constraint_op=weighted_linear_operator(Gc, row_weight=1./Ec, Ip_c=Ip_c)
+    else:
+        # put the fit and constraint matrices together
+        Gcoo=sp.vstack([G_data.toCSR(), Gc.toCSR()]).tocoo()
+
+        # eliminate the columns for the model variables that are set to zero
+        Gcoo=Gcoo.dot(Ip_c)
     timing['setup']=time()-tic
 
     # initialize the book-keeping matrices for the inversion
@@ -593,6 +1153,18 @@ def smooth_fit(**kwargs):
     if args['VERBOSE']:
         print("initial: %d:" % G_data.r.max(), flush=True)
 
+    # if coarse_scale is specified, initialize the model and the editing with a coarse-grid solution
+    m0_init=None
+    if args['coarse_scale'] is not None and args['max_iterations'] > 0:
+        tic_coarse=time()
+        m0_init, in_TSE = coarse_initial_model(data, in_TSE, grids, Ip_c.shape[0], args)
+        timing['coarse']=time()-tic_coarse
+
+    # if errors are requested, keep the factorization of the final solution
+    factorization=None
+    if args['compute_E']:
+        factorization={}
+
     # if we've done any iterations, parse the model and the data residuals
     if args['max_iterations'] > 0:
         tic_iteration=time()
@@ -600,7 +1172,9 @@ def smooth_fit(**kwargs):
                                 TCinv, G_data, Gc, in_TSE, Ip_c, timing,
                                 args, grids,\
                                 bias_model=bias_model, \
-                                sigma_extra_masks=args['sigma_extra_masks'])
+                                sigma_extra_masks=args['sigma_extra_masks'],
+                                m0_init=m0_init, constraint_op=constraint_op,
+                                factorization=factorization)
 
         timing['iteration']=time()-tic_iteration
         valid_data[valid_data]=in_TSE
@@ -634,29 +1208,60 @@ def smooth_fit(**kwargs):
 
     # Compute the error in the solution if requested
     if args['compute_E']:
+        # compute_E=True uses the full inverse of R, or compute_E can name a method
+        if args['compute_E'] is True:
+            E_method='full'
+        else:
+            E_method=args['compute_E']
+        if E_method not in ['full', 'selected', 'estimate']:
+            raise ValueError(f"compute_E={E_method} not understood, options are: [True, 'full', 'selected', 'estimate']")
         # if sigma_extra is not a data field, assume it is zero
         if not 'sigma_extra' in data.fields:
             data.assign({'sigma_extra': np.zeros_like(data.sigma)})
             r_data=data.z_est[data.three_sigma_edit==1]-data.z[data.three_sigma_edit==1]
             data.sigma_extra[data.three_sigma_edit==1] = calc_sigma_extra(r_data, data.sigma[data.three_sigma_edit==1])
 
-        # rebuild TCinv to take into account the extra error
-        TCinv=sp.dia_matrix((1./np.concatenate((np.sqrt(Ed**2+data.sigma_extra**2), Ec)), 0), shape=(N_eq, N_eq))
-
-        # We have generally not done any iterations at this point, so need to make the Ip_r matrix
-        cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
-        Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.sum()), \
-                           (np.arange(Gc.N_eq+in_TSE.sum()), \
-                            np.concatenate((np.flatnonzero(in_TSE), cov_rows)))), \
-                           shape=(Gc.N_eq+in_TSE.sum(), Gcoo.shape[0])).tocsc()
-        if args['VERBOSE']:
-            print("Starting uncertainty calculation", flush=True)
+        if args['error_res_scale'] is not None and args['error_res_scale'] != 1:
+            # calculate the errors on coarser grids, and interpolate the node errors
+            # to the fit grids
+            if args['VERBOSE']:
+                print("Starting uncertainty calculation", flush=True)
             tic_error=time()
-        calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, averaging_ops, \
-                         bias_model, args['bias_params'], dzdt_lags=args['dzdt_lags'], timing=timing, \
-                             error_res_scale=args['error_res_scale'])
-        if args['VERBOSE']:
-            print("\tUncertainty propagation took %3.2f seconds" % (time()-tic_error), flush=True)
+            coarse_errors(E, data, grids, averaging_ops, args)
+            timing['coarse_errors']=time()-tic_error
+            if args['VERBOSE']:
+                print("\tUncertainty propagation took %3.2f seconds" % (time()-tic_error), flush=True)
+        else:
+            if args['matrix_free']:
+                # the error calculation needs the constraint matrix
+                Gcoo=sp.vstack([Gcoo, Gc.toCSR(row_N=Gc.N_eq, col_N=G_data.col_N).dot(Ip_c)]).tocoo()
+
+            # the factorization from iterate_fit can only be reused if it
+            # includes the same data rows
+            if 'R' in factorization and not np.array_equal(factorization['rows'], in_TSE):
+                factorization={}
+
+            # rebuild TCinv to take into account the extra error
+            TCinv=sp.dia_matrix((1./np.concatenate((np.sqrt(Ed**2+data.sigma_extra**2), Ec)), 0), shape=(N_eq, N_eq))
+
+            # We have generally not done any iterations at this point, so need to make the Ip_r matrix
+            cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
+            Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.sum()), \
+                               (np.arange(Gc.N_eq+in_TSE.sum()), \
+                                np.concatenate((np.flatnonzero(in_TSE), cov_rows)))), \
+                               shape=(Gc.N_eq+in_TSE.sum(), Gcoo.shape[0])).tocsc()
+            if args['VERBOSE']:
+                print("Starting uncertainty calculation", flush=True)
+                tic_error=time()
+            calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, averaging_ops, \
+                             bias_model, args['bias_params'], dzdt_lags=args['dzdt_lags'], timing=timing, \
+                                 error_res_scale=args['error_res_scale'], method=E_method,
+                                 n_threads=args['n_threads'], n_probes=args['E_probes'],
+                                 probe_type=args['E_probe_type'], probe_rtol=args['E_probe_rtol'],
+                                 max_probes=args['E_max_probes'], factorization=factorization,
+                                 max_memory=args['E_max_memory'], Rinv_file=args['E_Rinv_file'])
+            if args['VERBOSE']:
+                print("\tUncertainty propagation took %3.2f seconds" % (time()-tic_error), flush=True)
 
     TOC=Gc.TOC
     return {'m':m, 'E':E, 'data':data, 'grids':grids, 'valid_data': valid_data, \
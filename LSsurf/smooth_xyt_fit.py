@@ -235,7 +235,7 @@ def parse_model(m, m0, G_data, G_dzbar, TOC, grids, bias_params, bias_model, dzd
     # reshape the components of m to the grid shapes
     m['z0']=np.reshape(m0[TOC['cols']['z0']], grids['z0'].shape)
     m['dz']=np.reshape(m0[TOC['cols']['dz']], grids['dz'].shape)
-    m['count']=np.reshape(np.array(G_data.toCSR().tocsc()[:,TOC['cols']['dz']].sum(axis=0)), grids['dz'].shape)
+    m['count']=np.reshape(np.array(G_data.toCSC()[:,TOC['cols']['dz']].sum(axis=0)), grids['dz'].shape)
     
     # calculate height rates
     for lag in dzdt_lags:
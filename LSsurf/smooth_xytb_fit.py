@@ -13,7 +13,7 @@ import copy
 from LSsurf.fd_grid import fd_grid
 from LSsurf.lin_op import lin_op
 import sparseqr
-from time import time, ctime, sleep
+from time import time, ctime
 from LSsurf.RDE import RDE
 import pointCollection as pc
 from LSsurf.inv_tr_upper import inv_tr_upper
@@ -24,6 +24,7 @@ from LSsurf.grid_functions import setup_grids, \
 from LSsurf.setup_grid_bias import setup_grid_bias
 from LSsurf.constraint_functions import setup_smoothness_constraints, \
                                         build_reference_epoch_matrix
+from LSsurf.solver_functions import fit_system, nuisance_columns
 
 def edit_data_by_subset_fit(N_subset, args):
 
@@ -81,7 +82,8 @@ def setup_PS_bias(data, G_data, constraint_op_list, grids, bds, args):
     ps_mtx=lin_op(grid=grids['PS_bias'], name='PS_bias').\
         interp_mtx(data.coords()[0:2])
     # POCA rows should have zero entries
-    temp=ps_mtx.v.ravel()
+    # (the entries of a lin_op are read-only, so the values are copied)
+    temp=ps_mtx.v.ravel().copy()
     temp[np.in1d(ps_mtx.r.ravel(), np.flatnonzero(data.swath==0))]=0
     ps_mtx.v=temp.reshape(ps_mtx.v.shape)
     G_data.add(ps_mtx)
@@ -105,8 +107,14 @@ def check_data_against_DEM(in_TSE, data, m0, G_data, DEM_tol):
     return in_TSE[np.abs(r_DEM[in_TSE]-np.nanmedian(r_DEM[in_TSE]))<DEM_tol]
 
 def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,\
-                bias_model=None):
-    cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
+                bias_model=None, factorization=None):
+    '''
+    iterate the solution and the editing of the data
+
+    If factorization is a dict, the factor of the weighted system from the
+    final solution (see fit_system.R_factor) is stored in it under 'R',
+    'perm', and 'rows', if the solver provides one.
+    '''
 
     # save the original state of the in_TSE variable so that we can force the non-editable
     # TSE values to remain in their original state
@@ -124,27 +132,37 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,\
 
     #initialize m0, so that we have a value for a previous iteration
     m0 = np.zeros(Ip_c.shape[0])
+    if args['solver_args'] is None:
+        solver_args={}
+    else:
+        solver_args=args['solver_args']
+    nuisance_cols=None
+    if args['solver']=='schur':
+        # bias parameters (everything but the surface grids) are eliminated
+        surface_cols=np.concatenate([G_data.TOC['cols'][key] for key in ['z0', 'dz', 'lagrangian_dz']
+                                     if key in G_data.TOC['cols']])
+        nuisance_cols=nuisance_columns(Ip_c, surface_cols)
+    # weight the system once.  Between iterations, only the selection of data
+    # rows changes, so the solver can keep its ordering and symbolic analysis
+    system=fit_system(Gcoo, rhs, TCinv, G_data.N_eq, solver=args['solver'],
+                      edit_mode=args['edit_mode'], warm_start=args['warm_start'],
+                      max_memory=args['max_solve_memory'],
+                      nuisance_cols=nuisance_cols,
+                      keep_factorization=factorization is not None, **solver_args)
 
     for iteration in range(args['max_iterations']):
-        # build the parsing matrix that removes invalid rows
-        Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.size), \
-                            (np.arange(Gc.N_eq+in_TSE.size), \
-                             np.concatenate((in_TSE, cov_rows)))), \
-                           shape=(Gc.N_eq+in_TSE.size, Gcoo.shape[0])).tocsc()
         m0_last=m0
         if args['VERBOSE']:
-            print("starting qr solve for iteration %d at %s" % (iteration, ctime()), flush=True)
+            print("starting %s solve for iteration %d at %s" % (args['solver'], iteration, ctime()), flush=True)
+        rtol=None
+        if args['warm_start'] and iteration > 0:
+            # the solution only needs to be accurate to a fraction of the
+            # convergence tolerance, relative to the size of the dz values.
+            # LSMR ignores this, and only uses the warm start (see fit_system.solve)
+            dz_scale=np.maximum(np.max(np.abs(m0_last[Gc.TOC['cols']['dz']])), args['converge_tol_dz'])
+            rtol=args['warm_start_tol_scale']*args['converge_tol_dz']/dz_scale
         # solve the equations
-        solved=False
-        while not solved:
-            try:
-                tic=time();
-                m0=Ip_c.dot(sparseqr.solve(Ip_r.dot(TCinv.dot(Gcoo)), Ip_r.dot(TCinv.dot(rhs))));
-                timing['sparseqr_solve']=time()-tic
-                solved=True
-            except TypeError:
-                print("smooth_xytb_fit: spareqr.solve failed, probably because of memory.  Retrying after 5 minutes")
-                sleep(300)
+        m0=Ip_c.dot(system.solve(in_TSE, timing=timing, rtol=rtol))
 
         # calculate the full data residual
         rs_data=(data.z-G_data.toCSR().dot(m0))/data.sigma
@@ -189,7 +207,7 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,\
         max_model_change_dz=np.max(np.abs((m0_last-m0)[Gc.TOC['cols']['dz']]))
 
         if args['VERBOSE']:
-            print('found %d in TSE, sigma_hat=%3.3f, dm_max=%3.3f, dt=%3.0f' % ( in_TSE.size, sigma_hat, max_model_change_dz, timing['sparseqr_solve']), flush=True)
+            print('found %d in TSE, sigma_hat=%3.3f, dm_max=%3.3f, dt=%3.0f' % ( in_TSE.size, sigma_hat, max_model_change_dz, timing['solve']), flush=True)
         # quit if the solution is too similar to the previous solution
         if (iteration > np.maximum(2, args['bias_nsigma_iteration'])):
             if (max_model_change_dz < args['converge_tol_dz']) and (iteration > 2):
@@ -211,6 +229,10 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,\
                     print("sigma_hat LT 1, exiting after iteration %d" % iteration, flush=True)
                 break
         m0_last=m0
+    if factorization is not None:
+        factor=system.R_factor()
+        if factor is not None:
+            factorization.update(zip(['R', 'perm', 'rows'], factor))
     return m0, sigma_hat, in_TSE, in_TSE_last, rs_data
 
 def parse_biases(m, bias_model, bias_params):
@@ -239,15 +261,19 @@ def parse_biases(m, bias_model, bias_params):
             slope_bias_dict[key]={'slope_x':m[bias_model['slope_bias_dict'][key][0]], 'slope_y':m[bias_model['slope_bias_dict'][key][1]]}
     return b_dict, slope_bias_dict
 
-def calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, avg_ops, bias_model, bias_params, dzdt_lags=None, timing={}, error_scale=1):
-    tic=time()
-    # take the QZ transform of Gcoo  # TEST WHETHER rhs can just be a vector of ones
-    z, R, perm, rank=sparseqr.rz(Ip_r.dot(TCinv.dot(Gcoo)), Ip_r.dot(TCinv.dot(rhs)))
-    z=z.ravel()
-    R=R.tocsr()
-    R.sort_indices()
-    R.eliminate_zeros()
-    timing['decompose_qz']=time()-tic
+def calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, avg_ops, bias_model, bias_params, dzdt_lags=None, timing={}, error_scale=1, factorization=None):
+    if factorization is not None and 'R' in factorization:
+        # reuse the factorization of the final solution (see iterate_fit)
+        R, perm = factorization['R'], factorization['perm']
+    else:
+        tic=time()
+        # take the QZ transform of Gcoo  # TEST WHETHER rhs can just be a vector of ones
+        z, R, perm, rank=sparseqr.rz(Ip_r.dot(TCinv.dot(Gcoo)), Ip_r.dot(TCinv.dot(rhs)))
+        z=z.ravel()
+        R=R.tocsr()
+        R.sort_indices()
+        R.eliminate_zeros()
+        timing['decompose_qz']=time()-tic
 
     E0=np.zeros(R.shape[0])
 
@@ -378,6 +404,12 @@ def smooth_xytb_fit(**kwargs):
     'mask_data':None,
     'mask_scale':None,
     'compute_E':False,
+    'solver':'spqr',
+    'solver_args':None,
+    'edit_mode':'select',
+    'warm_start':False,
+    'warm_start_tol_scale':0.001,
+    'max_solve_memory':None,
     'max_iterations':10,
     'srs_proj4': None,
     'N_subset': None,
@@ -548,12 +580,17 @@ def smooth_xytb_fit(**kwargs):
     if args['VERBOSE']:
         print("initial: %d:" % G_data.r.max(), flush=True)
 
+    # if errors are requested, keep the factorization of the final solution
+    factorization=None
+    if args['compute_E']:
+        factorization={}
+
     # if we've done any iterations, parse the model and the data residuals
     if args['max_iterations'] > 0:
         tic_iteration=time()
         m0, sigma_hat, in_TSE, in_TSE_last, rs_data=iterate_fit(data, Gcoo, rhs, \
                                 TCinv, G_data, Gc, in_TSE, Ip_c, timing, args, \
-                                    bias_model=bias_model)
+                                    bias_model=bias_model, factorization=factorization)
 
         timing['iteration']=time()-tic_iteration
         # in_TSE_last is the list of points in the last inversion step
@@ -575,6 +612,13 @@ def smooth_xytb_fit(**kwargs):
         cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
         Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.size), (np.arange(Gc.N_eq+in_TSE.size), np.concatenate((in_TSE, cov_rows)))), \
                            shape=(Gc.N_eq+in_TSE.size, Gcoo.shape[0])).tocsc()
+        # the factorization of the final solution can be reused if it
+        # included the same data rows
+        if 'R' in factorization:
+            rows=np.zeros(G_data.N_eq, dtype=bool)
+            rows[in_TSE]=True
+            if not np.array_equal(factorization['rows'], rows):
+                factorization={}
         if args['VERBOSE']:
             print("Starting uncertainty calculation", flush=True)
             tic_error=time()
@@ -584,7 +628,7 @@ def smooth_xytb_fit(**kwargs):
         print(f"scaling uncertainties by {error_scale}")
         calc_and_parse_errors(E, Gcoo, TCinv, rhs, Ip_c, Ip_r, grids, G_data, Gc, averaging_ops, \
                          bias_model, args['bias_params'], dzdt_lags=args['dzdt_lags'], timing=timing, \
-                             error_scale=error_scale)
+                             error_scale=error_scale, factorization=factorization)
         if args['VERBOSE']:
             print("\tUncertainty propagation took %3.2f seconds" % (time()-tic_error), flush=True)
 
@@ -25,6 +25,7 @@ from LSsurf.constraint_functions import setup_smoothness_constraints, \
                                         build_reference_epoch_matrix
 from LSsurf.match_priors import match_prior_dz,  match_tile_edges
 from LSsurf.calc_sigma_extra import calc_sigma_extra, calc_sigma_extra_on_grid
+from LSsurf.solver_functions import fit_system, nuisance_columns
 
 def check_data_against_DEM(in_TSE, data, m0, G_data, DEM_tol):
     m1 = m0.copy()
@@ -97,8 +98,6 @@ def edit_by_bias(data, m0, in_TSE, iteration, bias_model, args):
 
 def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
                 grids, bias_model=None, sigma_extra_masks=None):
-    cov_rows=G_data.N_eq+np.arange(Gc.N_eq)
-    E_all = 1/TCinv.diagonal()
 
     # run edit_by_bias to zero out the edited IDs
     edit_by_bias(data, np.zeros(Ip_c.shape[0]), in_TSE, -1, bias_model, args)
@@ -113,29 +112,38 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
         N_editable=data.size
 
     sigma_extra=0
-    N_eq = Gcoo.shape[0]
     last_iteration = False
     m0 = np.zeros(Ip_c.shape[0])
+    if args['solver_args'] is None:
+        solver_args={}
+    else:
+        solver_args=args['solver_args']
+    nuisance_cols=None
+    if args['solver']=='schur':
+        # bias parameters (everything but the surface grids) are eliminated
+        surface_cols=np.concatenate([G_data.TOC['cols'][key] for key in ['z0', 'dz', 'lagrangian_dz']
+                                     if key in G_data.TOC['cols']])
+        nuisance_cols=nuisance_columns(Ip_c, surface_cols)
+    # weight the system once.  Between iterations, only the selection of data
+    # rows changes, so the solver can keep its ordering and symbolic analysis
+    system=fit_system(Gcoo, rhs, TCinv, G_data.N_eq, solver=args['solver'],
+                      edit_mode=args['edit_mode'], warm_start=args['warm_start'],
+                      max_memory=args['max_solve_memory'],
+                      nuisance_cols=nuisance_cols, **solver_args)
     for iteration in range(args['max_iterations']):
 
-        # augment the errors on the shelf
-        E2_plus=E_all**2
-        TCinv=sp.dia_matrix((1./np.sqrt(E2_plus),0), shape=(N_eq, N_eq))
-
-        # build the parsing matrix that removes invalid rows
-        Ip_r=sp.coo_matrix((np.ones(Gc.N_eq+in_TSE.sum()), \
-                            (np.arange(Gc.N_eq+in_TSE.sum()), \
-                             np.concatenate((np.flatnonzero(in_TSE), cov_rows)))), \
-                           shape=(Gc.N_eq+in_TSE.sum(), Gcoo.shape[0])).tocsc()
-
         if args['VERBOSE']:
-            print("starting qr solve for iteration %d at %s" % (iteration, ctime()), flush=True)
+            print("starting %s solve for iteration %d at %s" % (args['solver'], iteration, ctime()), flush=True)
         # solve the equations
-        tic=time();
         m0_last=m0
-        #print("smooth_xytb_fit_aug:iterate_fit: SETTING TOLERANCE TO -2")
-        m0=Ip_c.dot(sparseqr.solve(Ip_r.dot(TCinv.dot(Gcoo)).tocoo(), Ip_r.dot(TCinv.dot(rhs))))#, tolerance=-2))
-        timing['sparseqr_solve']=time()-tic
+        rtol=None
+        if args['warm_start'] and iteration > 0:
+            # the solution only needs to be accurate to a fraction of the
+            # convergence tolerance, relative to the size of the dz values.
+            # LSMR ignores this, and only uses the warm start (see fit_system.solve)
+            dz_scale=np.maximum(np.max(np.abs(m0_last[Gc.TOC['cols']['dz']])), args['converge_tol_dz'])
+            rtol=args['warm_start_tol_scale']*args['converge_tol_dz']/dz_scale
+        m0=Ip_c.dot(system.solve(in_TSE, timing=timing, rtol=rtol))
 
         # calculate the full data residual
         r_data=data.z-G_data.toCSR().dot(m0)
@@ -173,7 +181,7 @@ def iterate_fit(data, Gcoo, rhs, TCinv, G_data, Gc, in_TSE, Ip_c, timing, args,
             last_iteration = True
         # select the data that are within 3*sigma of the solution
         if args['VERBOSE']:
-            print('found %d in TSE, dt=%3.0f' % ( in_TSE.sum(), timing['sparseqr_solve']), flush=True)
+            print('found %d in TSE, dt=%3.0f' % ( in_TSE.sum(), timing['solve']), flush=True)
             if sigma_extra_masks is None:
                 print(f'\t median(sigma_extra)={np.median(sigma_extra):3.4f}')
             else:
@@ -316,6 +324,12 @@ def smooth_xytb_fit_aug(**kwargs):
     'mask_update_function':None,
     'mask_scale':None,
     'compute_E':False,
+    'solver':'spqr',
+    'solver_args':None,
+    'edit_mode':'select',
+    'warm_start':False,
+    'warm_start_tol_scale':0.001,
+    'max_solve_memory':None,
     'max_iterations':10,
     'min_iterations':2,
     'sigma_extra_bin_spacing':None,
@@ -0,0 +1,1178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Solvers for the sparse least-squares systems built by smooth_fit
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spl
+from scipy.sparse.csgraph import reverse_cuthill_mckee, connected_components
+import sparseqr
+from LSsurf.spsolve_tr_upper import spsolve_tr_upper
+import os
+import warnings
+from time import time
+try:
+    from sksparse import cholmod
+except ImportError:
+    cholmod=None
+
+''' Functions to solve the sparse least-squares systems for surface fits
+
+    Each solver engine takes a weighted design matrix, G, and a weighted data
+    vector, d, and returns the model vector, m, that minimizes |G m - d|^2.
+    Engines are kept in a registry, so that the fitting routines can select
+    one by name.
+
+    Contains:
+        register_solver, solve_system, solve_spqr, solve_cholmod_normal, solve_lsmr,
+        solve_cg_normal, cg_normal_eqs, stacked_operator, normal_eq_factorization, fit_system,
+        SolverMemoryError, estimate_fill, predict_solve_memory, available_memory,
+        choose_solver, block_diag_inverse, nuisance_columns, schur_solver
+'''
+
+# registry of solver engines, keyed by name
+solvers={}
+
+# solvers that work with the normal equations, which fit_system updates incrementally
+normal_eq_solvers={'cholmod_normal', 'cg_normal', 'schur'}
+
+# iterative solvers, which accept a starting solution (x0)
+iterative_solvers={'lsmr', 'cg_normal'}
+
+# iterative solvers whose tolerance (rtol) can be relaxed between iterations.
+# LSMR's tolerances bound the backward error, not the error in the solution,
+# so a relaxed LSMR solution can stop far from the converged one
+relaxed_tol_solvers={'cg_normal'}
+
+# solvers to try, in order, if the requested solver is predicted to need too much memory
+low_memory_solvers=['cholmod_normal', 'lsmr']
+
+class SolverMemoryError(MemoryError):
+    '''
+    raised when no solver is predicted to fit in the available memory, or
+    when SPQR fails to allocate its factorization
+    '''
+    pass
+
+def spqr_memory_error(G):
+    '''
+    make a SolverMemoryError for a failed SPQR factorization of G
+
+    sparseqr returns None when SPQR cannot allocate its workspace, so the
+    failure surfaces as a TypeError (or MemoryError) from sparseqr.  The
+    error message includes the predicted memory for the factorization.
+    '''
+    predicted=predict_solve_memory(G, 'spqr')
+    return SolverMemoryError(f"SPQR failed for a {G.shape[0]} x {G.shape[1]} system "+\
+                             f"with {G.nnz} nonzeros, predicted to need {predicted/2**30:.3g} GB")
+
+def register_solver(name):
+    '''
+    decorator that adds a solver function to the registry
+
+    Parameters
+    ----------
+    name : str
+        name by which the solver will be selected
+
+    Returns
+    -------
+    decorator that registers the function and returns it unchanged
+    '''
+    def decorator(func):
+        solvers[name]=func
+        return func
+    return decorator
+
+@register_solver('spqr')
+def solve_spqr(G, d, **kwargs):
+    '''
+    solve the least-squares problem with a sparse QR factorization of G
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    d : numpy array
+        weighted data vector
+
+    Raises
+    ------
+    SolverMemoryError
+        if SPQR fails (which it does when it cannot allocate its workspace)
+
+    Returns
+    -------
+    m : numpy array
+        least-squares solution
+    '''
+    try:
+        m=sparseqr.solve(G.tocoo(), d)
+    except (TypeError, MemoryError) as e:
+        raise spqr_memory_error(G) from e
+    if m is None:
+        raise spqr_memory_error(G)
+    return m
+
+@register_solver('cholmod_normal')
+def solve_cholmod_normal(G, d, **kwargs):
+    '''
+    solve the least-squares problem with a Cholesky factorization of the normal equations
+
+    The normal-equation matrix, G^T G, is factored with CHOLMOD if scikit-sparse
+    is available, otherwise with scipy's sparse LU factorization. This is faster
+    than a QR factorization, but squares the condition number of the problem,
+    so it should only be used for well-conditioned problems.
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    d : numpy array
+        weighted data vector
+
+    Returns
+    -------
+    m : numpy array
+        least-squares solution
+    '''
+    G=G.tocsc()
+    return normal_eq_factorization().factorize(G.T @ G).solve(G.T @ d)
+
+@register_solver('lsmr')
+def solve_lsmr(G, d, atol=1.e-8, btol=1.e-8, maxiter=None, x0=None, rtol=None, info=None, **kwargs):
+    '''
+    solve the least-squares problem iteratively with LSMR
+
+    The columns of G are scaled to unit norm before the solution, which acts as
+    a diagonal preconditioner.
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix or scipy.sparse.linalg.LinearOperator
+        weighted design matrix.  A LinearOperator must have a col_norm2
+        attribute containing the squared norm of each column.
+    d : numpy array
+        weighted data vector
+    atol, btol : float, optional
+        stopping tolerances passed to scipy.sparse.linalg.lsmr. The defaults are 1.e-8.
+    maxiter : int, optional
+        maximum number of iterations.  If None, 10 times the number of
+        columns of G is used.  If LSMR stops at this limit before meeting
+        its tolerances, a RuntimeWarning is issued.
+    x0 : numpy array, optional
+        starting solution. The default is None (start from zero).
+    rtol : float, optional
+        if specified, overrides atol and btol
+    info : dict, optional
+        if specified, the number of iterations, the residual norm, and the
+        reason LSMR stopped (istop, see scipy.sparse.linalg.lsmr) are
+        reported in info['iterations'], info['residual_norm'], and info['istop']
+
+    Returns
+    -------
+    m : numpy array
+        least-squares solution
+    '''
+    if isinstance(G, spl.LinearOperator):
+        # matrix-free operator (see stacked_operator)
+        col_norm=np.sqrt(G.col_norm2)
+    else:
+        G=G.tocsc()
+        col_norm=np.sqrt(np.asarray(G.power(2).sum(axis=0))).ravel()
+    col_scale=np.zeros_like(col_norm)
+    col_scale[col_norm>0]=1./col_norm[col_norm>0]
+    if isinstance(G, spl.LinearOperator):
+        GD=spl.LinearOperator(G.shape, dtype=float,
+                              matvec=lambda x: G.matvec(col_scale*np.ravel(x)),
+                              rmatvec=lambda y: col_scale*G.rmatvec(np.ravel(y)))
+    else:
+        GD=G @ sp.diags(col_scale)
+    if rtol is not None:
+        atol=rtol
+        btol=rtol
+    y0=None
+    if x0 is not None:
+        y0=col_norm*x0
+    if maxiter is None:
+        # scipy's default, min(G.shape), is often too few for the smoothness
+        # constraints, whose condition numbers grow with the grid size
+        maxiter=10*G.shape[1]
+    out=spl.lsmr(GD, d, atol=atol, btol=btol, maxiter=maxiter, x0=y0)
+    if out[1]==7:
+        warnings.warn(f"solve_lsmr: LSMR reached the iteration limit ({maxiter}) before converging, "+\
+                      f"the solution may be inaccurate (normr={out[3]:.6g})", RuntimeWarning)
+    if info is not None:
+        info['iterations']=out[2]
+        info['residual_norm']=out[3]
+        info['istop']=out[1]
+    return col_scale*out[0]
+
+def stacked_operator(G, A):
+    '''
+    make a LinearOperator for a sparse matrix stacked on top of a LinearOperator
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        upper rows of the operator
+    A : scipy.sparse.linalg.LinearOperator
+        lower rows of the operator, with a col_norm2 attribute (see
+        stencil_op.weighted_linear_operator)
+
+    Returns
+    -------
+    scipy.sparse.linalg.LinearOperator
+        the stacked operator.  Its col_norm2 attribute contains the squared
+        norm of each column.
+    '''
+    G=G.tocsr()
+    GT=G.T.tocsr()
+    N_G=G.shape[0]
+    out=spl.LinearOperator((N_G+A.shape[0], G.shape[1]), dtype=float,
+                           matvec=lambda x: np.concatenate([G.dot(np.ravel(x)), A.matvec(np.ravel(x))]),
+                           rmatvec=lambda y: GT.dot(np.ravel(y)[0:N_G])+A.rmatvec(np.ravel(y)[N_G:]))
+    out.col_norm2=np.asarray(G.power(2).sum(axis=0)).ravel()+A.col_norm2
+    return out
+
+def cg_normal_eqs(N, b, x0=None, rtol=1.e-8, maxiter=None, info=None):
+    '''
+    solve a normal-equation system with Jacobi-preconditioned conjugate gradients
+
+    Parameters
+    ----------
+    N : scipy.sparse matrix
+        symmetric, positive-definite normal-equation matrix
+    b : numpy array
+        right-hand side
+    x0 : numpy array, optional
+        starting solution. The default is None (start from zero).
+    rtol : float, optional
+        relative tolerance on the residual norm. The default is 1.e-8.
+    maxiter : int, optional
+        maximum number of iterations.  If None, scipy's default is used.
+    info : dict, optional
+        if specified, the number of iterations and the norm of N x - b are
+        reported in info['iterations'] and info['residual_norm']
+
+    Returns
+    -------
+    x : numpy array
+        solution
+    '''
+    diag=N.diagonal()
+    M_diag=np.ones_like(diag)
+    M_diag[diag>0]=1./diag[diag>0]
+    count=[0]
+    def callback(xk):
+        count[0] += 1
+    try:
+        x=spl.cg(N, b, x0=x0, rtol=rtol, maxiter=maxiter, M=sp.diags(M_diag), callback=callback)[0]
+    except TypeError:
+        # scipy < 1.12 calls the relative tolerance 'tol'
+        x=spl.cg(N, b, x0=x0, tol=rtol, maxiter=maxiter, M=sp.diags(M_diag), callback=callback)[0]
+    if info is not None:
+        info['iterations']=count[0]
+        info['residual_norm']=np.linalg.norm(N @ x - b)
+    return x
+
+@register_solver('cg_normal')
+def solve_cg_normal(G, d, x0=None, rtol=1.e-8, maxiter=None, info=None, **kwargs):
+    '''
+    solve the least-squares problem with conjugate gradients on the normal equations
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    d : numpy array
+        weighted data vector
+    x0, rtol, maxiter, info :
+        see cg_normal_eqs
+
+    Returns
+    -------
+    m : numpy array
+        least-squares solution
+    '''
+    G=G.tocsc()
+    return cg_normal_eqs(G.T @ G, G.T @ d, x0=x0, rtol=rtol, maxiter=maxiter, info=info)
+
+def solve_system(G, d, solver='spqr', timing=None, **kwargs):
+    '''
+    solve a weighted least-squares system with a solver from the registry
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    d : numpy array
+        weighted data vector
+    solver : str, optional
+        name of the solver engine (one of the keys of solver_functions.solvers).
+        The default is 'spqr'.
+    timing : dict, optional
+        if specified, the time taken by the solution is reported in timing['solve']
+    **kwargs :
+        additional keywords are passed to the solver engine
+
+    Returns
+    -------
+    m : numpy array
+        least-squares solution
+    '''
+    if solver not in solvers:
+        raise ValueError(f"solver {solver} not understood, options are: {list(solvers.keys())}")
+    tic=time()
+    m=np.asarray(solvers[solver](G, d, **kwargs)).ravel()
+    if timing is not None:
+        timing['solve']=time()-tic
+    return m
+
+def estimate_fill(G):
+    '''
+    estimate the number of nonzeros in the triangular factor of G (or of G^T G)
+
+    The estimate is the envelope (profile) of G^T G after a reverse
+    Cuthill-McKee ordering.  The fill of a Cholesky factor is confined to the
+    envelope, and the R factor of G has the same pattern as the Cholesky factor
+    of G^T G, so this is an upper bound for the factor size with this ordering.
+    The fill-reducing orderings used by SPQR and CHOLMOD usually do better.
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        design matrix
+
+    Returns
+    -------
+    fill : int
+        estimated number of nonzeros in the upper triangle of the factor
+    nnz_N : int
+        number of nonzeros in G^T G
+    '''
+    G=sp.csr_matrix(G)
+    P=sp.csr_matrix((np.ones(G.indices.size), G.indices, G.indptr), shape=G.shape)
+    N=(P.T @ P).tocsr()
+    perm=reverse_cuthill_mckee(N, symmetric_mode=True)
+    N=N[perm,:][:, perm].tocsr()
+    rows=np.arange(N.shape[0])
+    counts=np.diff(N.indptr)
+    # the first column in each row of the permuted matrix bounds the envelope
+    first=rows.copy()
+    if np.any(counts>0):
+        first[counts>0]=np.minimum.reduceat(N.indices, N.indptr[:-1][counts>0])
+    return int(np.sum(rows-np.minimum(first, rows)+1)), N.nnz
+
+def predict_solve_memory(G, solver, fill=None, nnz_N=None):
+    '''
+    predict the peak memory (in bytes) that a solver engine will need for G
+
+    Each nonzero is counted as 16 bytes (a double and a 64-bit index).  The
+    model counts the copies of G made by each engine, plus the factor: for QR,
+    both R and the Householder vectors are kept; for the Cholesky solver, the
+    normal-equation matrix and its factor; for the iterative solvers, only
+    the matrices that they multiply by.
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    solver : str
+        name of the solver engine
+    fill, nnz_N : int, optional
+        number of nonzeros in the factor and in G^T G.  If None, they are
+        calculated with estimate_fill
+
+    Returns
+    -------
+    bytes : float
+        predicted peak memory
+    '''
+    nnz_G=G.nnz
+    if solver in ['spqr', 'cholmod_normal', 'cg_normal', 'schur'] and (fill is None or nnz_N is None):
+        fill, nnz_N = estimate_fill(G)
+    if solver=='spqr':
+        return 16.*(2*nnz_G + 2*fill)
+    if solver in ['cholmod_normal', 'schur']:
+        # the fill of the Schur complement is bounded by that of the full system
+        return 16.*(nnz_G + 2*nnz_N + fill)
+    if solver=='cg_normal':
+        return 16.*(nnz_G + 2*nnz_N)
+    # lsmr and any other solver that works only with G
+    return 16.*(2*nnz_G)
+
+def available_memory():
+    '''
+    return the memory (in bytes) that is available for new processes, or None if it cannot be determined
+
+    On Linux, this is MemAvailable from /proc/meminfo, which counts the page
+    cache that can be reclaimed.  Elsewhere, the free physical memory is
+    used, which is usually a smaller number.
+    '''
+    try:
+        with open('/proc/meminfo','r') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    # the value is reported in kB
+                    return float(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return float(os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE'))
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def choose_solver(G, solver, max_memory=None):
+    '''
+    choose a solver engine that is predicted to fit within a memory limit
+
+    If the requested solver is predicted to need more than max_memory, the
+    solvers in low_memory_solvers are tried in order, and a warning is issued
+    if the solver is changed.  The predictions are upper bounds (see
+    estimate_fill), so the check is only made if a limit is specified.
+
+    Parameters
+    ----------
+    G : scipy.sparse matrix
+        weighted design matrix
+    solver : str
+        name of the requested solver engine
+    max_memory : float or str, optional
+        memory limit, in bytes.  If 'available', the available memory is used
+        (see available_memory).  If None or np.inf (or if the available
+        memory cannot be determined), memory is not checked, and the
+        requested solver is returned.  The default is None.
+
+    Raises
+    ------
+    SolverMemoryError
+        if no solver is predicted to fit within max_memory
+
+    Returns
+    -------
+    solver : str
+        name of the selected solver engine
+    predicted : float
+        predicted peak memory for the selected solver, in bytes
+    '''
+    if isinstance(max_memory, str):
+        if max_memory != 'available':
+            raise ValueError(f"max_memory={max_memory} not understood, options are: a number, 'available', or None")
+        max_memory=available_memory()
+    if max_memory is None or not np.isfinite(max_memory):
+        return solver, None
+    fill, nnz_N = [None, None]
+    predictions={}
+    for this_solver in [solver]+[ii for ii in low_memory_solvers if ii != solver]:
+        if this_solver in ['spqr', 'cholmod_normal', 'cg_normal', 'schur'] and fill is None:
+            fill, nnz_N = estimate_fill(G)
+        predictions[this_solver]=predict_solve_memory(G, this_solver, fill=fill, nnz_N=nnz_N)
+        if predictions[this_solver] <= max_memory:
+            if this_solver != solver:
+                warnings.warn(f"choose_solver: {solver} is predicted to need {predictions[solver]/2**30:.3g} GB, "+\
+                              f"more than the limit of {max_memory/2**30:.3g} GB, "+\
+                              f"using {this_solver} ({predictions[this_solver]/2**30:.3g} GB)", RuntimeWarning)
+            return this_solver, predictions[this_solver]
+    raise SolverMemoryError("no solver is predicted to fit in %.3g GB: " % (max_memory/2**30) + \
+                            ", ".join([f"{key}: {val/2**30:.3g} GB" for key, val in predictions.items()]))
+
+class normal_eq_factorization(object):
+    '''
+    Cholesky factorization of a normal-equation matrix that can be refactored
+    without repeating the symbolic analysis
+
+    The fill-reducing ordering and the symbolic analysis are calculated for the
+    first matrix that is factored, and are reused for any later matrix that has
+    the same sparsity pattern, so that only the numeric factorization is redone.
+    CHOLMOD (from scikit-sparse) is used if it is available.  Otherwise the
+    matrix is permuted with a reverse Cuthill-McKee ordering and factored with
+    scipy's SuperLU, reusing the ordering.
+    '''
+    def __init__(self):
+        self.indptr=None
+        self.indices=None
+        self.perm=None
+        self.factor=None
+        self.N_analyze=0
+        self.N_factor=0
+
+    def __same_pattern__(self, N):
+        return self.indptr is not None and \
+            np.array_equal(self.indptr, N.indptr) and \
+            np.array_equal(self.indices, N.indices)
+
+    def __analyze__(self, N):
+        self.indptr=N.indptr.copy()
+        self.indices=N.indices.copy()
+        if cholmod is not None:
+            self.factor=cholmod.analyze(N)
+        else:
+            self.perm=reverse_cuthill_mckee(N, symmetric_mode=True)
+        self.N_analyze += 1
+
+    def factorize(self, N):
+        '''
+        calculate the numeric factorization of N, analyzing N first if its pattern is new
+
+        Parameters
+        ----------
+        N : scipy.sparse matrix
+            symmetric, positive-definite matrix
+
+        Returns
+        -------
+        self
+        '''
+        N=sp.csc_matrix(N)
+        N.sort_indices()
+        if not self.__same_pattern__(N):
+            self.__analyze__(N)
+        if cholmod is not None:
+            self.factor.cholesky_inplace(N)
+        else:
+            self.factor=spl.splu(N[self.perm,:][:, self.perm].tocsc(),
+                                 permc_spec='NATURAL', diag_pivot_thresh=0.,
+                                 options={'SymmetricMode':True})
+        self.N_factor += 1
+        return self
+
+    def solve(self, b):
+        '''
+        solve N x = b using the current factorization
+        '''
+        if cholmod is not None:
+            return self.factor(b)
+        x=np.zeros_like(b)
+        x[self.perm]=self.factor.solve(b[self.perm])
+        return x
+
+    def R_factor(self):
+        '''
+        upper-triangular factor of the last matrix that was factored
+
+        Returns
+        -------
+        R : scipy.sparse.csr_matrix
+            upper-triangular matrix for which R^T R = N[perm,:][:,perm]
+        perm : numpy array
+            ordering of the rows and columns of N
+        '''
+        if cholmod is not None:
+            R=self.factor.L().T.tocsr()
+            perm=self.factor.P()
+        else:
+            # SuperLU was run without pivoting, so U = D L^T, and R = D^-1/2 U
+            U=self.factor.U.tocsr()
+            R=sp.diags(1./np.sqrt(U.diagonal())).dot(U).tocsr()
+            perm=self.perm[self.factor.perm_c]
+        R.sort_indices()
+        R.eliminate_zeros()
+        return R, perm
+
+def block_diag_inverse(D):
+    '''
+    invert a sparse symmetric matrix whose connected blocks are small
+
+    The blocks are found as the connected components of the pattern of D, and
+    each block is inverted densely, so the inverse has the same block structure
+    as D.  This is efficient when the blocks are small, as for per-track biases
+    (one parameter per block) or for small bias grids.
+
+    Parameters
+    ----------
+    D : scipy.sparse matrix
+        symmetric, positive-definite matrix
+
+    Returns
+    -------
+    Dinv : scipy.sparse.csr_matrix
+        inverse of D
+    '''
+    D=sp.csr_matrix(D)
+    N_blocks, labels = connected_components(D, directed=False)
+    block_size=np.bincount(labels, minlength=N_blocks)
+    # single-parameter blocks are inverted together
+    single=block_size[labels]==1
+    rows=[np.flatnonzero(single)]
+    cols=[rows[0]]
+    vals=[1./D.diagonal()[single]]
+    for block in np.flatnonzero(block_size > 1):
+        ii=np.flatnonzero(labels==block)
+        Dinv_block=np.linalg.inv(D[ii,:][:, ii].toarray())
+        r, c = np.meshgrid(ii, ii, indexing='ij')
+        rows.append(r.ravel())
+        cols.append(c.ravel())
+        vals.append(Dinv_block.ravel())
+    return sp.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=D.shape).tocsr()
+
+def nuisance_columns(Ip_c, surface_cols):
+    '''
+    find the columns of the reduced system that are not surface parameters
+
+    Parameters
+    ----------
+    Ip_c : scipy.sparse matrix
+        matrix that maps the reduced model vector to the full model vector
+    surface_cols : numpy array
+        columns of the full model vector that are surface parameters
+
+    Returns
+    -------
+    numpy array
+        indices of the reduced-model columns that are not surface parameters
+    '''
+    Ip_c=sp.coo_matrix(Ip_c)
+    full_col=np.zeros(Ip_c.shape[1], dtype=int)
+    full_col[Ip_c.col]=Ip_c.row
+    return np.flatnonzero(~np.in1d(full_col, surface_cols))
+
+class schur_solver(object):
+    '''
+    Solve normal equations by eliminating nuisance parameters with a Schur complement
+
+    The normal equations are partitioned into surface parameters (s) and
+    nuisance parameters (n), such as biases:
+        [ A    B ] [x_s]   [b_s]
+        [ B^T  D ] [x_n] = [b_n]
+    Nuisance parameters couple to many data rows, so they spoil the banded
+    structure of A and add fill to a direct factorization.  D is nearly block
+    diagonal, so it is inverted block by block, the surface parameters are
+    found from the Schur complement:
+        (A - B D^-1 B^T) x_s = b_s - B D^-1 b_n
+    and the nuisance parameters are recovered by back-substitution:
+        x_n = D^-1 (b_n - B^T x_s)
+    The factorization of the Schur complement is kept between solutions, so
+    that its symbolic analysis is reused while its pattern does not change.
+
+    The covariance of the surface parameters is S^-1, so the factor of S can
+    be used to propagate their errors (see R_factor), and the variances of
+    the nuisance parameters are found by back-substitution (see
+    nuisance_variance).
+    '''
+    def __init__(self, nuisance_cols, N_cols):
+        '''
+        Parameters
+        ----------
+        nuisance_cols : numpy array
+            indices of the nuisance parameters
+        N_cols : int
+            total number of parameters
+        '''
+        nuisance=np.zeros(N_cols, dtype=bool)
+        nuisance[nuisance_cols]=True
+        self.ii_n=np.flatnonzero(nuisance)
+        self.ii_s=np.flatnonzero(~nuisance)
+        self.factorization=normal_eq_factorization()
+        self.B=None
+        self.Dinv=None
+        self.BDinv=None
+
+    def factorize(self, N):
+        '''
+        invert the nuisance block of N, and factor the Schur complement
+
+        Parameters
+        ----------
+        N : scipy.sparse matrix
+            normal-equation matrix
+
+        Returns
+        -------
+        self
+        '''
+        N=sp.csr_matrix(N)
+        N_s=N[self.ii_s,:]
+        A=N_s[:, self.ii_s]
+        self.B=N_s[:, self.ii_n]
+        self.Dinv=block_diag_inverse(N[self.ii_n,:][:, self.ii_n])
+        self.BDinv=(self.B @ self.Dinv).tocsr()
+        self.factorization.factorize((A - self.BDinv @ self.B.T).tocsc())
+        return self
+
+    def solve(self, N, b):
+        '''
+        solve N x = b
+
+        Parameters
+        ----------
+        N : scipy.sparse matrix
+            normal-equation matrix
+        b : numpy array
+            right-hand side
+
+        Returns
+        -------
+        x : numpy array
+            solution
+        '''
+        self.factorize(N)
+        x=np.zeros(N.shape[0])
+        x[self.ii_s]=self.factorization.solve(b[self.ii_s] - self.BDinv @ b[self.ii_n])
+        x[self.ii_n]=self.Dinv @ (b[self.ii_n] - self.B.T @ x[self.ii_s])
+        return x
+
+    def R_factor(self):
+        '''
+        upper-triangular factor for the errors of the surface parameters
+
+        The factor of the Schur complement is padded with an identity block
+        for the nuisance parameters, so that the rows of its inverse for the
+        surface parameters give their covariance, S^-1.  The rows of the
+        inverse for the nuisance parameters are placeholders: their
+        variances are calculated by nuisance_variance.
+
+        Returns
+        -------
+        R : scipy.sparse.csr_matrix
+            upper-triangular matrix
+        perm : numpy array
+            parameter for each row and column of R
+        '''
+        R_s, perm_s = self.factorization.R_factor()
+        R=sp.block_diag([R_s, sp.identity(self.ii_n.size)], format='csr')
+        R.sort_indices()
+        return R, np.concatenate([self.ii_s[perm_s], self.ii_n])
+
+    def nuisance_variance(self, N_batch=256):
+        '''
+        calculate the posterior variances of the nuisance parameters
+
+        The covariance of the nuisance parameters is
+            D^-1 + D^-1 B^T S^-1 B D^-1,
+        whose diagonal is calculated with solves against the last
+        Schur-complement factorization, in batches of N_batch columns.
+
+        Returns
+        -------
+        var : numpy array
+            variances of the nuisance parameters, in the order of self.ii_n
+        '''
+        var=np.asarray(self.Dinv.diagonal()).copy()
+        BDinv=self.BDinv.tocsc()
+        for i0 in range(0, self.ii_n.size, N_batch):
+            cols=np.arange(i0, np.minimum(i0+N_batch, self.ii_n.size))
+            C=BDinv[:, cols].toarray()
+            var[cols] += np.sum(C*self.factorization.solve(C), axis=0)
+        return var
+
+class fit_system(object):
+    '''
+    Weighted least-squares system whose data rows are edited between solutions
+
+    The fitting routines solve the same system repeatedly, changing only the set
+    of data rows that are included in the solution.  This class weights the
+    system once, and keeps whatever state the solver can reuse between
+    solutions.
+
+    For the normal-equation solvers, the contribution of the constraint
+    equations is calculated once, and between solutions the normal equations
+    are updated by adding the contributions of the rows that have entered the
+    solution and subtracting those of the rows that have left it.  The normal
+    equations are kept on the sparsity pattern obtained with all data rows
+    included, and the factorization is reused, so that the ordering and
+    symbolic analysis are only calculated once.
+
+    For the other solvers, edit_mode selects how rows are removed:
+        'select' : the included rows are copied into a new matrix for each solution
+        'weight' : the rows that are not included are given zero weight in
+                   place, so that the system matrix is not copied
+
+    If warm_start is True, the iterative solvers start each solution from the
+    previous one.  Only the solvers in relaxed_tol_solvers accept a relaxed
+    tolerance for the warm-started solutions (see solve); LSMR uses the
+    previous solution only as its starting point.
+
+    If keep_factorization is True, the upper-triangular factor of the weighted
+    system from the last solution is kept, so that it can be used to propagate
+    errors (see R_factor).  The 'spqr' solver then solves the system with a
+    Q-less QR factorization (sparseqr.rz) and a triangular solve, and
+    'cholmod_normal' provides the factor of its Cholesky factorization.  The
+    normal equations can also be refactored with the data rows reweighted
+    (e.g. to include sigma_extra in the data errors), reusing the ordering
+    and symbolic analysis.  For the 'spqr' solver, the QR factor is used for
+    the weights of the last solution, and the reweighted normal equations
+    are factored for other weights.
+
+    If constraint_op is specified, the constraint equations are applied as a
+    LinearOperator (e.g. a matrix-free stencil_op), and Gcoo contains only the
+    data rows.  This is only available for the 'lsmr' solver.
+
+    If max_memory is specified, the peak memory of the solver is predicted
+    before any solution, for the system with all data rows included.  If it
+    exceeds max_memory, a lower-memory solver is selected (see
+    choose_solver), and if no solver fits, SolverMemoryError is raised.
+    '''
+    def __init__(self, Gcoo, rhs, TCinv, N_data, solver='spqr', edit_mode='select',
+                 warm_start=False, max_memory=None, nuisance_cols=None,
+                 constraint_op=None, keep_factorization=False, **solver_args):
+        '''
+        Parameters
+        ----------
+        Gcoo : scipy.sparse matrix
+            design matrix, with N_data data rows followed by the constraint rows
+        rhs : numpy array
+            right-hand side of the equations
+        TCinv : scipy.sparse.dia_matrix
+            inverse square root of the data and constraint covariance
+        N_data : int
+            number of data rows in Gcoo
+        solver : str, optional
+            name of the solver engine. The default is 'spqr'.
+        edit_mode : str, optional
+            'select' or 'weight' (see above).  The default is 'select'.
+        warm_start : bool, optional
+            if True, start each solution from the previous one. Only
+            available for the iterative solvers. The default is False.
+        max_memory : float or str, optional
+            memory limit for the solution, in bytes, or 'available' (see
+            choose_solver).  If None, memory is not checked.  The default is None.
+        nuisance_cols : numpy array, optional
+            columns of Gcoo that are eliminated by the 'schur' solver
+        constraint_op : scipy.sparse.linalg.LinearOperator, optional
+            weighted constraint equations, with a col_norm2 attribute (see
+            stencil_op.weighted_linear_operator).  If specified, Gcoo
+            contains only the data rows, and rhs and TCinv contain the data
+            rows followed by the constraint rows.
+        keep_factorization : bool, optional
+            if True, keep the factor of the last solution (see R_factor).
+            The default is False.
+        **solver_args :
+            additional keywords for the solver engine
+        '''
+        if edit_mode not in ['select', 'weight']:
+            raise ValueError(f"edit_mode {edit_mode} not understood, options are: ['select', 'weight']")
+        if solver=='schur' and nuisance_cols is None:
+            raise ValueError("the schur solver requires nuisance_cols")
+        if warm_start and solver not in iterative_solvers:
+            raise ValueError(f"warm_start requires an iterative solver, options are: {list(iterative_solvers)}")
+        if constraint_op is not None and solver != 'lsmr':
+            raise ValueError("constraint_op requires the lsmr solver")
+        if constraint_op is None:
+            self.G=TCinv.dot(Gcoo).tocsr()
+        else:
+            self.G=sp.diags(TCinv.diagonal()[0:N_data]).dot(Gcoo).tocsr()
+        self.d=TCinv.dot(rhs)
+        solver, self.predicted_memory = choose_solver(self.G, solver, max_memory=max_memory)
+        warm_start = warm_start and solver in iterative_solvers
+        self.N_data=N_data
+        self.constraint_op=constraint_op
+        self.constraint_rows=np.arange(N_data, self.d.size)
+        self.solver=solver
+        self.edit_mode=edit_mode
+        self.solver_args=solver_args
+        self.warm_start=warm_start
+        # previous solution
+        self.x_last=None
+        # data rows included in the current system
+        self.in_rows=None
+        self.factorization=None
+        # factor of the last solution, and the data rows it included
+        self.keep_factorization=keep_factorization
+        self.R=None
+        self.R_perm=None
+        self.last_rows=None
+        if solver in normal_eq_solvers:
+            Gc=self.G[self.constraint_rows,:]
+            self.Nc=(Gc.T @ Gc).tocsc()
+            self.rhs_c=Gc.T @ self.d[self.constraint_rows]
+            # the normal equations calculated with all the data rows have a
+            # pattern that contains that for any subset of the data rows.  The
+            # pattern is calculated from the pattern of G, because entries of
+            # G^T G whose sums cancel are dropped from the product
+            P=sp.csr_matrix((np.ones(self.G.indices.size), self.G.indices, self.G.indptr), shape=self.G.shape)
+            N_all=(P.T @ P).tocsc()
+            N_all.sort_indices()
+            self.N_indptr=N_all.indptr
+            self.N_indices=N_all.indices
+            self.N_key=self.__pattern_key__(N_all)
+            self.N_vals=None
+            self.rhs_N=None
+            if solver=='cholmod_normal':
+                self.factorization=normal_eq_factorization()
+            elif solver=='schur':
+                self.factorization=schur_solver(nuisance_cols, self.G.shape[1])
+        if self.solver not in normal_eq_solvers and edit_mode=='weight':
+            # all rows start in the system.  The values of rows that are
+            # zeroed are kept so that they can be restored
+            self.in_rows=np.ones(N_data, dtype=bool)
+            self.d_data=self.d[0:N_data].copy()
+            self.saved_entries=np.zeros(0, dtype=int)
+            self.saved_values=np.zeros(0)
+
+    def __pattern_key__(self, N):
+        # sortable key for each entry of a CSC matrix with sorted indices
+        cols=np.repeat(np.arange(N.shape[1], dtype=np.int64), np.diff(N.indptr))
+        return cols*N.shape[0]+N.indices
+
+    def __on_pattern__(self, N):
+        # map the entries of N onto the pattern of the all-data normal equations
+        N=sp.csc_matrix(N)
+        N.sum_duplicates()
+        key=self.__pattern_key__(N)
+        ind=np.minimum(np.searchsorted(self.N_key, key), self.N_key.size-1)
+        if not np.array_equal(self.N_key[ind], key):
+            raise ValueError("normal-equation entries found outside the pattern of the full system")
+        data=np.zeros(self.N_key.size)
+        data[ind]=N.data
+        return data
+
+    def __row_entries__(self, rows):
+        # indices into G.data of the entries in a sorted list of rows
+        starts=self.G.indptr[rows]
+        counts=self.G.indptr[rows+1]-starts
+        return np.repeat(starts-np.cumsum(counts)+counts, counts)+np.arange(counts.sum())
+
+    def __normal_data_part__(self, rows):
+        # normal-equation values and rhs for a set of data rows
+        Gd=self.G[rows,:]
+        return self.__on_pattern__(Gd.T @ Gd), Gd.T @ self.d[rows]
+
+    def __update_normal_eqs__(self, in_rows):
+        if self.in_rows is not None:
+            entering=np.flatnonzero(in_rows & ~self.in_rows)
+            leaving=np.flatnonzero(self.in_rows & ~in_rows)
+        if self.in_rows is None or entering.size+leaving.size > in_rows.sum():
+            # recalculate from scratch if that is less work than an update
+            self.N_vals, self.rhs_N = self.__normal_data_part__(np.flatnonzero(in_rows))
+            self.N_vals += self.__on_pattern__(self.Nc)
+            self.rhs_N += self.rhs_c
+        else:
+            for rows, sign in [(entering, 1), (leaving, -1)]:
+                if rows.size==0:
+                    continue
+                N_vals, rhs = self.__normal_data_part__(rows)
+                self.N_vals += sign*N_vals
+                self.rhs_N += sign*rhs
+        self.in_rows=in_rows
+
+    def __update_row_weights__(self, in_rows):
+        # zero the rows of G and d that leave the solution, restore those that enter it
+        entering=np.flatnonzero(in_rows & ~self.in_rows)
+        leaving=np.flatnonzero(self.in_rows & ~in_rows)
+        if entering.size > 0:
+            entries=self.__row_entries__(entering)
+            ind=np.searchsorted(self.saved_entries, entries)
+            self.G.data[entries]=self.saved_values[ind]
+            keep=np.ones(self.saved_entries.size, dtype=bool)
+            keep[ind]=False
+            self.saved_entries=self.saved_entries[keep]
+            self.saved_values=self.saved_values[keep]
+            self.d[entering]=self.d_data[entering]
+        if leaving.size > 0:
+            entries=self.__row_entries__(leaving)
+            self.saved_entries=np.concatenate([self.saved_entries, entries])
+            self.saved_values=np.concatenate([self.saved_values, self.G.data[entries]])
+            order=np.argsort(self.saved_entries, kind='stable')
+            self.saved_entries=self.saved_entries[order]
+            self.saved_values=self.saved_values[order]
+            self.G.data[entries]=0.
+            self.d[leaving]=0.
+        self.in_rows=in_rows
+
+    def __system__(self, data_rows=None):
+        # weighted system matrix and data vector for a set of data rows.  If
+        # data_rows is None, all the rows in G are used
+        if self.constraint_op is None:
+            if data_rows is None:
+                return self.G, self.d
+            all_rows=np.concatenate([data_rows, self.constraint_rows])
+            return self.G[all_rows,:], self.d[all_rows]
+        if data_rows is None:
+            data_rows=np.arange(self.N_data)
+            Gd=self.G
+        else:
+            Gd=self.G[data_rows,:]
+        return stacked_operator(Gd, self.constraint_op), \
+            np.concatenate([self.d[data_rows], self.d[self.constraint_rows]])
+
+    def solve(self, rows, timing=None, rtol=None):
+        '''
+        solve the system using a subset of the data rows
+
+        Parameters
+        ----------
+        rows : numpy array
+            indices of the data rows to include, or a boolean array that is True for those rows
+        timing : dict, optional
+            if specified, the solution time is reported in timing['solve'].  For
+            the iterative solvers, the number of iterations and the residual
+            norm for each solution are appended to timing['solve_iterations']
+            and timing['solve_residual'], and for LSMR, the reason that it
+            stopped is appended to timing['solve_istop'].
+        rtol : float, optional
+            relative tolerance for the solvers in relaxed_tol_solvers.  It is
+            ignored by the other solvers.  If None, the solver's default (or
+            the value in solver_args) is used.
+
+        Returns
+        -------
+        m : numpy array
+            least-squares solution
+        '''
+        tic=time()
+        rows=np.asarray(rows)
+        if rows.dtype==bool:
+            in_rows=rows.copy()
+        else:
+            in_rows=np.zeros(self.N_data, dtype=bool)
+            in_rows[rows]=True
+        solver_args=self.solver_args.copy()
+        info={}
+        if self.solver in iterative_solvers:
+            solver_args['info']=info
+            if rtol is not None and self.solver in relaxed_tol_solvers:
+                solver_args['rtol']=rtol
+            if self.warm_start and self.x_last is not None:
+                solver_args['x0']=self.x_last
+        if self.solver in normal_eq_solvers:
+            self.__update_normal_eqs__(in_rows)
+            N=sp.csc_matrix((self.N_vals, self.N_indices, self.N_indptr), shape=(self.G.shape[1], self.G.shape[1]))
+            if self.solver=='schur':
+                m=self.factorization.solve(N, self.rhs_N)
+            elif self.factorization is not None:
+                m=self.factorization.factorize(N).solve(self.rhs_N)
+            else:
+                m=cg_normal_eqs(N, self.rhs_N, **solver_args)
+        else:
+            if self.edit_mode=='weight':
+                self.__update_row_weights__(in_rows)
+                G, d = self.__system__()
+            else:
+                G, d = self.__system__(np.flatnonzero(in_rows))
+            if self.keep_factorization and self.solver=='spqr':
+                m=self.__qr_solve__(G, d)
+            else:
+                m=solve_system(G, d, solver=self.solver, **solver_args)
+        self.x_last=m
+        self.last_rows=in_rows
+        if timing is not None:
+            timing['solve']=time()-tic
+            if 'iterations' in info:
+                timing.setdefault('solve_iterations', []).append(info['iterations'])
+                timing.setdefault('solve_residual', []).append(info['residual_norm'])
+            if 'istop' in info:
+                timing.setdefault('solve_istop', []).append(info['istop'])
+        return m
+
+    def __qr_solve__(self, G, d):
+        # solve the system with a Q-less QR factorization, keeping R
+        self.R, self.R_perm = [None, None]
+        try:
+            z, R, perm, rank = sparseqr.rz(G.tocoo(), d)
+        except (TypeError, MemoryError) as e:
+            raise spqr_memory_error(G) from e
+        if rank < G.shape[1]:
+            # R cannot be used to propagate errors for a rank-deficient system
+            return solve_spqr(G, d)
+        R=R.tocsr()
+        R.sort_indices()
+        R.eliminate_zeros()
+        m=np.zeros(G.shape[1])
+        m[perm]=spsolve_tr_upper(R, np.asarray(z, dtype=float).ravel()[0:rank])
+        self.R, self.R_perm = [R, np.asarray(perm)]
+        return m
+
+    def R_factor(self, rows=None, row_scale=None):
+        '''
+        upper-triangular factor of the weighted system
+
+        Only available if the system was created with keep_factorization=True,
+        for the 'spqr', 'cholmod_normal', and 'schur' solvers.  By default,
+        the factor of the last solution is returned.  For the normal-equation
+        solvers, if rows differ from those of the last solution, or if
+        row_scale is specified, the normal equations are recalculated and
+        refactored, reusing the ordering and the symbolic analysis.  The QR
+        factor of the 'spqr' solver is returned for the rows and weights of
+        the last solution; for other rows or weights, the reweighted normal
+        equations are factored with a Cholesky factorization, which is much
+        cheaper than a second QR factorization (but squares the condition
+        number of the system).  For 'schur', the factor only gives the errors
+        of the surface parameters (see schur_solver.R_factor), and those of
+        the nuisance parameters are given by nuisance_sigma.
+
+        Parameters
+        ----------
+        rows : numpy array, optional
+            boolean array that is True for the data rows to include, or
+            their indices.  The default is the rows of the last solution.
+        row_scale : numpy array, optional
+            factor by which each weighted data row is multiplied, e.g. to
+            replace the data errors with larger errors.  The default is None
+            (no scaling).
+
+        Returns
+        -------
+        R : scipy.sparse.csr_matrix
+            upper-triangular matrix for which R^T R = G^T G, where G is the
+            weighted system matrix with its columns reordered by perm.
+        perm : numpy array
+            column ordering of R
+        rows : numpy array
+            boolean array that is True for the data rows included in the factor
+        Returns None if no factor is available.
+        '''
+        if not self.keep_factorization or self.last_rows is None:
+            return None
+        if rows is None:
+            in_rows=self.last_rows
+        else:
+            in_rows=np.asarray(rows)
+            if in_rows.dtype != bool:
+                in_rows=np.zeros(self.N_data, dtype=bool)
+                in_rows[rows]=True
+        same_system=np.array_equal(in_rows, self.last_rows) and \
+            (row_scale is None or np.all(np.asarray(row_scale)[in_rows]==1))
+        if self.R is not None:
+            if same_system:
+                return self.R, self.R_perm, in_rows
+            return self.__reweighted_factor__(in_rows, row_scale) + (in_rows,)
+        if self.solver in ['cholmod_normal', 'schur']:
+            if not same_system:
+                self.__refactor__(in_rows, row_scale)
+            return self.factorization.R_factor() + (in_rows,)
+        return None
+
+    def __reweighted_factor__(self, in_rows, row_scale):
+        # Cholesky factor of the normal equations for a set of rows, with the
+        # data rows scaled by row_scale.  This replaces a second QR
+        # factorization of the reweighted system
+        rows=np.concatenate([np.flatnonzero(in_rows), self.constraint_rows])
+        scale=np.ones(self.G.shape[0])
+        if row_scale is not None:
+            scale[0:self.N_data]=row_scale
+        G=sp.diags(scale[rows]).dot(self.G[rows,:]).tocsc()
+        return normal_eq_factorization().factorize(G.T @ G).R_factor()
+
+    def __refactor__(self, in_rows, row_scale):
+        # factor the normal equations for a set of rows, with the rows scaled by row_scale
+        rows=np.flatnonzero(in_rows)
+        Gd=self.G[rows,:]
+        if row_scale is not None:
+            Gd=sp.diags(np.asarray(row_scale, dtype=float)[rows]).dot(Gd)
+        N_vals=self.__on_pattern__(Gd.T @ Gd) + self.__on_pattern__(self.Nc)
+        self.factorization.factorize(sp.csc_matrix((N_vals, self.N_indices, self.N_indptr),
+                                                   shape=(self.G.shape[1], self.G.shape[1])))
+        # the stored normal equations no longer match the factorization, so
+        # the next solution recalculates them
+        self.in_rows=None
+        self.last_rows=in_rows
+
+    def nuisance_sigma(self):
+        '''
+        posterior errors of the nuisance parameters from the last 'schur'
+        factorization (that of the last solution, or of the last call to
+        R_factor)
+
+        Returns
+        -------
+        cols : numpy array
+            columns of the nuisance parameters
+        sigma : numpy array
+            standard deviations of the nuisance parameters
+        '''
+        if self.solver != 'schur':
+            raise ValueError("nuisance_sigma is only available for the schur solver")
+        return self.factorization.ii_n, np.sqrt(self.factorization.nuisance_variance())
@@ -3,8 +3,8 @@ import numpy as np
 cimport numpy as np
 ITYPE=np.int32
 ctypedef np.int32_t ITYPE_t
-FTYPE=np.float
-ctypedef np.float_t FTYPE_t
+FTYPE=np.float64
+ctypedef np.float64_t FTYPE_t
 cimport cython
 @cython.boundscheck(False)
 
@@ -26,9 +26,9 @@ def spsolve_tr_upper(A, np.ndarray[FTYPE_t, ndim=1] b):
     .. copied from scipy version:: 0.19.0
     """
     # pull apart R and explicitly type the pieces
-    cdef np.ndarray[ITYPE_t, ndim=1] indptr=A.indptr    
-    cdef np.ndarray[ITYPE_t, ndim=1] indices=A.indices
-    cdef np.ndarray[FTYPE_t, ndim=1] data=A.data
+    cdef np.ndarray[ITYPE_t, ndim=1] indptr=np.asarray(A.indptr, dtype=ITYPE)
+    cdef np.ndarray[ITYPE_t, ndim=1] indices=np.asarray(A.indices, dtype=ITYPE)
+    cdef np.ndarray[FTYPE_t, ndim=1] data=np.asarray(A.data, dtype=FTYPE)
     # Result matrix
     cdef np.ndarray[FTYPE_t, ndim=1] x=b.copy()
     # temporary matrices and indexes
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Matrix-free operators for the finite-difference smoothness constraints
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spl
+from LSsurf.lin_op import lin_op, index_ranges, read_only
+
+''' Matrix-free linear operators for stencils on grids
+
+    The smoothness constraints (grad, grad2, grad_dzdt, grad2_dzdt, d2z_dt2)
+    apply the same stencil at every node of a grid.  A stencil_op stores the
+    stencil offsets and values instead of the r, c, and v arrays, and applies
+    them to a model vector with array slicing.
+
+    Contains:
+        stencil_op, weighted_linear_operator
+'''
+
+class stencil_op(lin_op):
+    '''
+    lin_op for translation-invariant stencils, applied without building the matrix
+
+    A stencil_op is made of blocks of equations.  Stencil blocks are built by
+    diff_op (with valid_equations_only=True and which_nodes=None), and keep
+    only the stencil and the range of central nodes.  Operators that are not
+    stencils can be stacked with stencil_ops with vstack, and are kept as
+    matrix blocks.
+
+    The matvec, rmatvec, and col_norm2 methods use the stencils directly.  If
+    the r, c, or v attributes are requested, the blocks are converted to
+    explicit triplets, and the operator behaves like a regular lin_op from
+    then on.
+    '''
+    def __init__(self, grid=None, row_0=0, col_N=None, col_0=None, name=None, v_dtype=None):
+        self.blocks=[]
+        super().__init__(grid=grid, row_0=row_0, col_N=col_N, col_0=col_0, name=name, v_dtype=v_dtype)
+
+    # r, c, and v are only built when they are asked for
+    def __materialize__(self):
+        # convert the blocks to r, c, v triplets, then combine them with any
+        # operators that have been added
+        if len(getattr(self, 'blocks', [])) == 0:
+            return super().__materialize__()
+        rr, cc, vv = [[], [], []]
+        for block in self.blocks:
+            if 'op' in block:
+                rr.append(block['op'].r.ravel()+block['row_0'])
+                cc.append(block['op'].c.ravel())
+                vv.append(block['op'].v.ravel())
+                continue
+            sub0s=[sub.ravel() for sub in np.meshgrid(*[np.arange(start, stop) for start, stop in
+                                                        zip(block['start'], block['stop'])], indexing='ij')]
+            N_terms=block['vals'].size
+            r=np.zeros((block['N_eq'], N_terms), dtype=int)
+            c=np.zeros((block['N_eq'], N_terms), dtype=int)
+            v=np.zeros((block['N_eq'], N_terms), dtype=float)
+            for ii in range(N_terms):
+                r[:,ii]=block['row_0']+np.arange(block['N_eq'], dtype=int)
+                c[:,ii]=block['grid'].global_ind([sub0+delta[ii] for sub0, delta in zip(sub0s, block['deltas'])])
+                v[:,ii]=block['vals'][ii]
+            rr.append(r.ravel())
+            cc.append(c.ravel())
+            vv.append(v.ravel())
+        self.blocks=[]
+        self._r, self._c, self._v = [np.concatenate(ii) for ii in [rr, cc, vv]]
+        super().__materialize__()
+
+    # ind0 is known without building the triplets, so reading or setting it
+    # does not convert the stencil blocks, unless operators have been added
+    @property
+    def ind0(self):
+        if len(self.blocks) > 0 and len(self._added)==0:
+            return read_only(self._ind0)
+        return lin_op.ind0.fget(self)
+
+    @ind0.setter
+    def ind0(self, val):
+        if len(self.blocks) > 0 and len(self._added)==0:
+            self._ind0=val
+        else:
+            lin_op.ind0.fset(self, val)
+
+    def diff_op(self, delta_subs, vals, which_nodes=None, valid_equations_only=True):
+        # build a stencil block.  Stencils restricted to a set of nodes, or
+        # truncated at the grid edges, are built as explicit lin_ops
+        if which_nodes is not None or not valid_equations_only:
+            return super().diff_op(delta_subs, vals, which_nodes=which_nodes,
+                                   valid_equations_only=valid_equations_only)
+        deltas=[np.asarray(delta_sub, dtype=int).ravel() for delta_sub in delta_subs]
+        start=[np.maximum(0, -np.min(delta)) for delta in deltas]
+        stop=[np.minimum(Ni, Ni-np.max(delta)) for Ni, delta in zip(self.grid.shape, deltas)]
+        stop=[np.maximum(this_start, this_stop) for this_start, this_stop in zip(start, stop)]
+        self.N_eq=int(np.prod([this_stop-this_start for this_start, this_stop in zip(start, stop)]))
+        self.blocks=[{'row_0':self.row_0, 'N_eq':self.N_eq, 'grid':self.grid, 'deltas':deltas,
+                      'vals':np.array([np.asarray(val).ravel()[0] for val in vals], dtype=float),
+                      'start':start, 'stop':stop}]
+        self._r, self._c, self._v = [None, None, None]
+        self._csr={}
+        sub0s=np.meshgrid(*[np.arange(this_start, this_stop) for this_start, this_stop in zip(start, stop)], indexing='ij')
+        self.ind0 = self.grid.global_ind([sub.ravel() for sub in sub0s]).ravel()
+        self.TOC['rows'] = {self.name:index_ranges(0, self.N_eq)}
+        self.TOC['cols'] = {self.grid.name:index_ranges(self.grid.col_0, self.grid.col_0+self.grid.N_nodes)}
+        self.__update_size_and_shape__()
+        return self
+
+    def vstack(self, ops, order=None, name=None, TOC_cols=None):
+        # stack operators, keeping the stencil blocks of any stencil_ops
+        if isinstance(ops, lin_op):
+            ops=(self, ops)
+        if order is None:
+            order=range(len(ops))
+        if not any(isinstance(op, stencil_op) and len(op.blocks) > 0 for op in ops):
+            return super().vstack(ops, order=order, name=name, TOC_cols=TOC_cols)
+        # the sizes of the operators are needed before self is overwritten
+        N_eqs=[ops[ind].N_eq for ind in order]
+        row_0s=self.__vstack_TOC__(ops, order, name=name, TOC_cols=TOC_cols)
+        blocks=[]
+        for ind, row_0, N_eq in zip(order, row_0s, N_eqs):
+            op=ops[ind]
+            if isinstance(op, stencil_op) and len(op.blocks) > 0:
+                for block in op.blocks:
+                    blocks.append(dict(block, row_0=block['row_0']+row_0))
+            else:
+                if op is self:
+                    # keep a copy of this operator's current entries
+                    self.__materialize__()
+                    op=lin_op(col_N=self.col_N)
+                    op.r, op.c, op.v, op.N_eq = [self._r, self._c, self._v, N_eq]
+                blocks.append({'row_0':row_0, 'N_eq':N_eq, 'op':op})
+        self.blocks=blocks
+        self._r, self._c, self._v = [None, None, None]
+        self._csr={}
+        self.__update_size_and_shape__()
+        return self
+
+    def __block_csr__(self, block):
+        if 'csr' not in block:
+            block['csr']=block['op'].toCSR(row_N=block['N_eq'], col_N=self.col_N)
+        return block['csr']
+
+    def __slices__(self, block, ii):
+        # slices of the grid that are multiplied by the ii-th stencil value
+        return tuple([slice(start+delta[ii], stop+delta[ii]) for start, stop, delta in
+                      zip(block['start'], block['stop'], block['deltas'])])
+
+    def __box_shape__(self, block):
+        return tuple([stop-start for start, stop in zip(block['start'], block['stop'])])
+
+    def matvec(self, x, row_weight=None):
+        '''
+        multiply the operator by a vector
+
+        Parameters
+        ----------
+        x : numpy array
+            model vector, of length self.col_N
+        row_weight : numpy array, optional
+            if specified, each row of the result is multiplied by this value
+            (e.g. 1/expected, or the output of mask_for_ind0)
+
+        Returns
+        -------
+        y : numpy array
+            result, of length self.N_eq
+        '''
+        if len(self.blocks)==0:
+            y=self.toCSR(row_N=self.N_eq, col_N=self.col_N).dot(x)
+        else:
+            y=np.zeros(self.N_eq)
+            for block in self.blocks:
+                rows=slice(block['row_0'], block['row_0']+block['N_eq'])
+                if 'op' in block:
+                    y[rows]=self.__block_csr__(block).dot(x)
+                    continue
+                grid=block['grid']
+                X=x[grid.col_0:grid.col_0+grid.N_nodes].reshape(grid.shape)
+                Y=np.zeros(self.__box_shape__(block))
+                for ii, val in enumerate(block['vals']):
+                    Y += val*X[self.__slices__(block, ii)]
+                y[rows]=Y.ravel()
+        if row_weight is not None:
+            y *= row_weight
+        return y
+
+    def rmatvec(self, y, row_weight=None, vals_power=1):
+        '''
+        multiply the transpose of the operator by a vector
+
+        Parameters
+        ----------
+        y : numpy array
+            vector of length self.N_eq
+        row_weight : numpy array, optional
+            if specified, y is multiplied by this value before the product
+        vals_power : int, optional
+            power to which the operator's values are raised. The default is 1.
+
+        Returns
+        -------
+        x : numpy array
+            result, of length self.col_N
+        '''
+        if row_weight is not None:
+            y=y*row_weight
+        if len(self.blocks)==0:
+            csr=self.toCSR(row_N=self.N_eq, col_N=self.col_N)
+            if vals_power != 1:
+                csr=csr.power(vals_power)
+            return csr.T.dot(y)
+        x=np.zeros(self.col_N)
+        for block in self.blocks:
+            rows=slice(block['row_0'], block['row_0']+block['N_eq'])
+            if 'op' in block:
+                csr=self.__block_csr__(block)
+                if vals_power != 1:
+                    csr=csr.power(vals_power)
+                x += csr.T.dot(y[rows])
+                continue
+            grid=block['grid']
+            X=np.zeros(grid.shape)
+            Y=y[rows].reshape(self.__box_shape__(block))
+            for ii, val in enumerate(block['vals']):
+                X[self.__slices__(block, ii)] += val**vals_power*Y
+            x[grid.col_0:grid.col_0+grid.N_nodes] += X.ravel()
+        return x
+
+    def col_norm2(self, row_weight=None):
+        '''
+        calculate the squared norm of each column of the (row-weighted) operator
+        '''
+        w2=np.ones(self.N_eq)
+        if row_weight is not None:
+            w2=row_weight**2
+        return self.rmatvec(w2, vals_power=2)
+
+def weighted_linear_operator(op, row_weight=None, Ip_c=None):
+    '''
+    make a scipy LinearOperator for diag(row_weight) * op * Ip_c
+
+    Parameters
+    ----------
+    op : lin_op or stencil_op
+        operator.  stencil_ops are applied without building their matrices.
+    row_weight : numpy array, optional
+        weight for each row of op (e.g. 1/op.expected, optionally multiplied
+        by op.mask_for_ind0(mask_scale))
+    Ip_c : scipy.sparse matrix, optional
+        matrix that maps a reduced model vector to the columns of op
+
+    Returns
+    -------
+    A : scipy.sparse.linalg.LinearOperator
+        the operator.  A.col_norm2 contains the squared column norms of A.
+    '''
+    if not isinstance(op, stencil_op):
+        csr=op.toCSR(row_N=op.N_eq, col_N=op.col_N)
+        if row_weight is not None:
+            csr=sp.diags(row_weight).dot(csr)
+        if Ip_c is not None:
+            csr=csr.dot(Ip_c)
+        A=spl.aslinearoperator(csr)
+        A.col_norm2=np.asarray(csr.power(2).sum(axis=0)).ravel()
+        return A
+    if Ip_c is None:
+        Ip_c=sp.eye(op.col_N, format='csr')
+    Ip_c=sp.csr_matrix(Ip_c)
+    Ip_cT=Ip_c.T.tocsr()
+    A=spl.LinearOperator((op.N_eq, Ip_c.shape[1]), dtype=float,
+                         matvec=lambda x: op.matvec(Ip_c.dot(np.ravel(x)), row_weight=row_weight),
+                         rmatvec=lambda y: Ip_cT.dot(op.rmatvec(np.ravel(y), row_weight=row_weight)))
+    A.col_norm2=Ip_cT.dot(op.col_norm2(row_weight=row_weight))
+    return A
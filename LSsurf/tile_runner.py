@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run smooth_fit over a set of tiles in a process pool
+"""
+
+import numpy as np
+import os
+import csv
+import resource
+from time import time, sleep, ctime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from LSsurf.smooth_fit import smooth_fit
+from LSsurf.solver_functions import available_memory
+
+''' Run smooth_fit for a set of tiles in a pool of processes
+
+    Each tile is fit in its own worker process.  The number of tiles that run
+    at once is limited by the number of workers and by a memory budget, tiles
+    whose output files exist are skipped, failed tiles are retried after a
+    delay that doubles with each attempt, and the status and timing of each
+    attempt is written to a ledger file.
+
+    Tiles that are matched to the edges of their neighbors (with
+    smooth_fit's prior_edge_args) can be run in waves: the tiles are colored
+    by the parity of their column and row on the tile lattice, so that no two
+    adjacent tiles share a color, and each tile is matched only to the
+    neighbors that have colors earlier than its own.  A tile starts as soon
+    as those neighbors have finished, so the set of neighbors that each tile
+    sees does not depend on the run order.
+
+    Contains:
+        run_tiles, run_tile, tile_waves, estimate_tile_memory, tile_filename
+'''
+
+ledger_fields=['x', 'y', 'out_file', 'status', 'attempt', 'start', 'elapsed', 'peak_memory', 'message']
+
+def tile_filename(xy0, out_dir='.', file_template='E%d_N%d.h5'):
+    '''
+    return the output filename for the tile centered at xy0 (in m)
+    '''
+    return os.path.join(out_dir, file_template % (xy0[0]/1000, xy0[1]/1000))
+
+def estimate_tile_memory(fit_args, N_data=None):
+    '''
+    rough estimate of the peak memory (in bytes) needed to fit one tile
+
+    The number of model columns is calculated from fit_args['W'] and
+    fit_args['spacing'].  The triangular factor is assumed to have the fill of
+    a banded matrix whose bandwidth is one horizontal slice of the dz grid for
+    every epoch (see solver_functions.estimate_fill), and each data point is
+    assumed to contribute 8 nonzeros (the z0 and dz interpolation weights).
+
+    Parameters
+    ----------
+    fit_args : dict
+        arguments for smooth_fit.  Must contain 'W' and 'spacing'
+    N_data : int, optional
+        number of data in the tile.  If None, one data point per z0 node is assumed.
+
+    Returns
+    -------
+    float
+        estimated memory, in bytes
+    '''
+    W, spacing = [fit_args['W'], fit_args['spacing']]
+    N_z0=np.prod([W[coord]/spacing['z0']+1 for coord in ['x','y']])
+    N_xy=np.prod([W[coord]/spacing['dz']+1 for coord in ['x','y']])
+    N_t=W['t']/spacing['dt']+1
+    N_cols=N_z0+N_xy*N_t
+    if N_data is None:
+        N_data=N_z0
+    fill=N_cols*np.sqrt(N_xy)*N_t
+    return 16.*(fill + 8*N_data + N_cols)
+
+def tile_waves(tiles, tile_spacing):
+    '''
+    assign tiles to waves, and find the neighbors on which each tile depends
+
+    Each tile is given a color, (i mod 2, j mod 2), where i and j are the
+    column and row of the tile on a lattice with spacing tile_spacing.  No
+    two adjacent tiles (including diagonal neighbors) have the same color.
+    The colors are numbered 0 to 3, and each tile depends on the adjacent
+    tiles with lower numbers.
+
+    Parameters
+    ----------
+    tiles : iterable
+        x, y coordinates of the tile centers
+    tile_spacing : float
+        distance between tile centers
+
+    Returns
+    -------
+    wave : dict
+        wave number (0-3) for each tile, keyed by (x, y)
+    depends_on : dict
+        list of the adjacent tiles in earlier waves, keyed by (x, y).  These
+        may include tiles that are not in the list of tiles.
+    '''
+    tiles=[tuple(xy0) for xy0 in tiles]
+    wave={}
+    depends_on={}
+    for xy0 in tiles:
+        # round halves up: np.round rounds them to the nearest even number,
+        # which puts adjacent tiles centered on half spacings in the same wave
+        ij=[int(np.floor(coord/tile_spacing+0.5)) for coord in xy0]
+        wave[xy0]=2*(ij[0] % 2) + (ij[1] % 2)
+        depends_on[xy0]=[]
+        for di in [-1, 0, 1]:
+            for dj in [-1, 0, 1]:
+                if di==0 and dj==0:
+                    continue
+                this_wave=2*((ij[0]+di) % 2) + ((ij[1]+dj) % 2)
+                if this_wave < wave[xy0]:
+                    depends_on[xy0].append((xy0[0]+di*tile_spacing, xy0[1]+dj*tile_spacing))
+    return wave, depends_on
+
+def run_tile(xy0, fit_args, read_data, save_function, out_file):
+    '''
+    read the data for a tile, fit it with smooth_fit, and save the result
+
+    Parameters
+    ----------
+    xy0 : iterable
+        x and y coordinates of the tile center
+    fit_args : dict
+        arguments for smooth_fit, except for 'data'. The tile center is
+        written into fit_args['ctr']
+    read_data : callable
+        function that takes (xy0, fit_args) and returns a pointCollection.data
+        object for the tile
+    save_function : callable
+        function that takes (S, out_file), where S is the output of smooth_fit
+    out_file : str
+        output file
+
+    Returns
+    -------
+    dict
+        'status' ('done', or 'no data' if smooth_fit returned no data),
+        'timing' (the smooth_fit timing dict), and 'peak_memory' (the peak
+        resident memory of the worker, in bytes)
+    '''
+    fit_args=fit_args.copy()
+    fit_args['ctr']=dict(fit_args['ctr'], x=xy0[0], y=xy0[1])
+    fit_args['data']=read_data(xy0, fit_args)
+    S=smooth_fit(**fit_args)
+    status='done'
+    if S['data'] is None or S['data'].size==0:
+        status='no data'
+    else:
+        save_function(S, out_file)
+    # ru_maxrss is in kB on linux
+    return {'status':status, 'timing':S['timing'],
+            'peak_memory':1024.*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def new_pool(max_workers):
+    # each worker runs one tile, so that its memory is returned after each tile
+    # and its peak memory measures only that tile
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=1)
+    except TypeError:
+        # python < 3.11
+        return ProcessPoolExecutor(max_workers=max_workers)
+
+def run_tiles(tiles, fit_args, read_data, save_function, out_dir='.',
+              file_template='E%d_N%d.h5', max_workers=None, max_memory=None,
+              tile_memory=None, replace=False, max_retries=2, retry_delay=30.,
+              ledger_file=None, tile_spacing=None, verbose=False):
+    '''
+    fit a set of tiles with smooth_fit in a pool of worker processes
+
+    Parameters
+    ----------
+    tiles : iterable
+        x, y coordinates of the tile centers
+    fit_args : dict
+        arguments for smooth_fit, except for 'data'.  fit_args['ctr'] must
+        contain 't'; 'x' and 'y' are set for each tile.
+    read_data : callable
+        function that takes (xy0, fit_args) and returns the data for a tile.
+        Must be defined at the top level of a module so that it can be sent
+        to the worker processes.
+    save_function : callable
+        function that takes (S, out_file) and writes the smooth_fit output S.
+        Must be defined at the top level of a module.
+    out_dir : str, optional
+        directory for the output files. The default is '.'.
+    file_template : str, optional
+        template for the output filenames, formatted with the tile center in
+        km. The default is 'E%d_N%d.h5'.
+    max_workers : int, optional
+        maximum number of worker processes.  The default is os.cpu_count().
+    max_memory : float, optional
+        memory budget (in bytes) for all the workers.  If specified, each
+        tile's solver is limited to its share of the budget,
+        max_memory/max_workers, or to fit_args['max_solve_memory'] if that is
+        smaller (see solver_functions.choose_solver).  If None, the available
+        memory is used to schedule the tiles, and the solvers are limited
+        only by fit_args['max_solve_memory'].
+    tile_memory : float, optional
+        memory estimate for each tile, in bytes.  If None, estimate_tile_memory
+        is used.  Whenever a tile finishes with a larger peak memory than the
+        estimate, the estimate is increased to that value.
+    replace : bool, optional
+        if True, tiles whose output files exist are fit again. The default is False.
+    max_retries : int, optional
+        number of times a failed tile is retried. The default is 2.
+    retry_delay : float, optional
+        delay before the first retry, in seconds.  The delay doubles with
+        each retry.  The default is 30.
+    ledger_file : str, optional
+        csv file to which the status and timing of each attempt is appended.
+        The default is 'tile_ledger.csv' in out_dir.
+    tile_spacing : float, optional
+        if specified, the tiles are run in waves (see tile_waves).  A tile is
+        not started until the adjacent tiles in earlier waves have finished,
+        and if fit_args['prior_edge_args'] is specified, the tile's edges
+        are matched only to the output files of those tiles.  The default is
+        None.
+    verbose : bool, optional
+        if True, report the progress. The default is False.
+
+    Returns
+    -------
+    dict
+        final status for each tile, keyed by (x, y)
+    '''
+    if max_workers is None:
+        max_workers=os.cpu_count()
+    if tile_memory is None:
+        tile_memory=estimate_tile_memory(fit_args)
+    if ledger_file is None:
+        ledger_file=os.path.join(out_dir, 'tile_ledger.csv')
+    fit_args=fit_args.copy()
+    if max_memory is not None:
+        # if a budget is specified, each tile's solver has to fit in the
+        # tile's share of the budget
+        solve_memory=fit_args.get('max_solve_memory', None)
+        if solve_memory=='available':
+            solve_memory=available_memory()
+        if solve_memory is None:
+            fit_args['max_solve_memory']=max_memory/max_workers
+        else:
+            fit_args['max_solve_memory']=np.minimum(solve_memory, max_memory/max_workers)
+    if max_memory is None:
+        max_memory=available_memory()
+
+    new_ledger=not os.path.isfile(ledger_file)
+    ledger_fh=open(ledger_file,'a', newline='')
+    ledger=csv.DictWriter(ledger_fh, fieldnames=ledger_fields)
+    if new_ledger:
+        ledger.writeheader()
+    def log(xy0, out_file, status, attempt, start, peak_memory=np.nan, message=''):
+        ledger.writerow({'x':xy0[0], 'y':xy0[1], 'out_file':out_file, 'status':status,
+                         'attempt':attempt, 'start':ctime(start), 'elapsed':'%3.2f' % (time()-start),
+                         'peak_memory':'%3.3g' % peak_memory, 'message':message})
+        ledger_fh.flush()
+        if verbose:
+            print(f"tile_runner: {out_file} {status} (attempt {attempt}) {message}", flush=True)
+
+    status={}
+    if tile_spacing is None:
+        depends_on={}
+    else:
+        _, depends_on = tile_waves(tiles, tile_spacing)
+    # queue of [ready time, attempt, xy0]
+    queue=[]
+    for xy0 in tiles:
+        xy0=tuple(xy0)
+        out_file=tile_filename(xy0, out_dir=out_dir, file_template=file_template)
+        if not replace and os.path.isfile(out_file):
+            status[xy0]='skipped'
+            log(xy0, out_file, 'skipped', 0, time())
+            continue
+        queue.append([0., 0, xy0])
+
+    # tiles that are in this run, and that have not finished
+    pending=set([item[2] for item in queue])
+    def ready(item):
+        # tiles that are not in this run count as finished
+        return not any(dep in pending for dep in depends_on.get(item[2], []))
+
+    pool=new_pool(max_workers)
+    running={}
+    try:
+        while len(queue) > 0 or len(running) > 0:
+            # submit the tiles that are ready, as long as they fit in the budget
+            now=time()
+            for item in [item for item in queue if item[0] <= now and ready(item)]:
+                if len(running) >= max_workers:
+                    break
+                if max_memory is not None and len(running) > 0 and \
+                        (len(running)+1)*tile_memory > max_memory:
+                    break
+                queue.remove(item)
+                _, attempt, xy0 = item
+                out_file=tile_filename(xy0, out_dir=out_dir, file_template=file_template)
+                this_fit_args=fit_args
+                if xy0 in depends_on and fit_args.get('prior_edge_args', None) is not None:
+                    # match the edges of the finished neighbors in earlier waves
+                    prior_files=[tile_filename(dep, out_dir=out_dir, file_template=file_template)
+                                 for dep in depends_on[xy0]]
+                    this_fit_args=dict(fit_args, prior_edge_args=dict(fit_args['prior_edge_args'],
+                        prior_files=[file for file in prior_files if os.path.isfile(file)]))
+                future=pool.submit(run_tile, xy0, this_fit_args, read_data, save_function, out_file)
+                running[future]=(xy0, attempt, time(), out_file, pool)
+            if len(running)==0:
+                # wait for the next retry
+                sleep(np.maximum(0, np.min([item[0] for item in queue if ready(item)])-time()))
+                continue
+            done, _ = wait(list(running.keys()), timeout=1., return_when=FIRST_COMPLETED)
+            for future in done:
+                xy0, attempt, start, out_file, this_pool = running.pop(future)
+                try:
+                    result=future.result()
+                    status[xy0]=result['status']
+                    pending.discard(xy0)
+                    tile_memory=np.maximum(tile_memory, result['peak_memory'])
+                    log(xy0, out_file, result['status'], attempt, start,
+                        peak_memory=result['peak_memory'],
+                        message=' '.join([f"{key}={val:3.1f}" for key, val in result['timing'].items()
+                                          if np.isscalar(val)]))
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool) and this_pool is pool:
+                        # a worker died (e.g. it was killed for using too
+                        # much memory). The pool has to be replaced
+                        pool.shutdown(wait=False)
+                        pool=new_pool(max_workers)
+                    if attempt < max_retries:
+                        status[xy0]='retry'
+                        queue.append([time()+retry_delay*2**attempt, attempt+1, xy0])
+                    else:
+                        status[xy0]='failed'
+                        pending.discard(xy0)
+                    log(xy0, out_file, status[xy0], attempt, start, message=repr(e))
+    finally:
+        pool.shutdown(wait=True)
+        ledger_fh.close()
+    return status
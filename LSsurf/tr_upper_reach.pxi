@@ -0,0 +1,38 @@
+# Reach of a column of the inverse of an upper-triangular matrix.  Included by
+# inv_tr_upper.pyx and propagate_qz_errors.pyx, which define ITYPE_t and LTYPE_t
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef Py_ssize_t reach(ITYPE_t[:] Cp, ITYPE_t[:] Ci, Py_ssize_t col, LTYPE_t[:] mark,
+                      LTYPE_t[:] stack, LTYPE_t[:] pstack, LTYPE_t[:] xi) nogil:
+    # find the rows of R x = e_col for which x can be nonzero, by a depth-first
+    # search from col in the graph of the columns of R (row i depends on row j
+    # if R[i,j] != 0).  The rows are written to xi[top:N] in an order in which
+    # they can be calculated, and top is returned.  Rows that have been
+    # visited are marked with mark[i]=col, so mark does not need to be reset
+    cdef Py_ssize_t head, top, i, j, p, done
+    top=xi.shape[0]
+    head=0
+    stack[0]=col
+    while head >= 0:
+        j=stack[head]
+        if mark[j] != col:
+            mark[j]=col
+            pstack[head]=Cp[j]
+        done=1
+        for p in range(pstack[head], Cp[j+1]):
+            i=Ci[p]
+            if i >= j or mark[i]==col:
+                continue
+            # descend to row i, and continue with row j's next entry later
+            pstack[head]=p+1
+            head=head+1
+            stack[head]=i
+            done=0
+            break
+        if done:
+            head=head-1
+            top=top-1
+            xi[top]=j
+    return top
@@ -53,10 +53,19 @@ setup_requires=[
     'cython',
 ]
 # cythonize extensions
+# inv_tr_upper runs in parallel with OpenMP (Apple's clang does not support -fopenmp)
+if sys.platform == 'darwin':
+    openmp_args=[]
+else:
+    openmp_args=['-fopenmp']
 ext_modules=[
-    Extension('LSsurf.inv_tr_upper', sources=['LSsurf/inv_tr_upper.pyx']),
-    Extension('LSsurf.propagate_qz_errors', sources=['LSsurf/propagate_qz_errors.pyx']),
-    Extension('LSsurf.spsolve_tr_upper', sources=['LSsurf/spsolve_tr_upper.pyx'])
+    Extension('LSsurf.inv_tr_upper', sources=['LSsurf/inv_tr_upper.pyx'],
+              depends=['LSsurf/tr_upper_reach.pxi'],
+              extra_compile_args=openmp_args, extra_link_args=openmp_args),
+    Extension('LSsurf.propagate_qz_errors', sources=['LSsurf/propagate_qz_errors.pyx'],
+              depends=['LSsurf/tr_upper_reach.pxi']),
+    Extension('LSsurf.spsolve_tr_upper', sources=['LSsurf/spsolve_tr_upper.pyx']),
+    Extension('LSsurf.selected_inverse', sources=['LSsurf/selected_inverse.pyx'])
 ]
 
 setup(
@@ -0,0 +1,54 @@
+import numpy as np
+import scipy.sparse as sp
+import pointCollection as pc
+from LSsurf.fd_grid import fd_grid
+from LSsurf.lin_op import lin_op
+from LSsurf.smooth_fit import smooth_fit
+
+def make_R(N=300, density=0.01, seed=0):
+    # sparse, well-conditioned upper-triangular matrix
+    rng=np.random.default_rng(seed)
+    R=sp.triu(sp.random(N, N, density=density, random_state=seed), k=1)
+    return (R+sp.diags(rng.uniform(1, 2, N))).tocsr()
+
+def test_error_variance_from_R():
+    # the variances of the rows of an averaging operator, found with
+    # triangular solves, match those from the dense covariance matrix
+    grid=fd_grid([[0., 1400.], [0., 1900.]], [100., 100.], name='z')
+    op=lin_op(grid, name='avg').diff_op(([0, 0, 1, 1], [0, 1, 0, 1]), np.zeros(4)+0.25)
+    R=make_R(N=grid.N_nodes)
+    perm=np.random.default_rng(1).permutation(R.shape[0])
+    # the parameters of R are in the order given by perm
+    C=np.zeros(R.shape)
+    C[np.ix_(perm, perm)]=np.linalg.inv(R.T.dot(R).toarray())
+    A=op.toCSR(row_N=op.N_eq, col_N=grid.N_nodes).toarray()
+    assert np.allclose(op.error_variance_from_R(R, perm, N_batch=50), np.diag(A @ C @ A.T), rtol=1.e-10)
+
+def make_data(N=800, seed=1):
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)+rng.normal(0, 0.1, N)
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1})
+
+def fit(compute_E):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=make_data(), ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.},
+                      spacing={'z0':250., 'dz':500., 'dt':0.5}, E_RMS=E_RMS,
+                      reference_epoch=2, max_iterations=5, compute_E=compute_E,
+                      VERBOSE=False, dzdt_lags=[1, 2], avg_scales=[2000.])
+
+def test_avg_op_errors():
+    # the averaging-operator errors from triangular solves match those from
+    # the full inverse of R.  The full inverse drops entries smaller than
+    # 1e-5, so its errors are slightly smaller
+    S_full=fit('full')
+    S=fit('selected')
+    keys=['sigma_dzdt_lag1', 'sigma_dzdt_lag2', 'sigma_avg_dz_2000m',
+          'sigma_avg_dzdt_2000m_lag1', 'sigma_avg_dzdt_2000m_lag2']
+    for key in keys:
+        E, E_full = getattr(S['E'][key], key), getattr(S_full['E'][key], key)
+        assert np.any(np.isfinite(E))
+        assert np.allclose(E, E_full, rtol=1.e-3, equal_nan=True)
@@ -0,0 +1,41 @@
+import numpy as np
+import pointCollection as pc
+from LSsurf.smooth_fit import smooth_fit
+
+def make_data(N=800, seed=1):
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)+rng.normal(0, 0.1, N)
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1})
+
+def fit(data, spacing, **kwargs):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=data, ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.}, spacing=spacing, E_RMS=E_RMS,
+                      reference_epoch=2, VERBOSE=False, **kwargs)
+
+def test_coarse_errors():
+    # with error_res_scale=2, the coarse-node errors are those of a full error
+    # calculation on grids with twice the z0 and dz spacing
+    spacing={'z0':250., 'dz':1000., 'dt':0.5}
+    S=fit(make_data(), spacing, max_iterations=5, compute_E='full', error_res_scale=2)
+
+    # repeat the error calculation on the coarse grids with the editing of the fine fit
+    coarse_spacing={'z0':500., 'dz':2000., 'dt':0.5}
+    S_c=fit(S['data'].copy(), coarse_spacing, max_iterations=0, compute_E='full')
+    for key in ['sigma_z0', 'sigma_dz']:
+        E, E_c = S['E'][key+'_coarse'], S_c['E'][key]
+        assert np.array_equal(E.x, E_c.x) and np.array_equal(E.y, E_c.y)
+        assert np.allclose(getattr(E, key), getattr(E_c, key), rtol=1.e-8, equal_nan=True)
+
+    # the native-grid maps are the coarse maps interpolated to the fit nodes.
+    # The coarse nodes are every second fine node, so they match there
+    S_f=fit(S['data'].copy(), spacing, max_iterations=0, compute_E='full')
+    for key in ['sigma_z0', 'sigma_dz']:
+        E, E_c, E_f = S['E'][key], S['E'][key+'_coarse'], S_f['E'][key]
+        assert np.array_equal(E.x, E_f.x) and np.array_equal(E.y, E_f.y)
+        assert getattr(E, key).shape==getattr(E_f, key).shape
+        assert np.all(np.isfinite(getattr(E, key)))
+        assert np.allclose(getattr(E, key)[::2, ::2], getattr(E_c, key), rtol=1.e-8)
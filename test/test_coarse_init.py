@@ -0,0 +1,33 @@
+import numpy as np
+import pointCollection as pc
+from LSsurf.smooth_fit import smooth_fit
+
+def make_data(N=800, seed=1):
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)+rng.normal(0, 0.1, N)
+    # add some blunders for the editing to find
+    z[::40] += 5
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1})
+
+def fit(**kwargs):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=make_data(), ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.},
+                      spacing={'z0':250., 'dz':1000., 'dt':0.5}, E_RMS=E_RMS,
+                      reference_epoch=2, max_iterations=10, VERBOSE=False, **kwargs)
+
+def test_coarse_initialization():
+    # initializing from a coarse solution finds the blunders, and converges
+    # to nearly the same editing and surface as a fit started from scratch.
+    # Points close to the three-sigma threshold can be edited differently
+    S=fit()
+    S_c=fit(coarse_scale=2)
+    assert 'coarse' in S_c['timing']
+    assert not np.any(S_c['data'].three_sigma_edit[::40])
+    assert np.mean(S['data'].three_sigma_edit != S_c['data'].three_sigma_edit) < 0.01
+    for key in ['z0', 'dz']:
+        z, z_c = getattr(S['m'][key], key), getattr(S_c['m'][key], key)
+        assert np.sqrt(np.nanmean((z_c-z)**2)) < 0.05*np.nanstd(z)
@@ -0,0 +1,36 @@
+import warnings
+import numpy as np
+import pointCollection as pc
+from LSsurf.smooth_fit import smooth_fit
+
+def make_data(N=800, seed=1):
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)+rng.normal(0, 0.1, N)
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1})
+
+def fit(compute_E, **kwargs):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=make_data(), ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.},
+                      spacing={'z0':250., 'dz':1000., 'dt':0.5}, E_RMS=E_RMS,
+                      reference_epoch=2, max_iterations=5, compute_E=compute_E,
+                      VERBOSE=False, dzdt_lags=[1], **kwargs)
+
+def test_probe_estimate():
+    # the default probe estimate runs without warnings, has finite
+    # estimator variances, and mostly agrees with the full calculation
+    # to within its reported standard error
+    S_full=fit('full')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        S=fit('estimate')
+    for key in ['sigma_z0', 'sigma_dz']:
+        E, E_full = getattr(S['E'][key], key), getattr(S_full['E'][key], key)
+        E_var=getattr(S['E'][key], key+'_estimator_var')
+        assert np.all(np.isfinite(E_var)) and np.all(E_var >= 0)
+        assert np.mean(np.abs(E-E_full) <= 3*np.sqrt(E_var)) > 0.9
+        nz=E_full > 0
+        assert np.all(np.abs(E[nz]/E_full[nz]-1) < 0.4)
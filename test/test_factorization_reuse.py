@@ -0,0 +1,46 @@
+import numpy as np
+import pointCollection as pc
+import sparseqr
+from LSsurf.smooth_fit import smooth_fit
+from LSsurf.solver_functions import fit_system
+
+def make_data(N=800, noise=0.2, seed=1):
+    # data whose noise is larger than their errors, so that sigma_extra is
+    # nonzero, and the errors are calculated with new weights
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)+rng.normal(0, noise, N)
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1})
+
+def fit(solver):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=make_data(), ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.},
+                      spacing={'z0':250., 'dz':1000., 'dt':0.5}, E_RMS=E_RMS,
+                      reference_epoch=2, max_iterations=5, compute_E=True,
+                      solver=solver, VERBOSE=False, dzdt_lags=[1])
+
+def test_spqr_factorization_reuse(monkeypatch):
+    # with the default solver, the system kept from the final solution is
+    # reweighted for the errors, and is not factored again with QR
+    calls=[]
+    rz=sparseqr.rz
+    def counted_rz(*args, **kwargs):
+        calls.append(args[0].shape)
+        return rz(*args, **kwargs)
+    monkeypatch.setattr(sparseqr, 'rz', counted_rz)
+    S=fit('spqr')
+    assert np.all(S['data'].sigma_extra > 0)
+    assert 'decompose_qz' not in S['timing']
+    N_solves=len(calls)
+    # without the kept system, the errors need one more QR factorization
+    calls.clear()
+    monkeypatch.setattr(fit_system, 'R_factor', lambda self, **kwargs: None)
+    S_qr=fit('spqr')
+    assert 'decompose_qz' in S_qr['timing'] and len(calls)==N_solves+1
+    # the normal equations square the condition number of the system, so
+    # the errors agree to a relative tolerance of 1e-4
+    for key in ['sigma_z0', 'sigma_dz', 'sigma_dzdt_lag1']:
+        assert np.allclose(getattr(S['E'][key], key), getattr(S_qr['E'][key], key), rtol=1.e-4, equal_nan=True)
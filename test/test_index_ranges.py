@@ -0,0 +1,42 @@
+import numpy as np
+from LSsurf.fd_grid import fd_grid
+from LSsurf.lin_op import lin_op, index_ranges
+from LSsurf.op_structure_checks import op_field_rc, complete_TOC_col, complete_TOC_row
+
+def test_sequence_methods():
+    inds=index_ranges([2, 10, 20], [5, 12, 23])
+    arr=np.array([2, 3, 4, 10, 11, 20, 21, 22])
+    assert len(inds)==arr.size
+    assert list(inds)==list(arr)
+    assert [inds[ii] for ii in range(-arr.size, arr.size)]==list(arr[np.r_[0:arr.size, 0:arr.size]])
+    assert np.array_equal(inds[1:6], arr[1:6])
+    assert np.array_equal(inds[::2], arr[::2])
+    assert np.array_equal(inds[[0, 7]], arr[[0, 7]])
+    assert np.array_equal(inds[arr > 4], arr[arr > 4])
+    # a slice of a single range is a range
+    assert isinstance(index_ranges(5, 15)[2:4], index_ranges)
+    assert np.array_equal(index_ranges(5, 15)[2:4], [7, 8])
+
+def make_ops():
+    z0=fd_grid([[0., 400.], [0., 600.]], [100., 100.], name='z0')
+    dz=fd_grid([[0., 400.], [0., 600.], [0., 2.]], [200., 200., 1.], name='dz',
+               col_0=z0.N_nodes)
+    d2x=lin_op(z0, name='d2z0_dx2').diff_op(([0, 0, 0], [-1, 0, 1]), np.array([1., -2., 1.]))
+    d2t=lin_op(dz, name='d2z_dt2').diff_op(([0, 0, 0], [0, 0, 0], [-1, 0, 1]), np.array([1., -2., 1.]))
+    G=lin_op(col_N=dz.col_0+dz.N_nodes, name='G').vstack([d2x, d2t])
+    return z0, dz, G
+
+def test_TOC_call_sites():
+    z0, dz, G = make_ops()
+    assert isinstance(G.TOC['cols']['z0'], index_ranges)
+    # indexing a model vector with the TOC entries
+    m0=np.arange(G.col_N, dtype=float)
+    assert np.array_equal(m0[G.TOC['cols']['z0']], np.arange(z0.N_nodes))
+    assert np.array_equal(m0[G.TOC['cols']['dz']], z0.N_nodes+np.arange(dz.N_nodes))
+    # selecting rows of the sparse matrix with the TOC entries (as in op_field_rc)
+    rows=np.asarray(G.TOC['rows']['d2z_dt2'])
+    assert (G.toCSR()[G.TOC['rows']['d2z_dt2'], :] != G.toCSR()[rows, :]).nnz==0
+    assert op_field_rc(G, 'd2z_dt2', ['dz'])
+    assert not op_field_rc(G, 'd2z_dt2', ['z0'])
+    assert complete_TOC_col(G, ['z0', 'dz'])[0]
+    assert complete_TOC_row(G, ['d2z0_dx2', 'd2z_dt2'])[0]
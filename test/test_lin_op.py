@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+from LSsurf.fd_grid import fd_grid
+from LSsurf.lin_op import lin_op, index_dtype
+
+def make_grid(name='z0', col_0=0):
+    return fd_grid([[0., 400.], [0., 600.]], [100., 100.], name=name, col_0=col_0)
+
+def test_entries_are_read_only():
+    # in-place changes to the entries would not reset the stored matrices,
+    # so they raise an error
+    op=lin_op(make_grid(), name='d2z_dx2').diff_op(([0, 0, 0], [-1, 0, 1]), np.array([1., -2., 1.]))
+    with pytest.raises(ValueError):
+        op.v[0]=0.
+    with pytest.raises(ValueError):
+        op.v *= 2
+    # assigning new entries resets the matrices
+    A=op.toCSR()
+    op.v=op.v*2
+    assert np.allclose(op.toCSR().toarray(), 2*A.toarray())
+
+def test_toCSR_is_kept_and_read_only():
+    op=lin_op(make_grid(), name='d2z_dx2').diff_op(([0, 0, 0], [-1, 0, 1]), np.array([1., -2., 1.]))
+    A=op.toCSR()
+    # repeat calls return the kept matrix, which cannot be modified in place
+    assert op.toCSR() is A
+    with pytest.raises(ValueError):
+        A.data[0]=0.
+    B=op.toCSC()
+    assert op.toCSC() is B
+    with pytest.raises(ValueError):
+        B.data[0]=0.
+    # a copy can be modified
+    A1=A.copy()
+    A1.data[:]=0.
+    assert np.any(op.toCSR().data != 0)
+    # only the last matrix of each kind is kept
+    A2=op.toCSR(row_N=op.N_eq+2)
+    assert A2.shape[0]==op.N_eq+2
+    assert len(op._csr)==2 and op.toCSR(row_N=op.N_eq+2) is A2
+
+def test_add_records_entries():
+    # changing an operator after it has been added does not change the sum
+    op1=lin_op(make_grid(), name='d2z_dx2').diff_op(([0, 0, 0], [-1, 0, 1]), np.array([1., -2., 1.]))
+    op2=lin_op(make_grid(), name='d2z_dy2').diff_op(([-1, 0, 1], [0, 0, 0]), np.array([1., -2., 1.]))
+    op2.r=op2.r+op1.N_eq
+    total=lin_op(col_N=op1.col_N, name='total').add([op1, op2])
+    expected=op1.toCSR(row_N=op1.N_eq+op2.N_eq)+op2.toCSR(row_N=op1.N_eq+op2.N_eq)
+    op1.v=op1.v*0
+    op2.c=op2.c[::-1]
+    assert np.allclose(total.toCSR(row_N=expected.shape[0]).toarray(), expected.toarray())
+
+def test_setup_PS_bias():
+    # setup_PS_bias zeros the POCA rows of its operator without writing
+    # into the read-only entries
+    import pointCollection as pc
+    from LSsurf.smooth_xytb_fit import setup_PS_bias
+    rng=np.random.default_rng(0)
+    data=pc.data().from_dict({'x':rng.uniform(0, 400, 50), 'y':rng.uniform(0, 600, 50),
+                              'time':np.zeros(50), 'swath':(np.arange(50) % 2).astype(float)})
+    dz=fd_grid([[0., 600.], [0., 400.], [0., 1.]], [200., 200., 1.], name='dz')
+    args={'spacing':{'dz':200.}, 'srs_proj4':None, 'mask_file':None, 'mask_data':None,
+          'E_RMS_d2x_PS_bias':1., 'E_RMS_PS_bias':1.}
+    G_data=lin_op(col_N=dz.col_N, name='G_data')
+    constraint_op_list=[]
+    setup_PS_bias(data, G_data, constraint_op_list, {'dz':dz}, {'x':[0., 400.], 'y':[0., 600.]}, args)
+    A=G_data.toCSR(row_N=data.size)
+    assert A[data.swath==0, :].nnz==0
+    assert A[data.swath==1, :].nnz > 0
+    assert len(constraint_op_list)==2
+
+def masked_reference(A, mask, shape, time_step_overlap=1):
+    # multiply each entry of the dense matrix A by the mask at its node, one
+    # row at a time, keeping only the 2-D cells for which the row includes
+    # time_step_overlap unmasked nodes
+    A=A.copy()
+    for row in range(A.shape[0]):
+        inds=np.flatnonzero(A[row])
+        subs=np.unravel_index(inds, shape)
+        mask_sub=mask[subs[0:mask.ndim]]
+        if not np.any(mask_sub):
+            A[row, inds]=0.
+            continue
+        if time_step_overlap > 1:
+            cell=np.ravel_multi_index(subs[0:2], shape[0:2])
+            for this_cell in np.unique(cell):
+                if np.sum(mask_sub[cell==this_cell]) < time_step_overlap:
+                    mask_sub[cell==this_cell]=0.
+        A[row, inds] *= mask_sub
+    return A
+
+@pytest.mark.parametrize('mask_dims, time_step_overlap', [(2, 1), (3, 1), (3, 2)])
+def test_apply_mask(mask_dims, time_step_overlap):
+    # the vectorized masking matches masking each row in turn
+    grid=fd_grid([[0., 500.], [0., 600.], [0., 1.5]], [100., 100., 0.5], name='dz')
+    rng=np.random.default_rng(mask_dims+time_step_overlap)
+    mask=(rng.random(grid.shape[0:mask_dims]) > 0.4).astype(float)
+    def make_op():
+        return lin_op(grid, name='avg').diff_op(([0, 0, 1, 1, 0, 0, 1, 1], [0, 1, 0, 1, 0, 1, 0, 1],
+                                                 [0, 0, 0, 0, 1, 1, 1, 1]), np.zeros(8)+0.125)
+    op=make_op()
+    A=op.toCSR().toarray()
+    op.apply_mask(mask=mask, time_step_overlap=time_step_overlap)
+    assert np.allclose(op.toCSR().toarray(), masked_reference(A, mask, grid.shape, time_step_overlap))
+    if mask_dims==2:
+        # apply_2d_mask does not zero rows, so it scales each column by the mask
+        op=make_op().apply_2d_mask(mask=mask)
+        node_mask=np.broadcast_to(mask[:, :, None], grid.shape).ravel()
+        assert np.allclose(op.toCSR().toarray(), A*node_mask)
+
+def test_compact_dtypes():
+    # indices are stored as int32 when they fit, and as int64 otherwise
+    assert index_dtype(2**31-1)==np.int32 and index_dtype(2**31)==np.int64
+    grid=fd_grid([[0., 500.], [0., 600.], [0., 2.]], [100., 100., 0.5], name='dz')
+    rng=np.random.default_rng(0)
+    pts=[rng.uniform(0, 500, 100), rng.uniform(0, 600, 100), rng.uniform(0, 2, 100)]
+    op=lin_op(grid, name='interp').interp_mtx(pts)
+    A=op.toCSR()
+    assert op.r.dtype==np.int32 and op.c.dtype==np.int32
+    big=lin_op(grid, name='interp', col_N=2**31+10).interp_mtx(pts)
+    big.fix_dtypes()
+    assert big.c.dtype==np.int64
+    # float32 values give the same interpolation to single precision
+    op32=lin_op(grid, name='interp', v_dtype=np.float32).interp_mtx(pts)
+    A32=op32.toCSR()
+    assert op32.v.dtype==np.float32 and A32.dtype==np.float32
+    z=rng.normal(size=grid.N_nodes)
+    assert np.allclose(A32.dot(z), A.dot(z), rtol=1.e-5, atol=1.e-6)
+    # stacking the float32 operator with itself keeps the values as float32
+    stacked=lin_op(col_N=op32.col_N).vstack([op32, op32])
+    assert stacked.v.dtype==np.float32 and stacked.N_eq==200
+
+@pytest.mark.parametrize('chunk_size, n_threads', [(7, 1), (7, 3), (1000, 2)])
+def test_chunked_interp_mtx(chunk_size, n_threads):
+    # building the interpolation matrix in chunks gives the same operator,
+    # including for points outside the grid
+    grid=fd_grid([[0., 500.], [0., 600.], [0., 2.]], [100., 100., 0.5], name='dz', col_0=17)
+    rng=np.random.default_rng(1)
+    pts=[rng.uniform(-50, 550, 101), rng.uniform(0, 600, 101), rng.uniform(0, 2, 101)]
+    ref=lin_op(grid, name='interp').interp_mtx(pts, bounds_error=False)
+    op=lin_op(grid, name='interp').interp_mtx(pts, bounds_error=False, chunk_size=chunk_size, n_threads=n_threads)
+    assert ref.N_eq < 101
+    for field in ['r', 'c', 'v', 'ind0']:
+        assert np.array_equal(getattr(op, field), getattr(ref, field))
+    with pytest.raises(ValueError):
+        lin_op(grid, name='interp').interp_mtx(pts, chunk_size=chunk_size)
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+from LSsurf.fd_grid import fd_grid
+from LSsurf.lin_op import lin_op
+from LSsurf.op_cache import op_cache
+
+def make_grid():
+    return fd_grid([[0., 500.], [0., 600.], [0., 2.]], [100., 100., 0.5], name='dz', col_0=42)
+
+def same_op(op, ref):
+    return op.N_eq==ref.N_eq and op.col_N==ref.col_N and op.name==ref.name and \
+        abs(op.toCSR()-ref.toCSR()).max()==0 and np.array_equal(op.ind0, ref.ind0) and \
+        all(np.array_equal(op.TOC['rows'][key], ref.TOC['rows'][key]) for key in ref.TOC['rows'])
+
+def test_round_trip(tmp_path):
+    # an operator read from the cache matches the one that was built
+    cache=op_cache(str(tmp_path))
+    ref=lin_op(make_grid(), name='grad2_dzdt').grad2_dzdt(DOF='z', t_lag=1)
+    op=cache.build(lin_op, make_grid(), 'grad2_dzdt', 'grad2_dzdt', DOF='z', t_lag=1)
+    assert same_op(op, ref)
+    assert len(os.listdir(str(tmp_path)))==1
+    op=cache.build(lin_op, make_grid(), 'grad2_dzdt', 'grad2_dzdt', DOF='z', t_lag=1)
+    assert isinstance(op.c.base, np.memmap) or isinstance(op.c, np.memmap)
+    assert same_op(op, ref)
+    # different arguments give a different entry
+    cache.build(lin_op, make_grid(), 'grad2_dzdt', 'grad2_dzdt', DOF='z', t_lag=2)
+    assert len(os.listdir(str(tmp_path)))==2
+
+@pytest.mark.parametrize('meta', [b'cLSsurf.lin_op\nno_such_class\n.', b'cno_such_module\nthing\n.',
+                                  b'not a pickle', b''])
+def test_stale_entry(tmp_path, meta):
+    # an entry whose metadata cannot be read is deleted and rebuilt
+    cache=op_cache(str(tmp_path))
+    grid=fd_grid([[0., 500.], [0., 600.]], [100., 100.], name='z0')
+    args=(lin_op, grid, 'grad_z0', 'grad')
+    ref=cache.build(*args, DOF='z0')
+    entry=os.path.join(str(tmp_path), cache.key(grid, 'grad_z0', 'grad', {'DOF':'z0'}))
+    with open(os.path.join(entry, 'meta.pkl'),'wb') as fh:
+        fh.write(meta)
+    assert same_op(cache.build(*args, DOF='z0'), ref)
+    # the rebuilt entry can be read
+    with open(os.path.join(entry, 'meta.pkl'),'rb') as fh:
+        assert fh.read() != meta
+    assert same_op(cache.build(*args, DOF='z0'), ref)
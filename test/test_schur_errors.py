@@ -0,0 +1,36 @@
+import numpy as np
+import pointCollection as pc
+from LSsurf.smooth_fit import smooth_fit
+
+def make_track_data(N=800, N_tracks=20, seed=1):
+    # synthetic surface with a bias for each track
+    rng=np.random.default_rng(seed)
+    x=rng.uniform(-2000, 2000, N)
+    y=rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    track=rng.integers(0, N_tracks, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t*np.sin(y/900)
+    z += rng.normal(0, 0.1, N) + rng.normal(0, 0.5, N_tracks)[track]
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1,
+                                'track':track.astype(float), 'sigma_corr':np.zeros(N)+0.5})
+
+def fit(solver):
+    E_RMS={'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5}
+    return smooth_fit(data=make_track_data(), ctr={'x':0., 'y':0., 't':0.},
+                      W={'x':4000., 'y':4000., 't':2.},
+                      spacing={'z0':250., 'dz':1000., 'dt':0.5}, E_RMS=E_RMS,
+                      reference_epoch=2, max_iterations=5, bias_params=['track'],
+                      compute_E=True, solver=solver, VERBOSE=False, dzdt_lags=[1])
+
+def test_schur_bias_errors():
+    # the bias errors found by back-substitution match those from the full
+    # inverse.  The normal equations square the condition number of the
+    # system, so the errors agree to a relative tolerance of 1e-4
+    S_full=fit('spqr')
+    S_schur=fit('schur')
+    assert 'decompose_qz' not in S_schur['timing']
+    assert np.array_equal(S_full['E']['sigma_bias']['ID'], S_schur['E']['sigma_bias']['ID'])
+    assert np.allclose(S_full['m']['bias']['val'], S_schur['m']['bias']['val'], atol=1.e-6)
+    assert np.allclose(S_full['E']['sigma_bias']['val'], S_schur['E']['sigma_bias']['val'], rtol=1.e-4)
+    assert np.allclose(S_full['E']['sigma_z0'].sigma_z0, S_schur['E']['sigma_z0'].sigma_z0, rtol=1.e-4)
+    assert np.allclose(S_full['E']['sigma_dz'].sigma_dz, S_schur['E']['sigma_dz'].sigma_dz, rtol=1.e-4)
@@ -0,0 +1,106 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+import sparseqr
+from LSsurf.solver_functions import solve_system, fit_system, SolverMemoryError
+
+def make_system(N_rows=200, N_cols=40, seed=0):
+    # a well-conditioned sparse least-squares problem
+    rng=np.random.default_rng(seed)
+    G=sp.random(N_rows, N_cols, density=0.1, random_state=seed, format='csr')
+    G=sp.vstack([G, sp.eye(N_cols)]).tocsr()
+    m_true=rng.normal(size=N_cols)
+    d=G.dot(m_true)+rng.normal(0, 0.01, G.shape[0])
+    return G, d
+
+def test_spqr_failure_raises_memory_error(monkeypatch):
+    # sparseqr reports an allocation failure as a TypeError
+    G, d = make_system()
+    def fail(*args, **kwargs):
+        raise TypeError("initializer for ctype 'cholmod_sparse *' must be a cdata pointer, not NoneType")
+    monkeypatch.setattr(sparseqr, 'solve', fail)
+    monkeypatch.setattr(sparseqr, 'rz', fail)
+    with pytest.raises(SolverMemoryError, match='predicted to need'):
+        solve_system(G, d, solver='spqr')
+    N_data=G.shape[0]-G.shape[1]
+    system=fit_system(G.tocoo(), d, sp.eye(G.shape[0]).todia(), N_data, solver='spqr', keep_factorization=True)
+    with pytest.raises(SolverMemoryError):
+        system.solve(np.ones(N_data, dtype=bool))
+
+@pytest.mark.parametrize('solver', ['spqr', 'cholmod_normal', 'lsmr', 'cg_normal'])
+def test_registered_solvers_agree(solver):
+    # every registered engine solves the same least-squares problem
+    G, d = make_system()
+    m_ref=np.linalg.lstsq(G.toarray(), d, rcond=None)[0]
+    m=solve_system(G, d, solver=solver)
+    assert np.allclose(m, m_ref, rtol=1.e-5, atol=1.e-6)
+
+def lstsq_subset(G, d, rows):
+    # dense least-squares solution using the selected data rows and all the constraint rows
+    keep=np.concatenate([rows, np.ones(G.shape[0]-rows.size, dtype=bool)])
+    return np.linalg.lstsq(G[keep].toarray(), d[keep], rcond=None)[0]
+
+def test_factorization_analysis_is_reused():
+    # changing the data rows refactors the normal equations without
+    # repeating the symbolic analysis
+    G, d = make_system()
+    N_data=G.shape[0]-G.shape[1]
+    system=fit_system(G.tocoo(), d, sp.eye(G.shape[0]).todia(), N_data, solver='cholmod_normal')
+    rng=np.random.default_rng(1)
+    for count in range(3):
+        rows=rng.random(N_data) > 0.2
+        m=system.solve(rows)
+        assert np.allclose(m, lstsq_subset(G, d, rows), rtol=1.e-6, atol=1.e-8)
+    assert system.factorization.N_analyze==1
+    assert system.factorization.N_factor==3
+
+@pytest.mark.parametrize('solver', ['spqr', 'lsmr'])
+def test_zero_weight_editing(solver):
+    # rows that leave the solution and come back give the same solution as
+    # rebuilding the system from the selected rows
+    G, d = make_system()
+    N_data=G.shape[0]-G.shape[1]
+    system=fit_system(G.tocoo(), d, sp.eye(G.shape[0]).todia(), N_data,
+                      solver=solver, edit_mode='weight')
+    rng=np.random.default_rng(2)
+    for count in range(4):
+        rows=rng.random(N_data) > 0.3
+        m=system.solve(rows)
+        assert np.allclose(m, lstsq_subset(G, d, rows), rtol=1.e-5, atol=1.e-6)
+    # all the edited entries are restored when all the rows are used
+    system.solve(np.ones(N_data, dtype=bool))
+    assert system.saved_entries.size==0
+    assert np.array_equal(system.G.toarray(), G.toarray())
+    assert np.array_equal(system.d, d)
+
+@pytest.mark.parametrize('solver', ['lsmr', 'cg_normal'])
+def test_warm_start(solver):
+    # a warm-started solution of a slightly edited system matches the cold
+    # solution, and takes fewer iterations
+    G, d = make_system(N_rows=2000, N_cols=400)
+    N_data=G.shape[0]-G.shape[1]
+    rows=np.ones(N_data, dtype=bool)
+    edited=rows.copy()
+    edited[::50]=False
+    args=dict(solver=solver, atol=1.e-10, btol=1.e-10) if solver=='lsmr' else dict(solver=solver, rtol=1.e-10)
+    timing={}
+    for warm_start in [False, True]:
+        system=fit_system(G.tocoo(), d, sp.eye(G.shape[0]).todia(), N_data,
+                          warm_start=warm_start, **args)
+        system.solve(rows)
+        timing[warm_start]={}
+        m=system.solve(edited, timing=timing[warm_start])
+        assert np.allclose(m, lstsq_subset(G, d, edited), rtol=1.e-5, atol=1.e-6)
+    assert timing[True]['solve_iterations'][-1] < timing[False]['solve_iterations'][-1]
+
+def test_schur_solver():
+    # eliminating the nuisance columns gives the same solution as solving
+    # the full system
+    G, d = make_system()
+    N_data=G.shape[0]-G.shape[1]
+    rows=np.ones(N_data, dtype=bool)
+    rows[::5]=False
+    system=fit_system(G.tocoo(), d, sp.eye(G.shape[0]).todia(), N_data, solver='schur',
+                      nuisance_cols=np.arange(35, 40))
+    m=system.solve(rows)
+    assert np.allclose(m, lstsq_subset(G, d, rows), rtol=1.e-6, atol=1.e-8)
@@ -0,0 +1,64 @@
+import numpy as np
+import scipy.sparse as sp
+from LSsurf.fd_grid import fd_grid
+from LSsurf.lin_op import lin_op
+from LSsurf.stencil_op import stencil_op, weighted_linear_operator
+
+def make_grids():
+    z0=fd_grid([[0., 500.], [0., 700.]], [100., 100.], name='z0')
+    dz=fd_grid([[0., 600.], [0., 800.], [0., 2.]], [200., 200., 0.5], name='dz', col_0=z0.N_nodes)
+    return z0, dz
+
+def build(op_class, z0, dz):
+    # the smoothness constraints, stacked with a constraint that is not a stencil
+    ops=[op_class(z0, name='grad2_z0').grad2(DOF='z0'),
+         op_class(z0, name='grad_z0').grad(DOF='z0'),
+         lin_op(z0, name='mag_z0').one(DOF='z0'),
+         op_class(dz, name='grad2_dzdt').grad2_dzdt(DOF='z', t_lag=1),
+         op_class(dz, name='grad_dzdt').grad_dzdt(DOF='z', t_lag=1),
+         op_class(dz, name='d2z_dt2').d2z_dt2(DOF='z')]
+    for op in ops:
+        op.col_N=dz.col_0+dz.N_nodes
+    return op_class(None, name='constraints').vstack(ops)
+
+def test_stencils_are_kept():
+    # building, stacking, and weighting the stencils does not build their triplets
+    z0, dz = make_grids()
+    grad2=stencil_op(z0, name='grad2_z0').grad2(DOF='z0')
+    assert grad2.mask_for_ind0().size==grad2.N_eq
+    assert len(grad2.blocks)==3 and grad2._r is None
+    op=build(stencil_op, z0, dz)
+    # one block for each stencil, and one for the mag_z0 matrix
+    assert sum('op' not in block for block in op.blocks)==11
+    assert len(op.blocks)==12 and op._r is None
+    assert op.ind0.size==op.N_eq
+    weighted_linear_operator(op, row_weight=np.ones(op.N_eq))
+    assert len(op.blocks)==12 and op._r is None
+
+def test_stencil_products():
+    # the matrix-free products match those of the explicit matrix
+    z0, dz = make_grids()
+    op, ref = build(stencil_op, z0, dz), build(lin_op, *make_grids())
+    assert op.N_eq==ref.N_eq and op.col_N==ref.col_N
+    A=ref.toCSR(row_N=ref.N_eq, col_N=ref.col_N)
+    rng=np.random.default_rng(0)
+    x, y, w = rng.normal(size=op.col_N), rng.normal(size=op.N_eq), rng.uniform(0.5, 2, op.N_eq)
+    assert np.allclose(op.matvec(x), A.dot(x))
+    assert np.allclose(op.matvec(x, row_weight=w), w*A.dot(x))
+    assert np.allclose(op.rmatvec(y), A.T.dot(y))
+    assert np.allclose(op.rmatvec(y, row_weight=w), A.T.dot(w*y))
+    assert np.allclose(op.col_norm2(row_weight=w), np.asarray(sp.diags(w).dot(A).power(2).sum(axis=0)).ravel())
+
+    # the weighted operator matches the weighted matrix, for a subset of columns
+    Ip_c=sp.eye(op.col_N, format='csr')[:, ::2]
+    L=weighted_linear_operator(op, row_weight=w, Ip_c=Ip_c)
+    B=sp.diags(w).dot(A).dot(Ip_c)
+    xc=x[::2]
+    assert np.allclose(L.matvec(xc), B.dot(xc))
+    assert np.allclose(L.rmatvec(y), B.T.dot(y))
+    assert np.allclose(L.col_norm2, np.asarray(B.power(2).sum(axis=0)).ravel())
+
+    # the explicit matrix built from the stencils matches, and the products
+    # are unchanged once the triplets have been made
+    assert abs(op.toCSR(row_N=op.N_eq, col_N=op.col_N)-A).max() < 1.e-12
+    assert np.allclose(op.matvec(x), A.dot(x))
@@ -0,0 +1,38 @@
+import numpy as np
+import scipy.sparse as sp
+import sys
+import pytest
+from LSsurf.smooth_fit import stream_Rinv_errors, calc_Rinv
+from LSsurf.inv_tr_upper import inv_tr_upper
+
+def make_R(N=300, density=0.01, seed=0):
+    # sparse, well-conditioned upper-triangular matrix
+    rng=np.random.default_rng(seed)
+    R=sp.triu(sp.random(N, N, density=density, random_state=seed), k=1)
+    return (R+sp.diags(rng.uniform(1, 2, N))).tocsr()
+
+def test_stream_matches_full():
+    # streaming Rinv in small blocks gives the same variances as the full Rinv
+    R=make_R()
+    perm=np.random.default_rng(1).permutation(R.shape[0])
+    Rinv=calc_Rinv(R, perm, {})
+    timing={}
+    E0_2, avg_var = stream_Rinv_errors(R, perm, sp.eye(R.shape[0]), {}, timing, max_memory=64*400)
+    assert 'Rinv_stream' in timing
+    assert np.allclose(E0_2, np.asarray(Rinv.power(2).sum(axis=1)).ravel(), rtol=1.e-12)
+
+@pytest.mark.parametrize('failure', ['status', 'missing_column'])
+def test_stream_failure_raises(monkeypatch, failure):
+    # a block that inv_tr_upper did not complete raises an error instead of
+    # leaving zeros in the variances
+    def failing_inv_tr_upper(R, nnz, tol, n_threads=1, first_col=0, last_col=None):
+        RR, CC, VV, status = inv_tr_upper(R, nnz, tol, n_threads, first_col=first_col, last_col=last_col)
+        if failure=='status':
+            return RR, CC, VV, 1
+        keep=CC < CC.max()
+        return RR[keep], CC[keep], VV[keep], status
+    # LSsurf.smooth_fit is the function of that name, so patch the module
+    monkeypatch.setattr(sys.modules['LSsurf.smooth_fit'], 'inv_tr_upper', failing_inv_tr_upper)
+    R=make_R()
+    with pytest.raises(RuntimeError, match='did not return'):
+        stream_Rinv_errors(R, np.arange(R.shape[0]), sp.eye(R.shape[0]), {}, {}, max_memory=64*400)
@@ -0,0 +1,79 @@
+import os
+import csv
+import numpy as np
+import pointCollection as pc
+from LSsurf.tile_runner import run_tiles, tile_filename, tile_waves
+
+def read_data(xy0, fit_args):
+    # synthetic data for a tile.  The tile at the origin fails the first time
+    # it is read, and the tile at (0, 4000) always fails.  The solver memory
+    # limit is recorded in the data, so that it is written to the output file
+    if xy0==(0., 0.):
+        marker=os.path.join(os.environ['TILE_RUNNER_TEST_DIR'], 'failed_once')
+        if not os.path.isfile(marker):
+            open(marker,'w').close()
+            raise RuntimeError('first attempt fails')
+    if xy0==(0., 4000.):
+        raise RuntimeError('always fails')
+    N=200
+    rng=np.random.default_rng(1)
+    x=xy0[0]+rng.uniform(-2000, 2000, N)
+    y=xy0[1]+rng.uniform(-2000, 2000, N)
+    t=rng.uniform(-0.99, 0.99, N)
+    z=np.sin(x/700)+0.3*np.cos(y/500)+0.5*t+rng.normal(0, 0.1, N)
+    return pc.data().from_dict({'x':x, 'y':y, 'time':t, 'z':z, 'sigma':np.zeros(N)+0.1,
+                                'max_solve_memory':np.zeros(N)+fit_args['max_solve_memory']})
+
+def save_function(S, out_file):
+    with open(out_file,'w') as fh:
+        fh.write(str(S['data'].max_solve_memory[0]))
+
+def test_run_tiles(tmp_path, monkeypatch):
+    monkeypatch.setenv('TILE_RUNNER_TEST_DIR', str(tmp_path))
+    tiles=[(0., 0.), (4000., 0.), (0., 4000.), (4000., 4000.)]
+    fit_args={'W':{'x':4000., 'y':4000., 't':2.}, 'ctr':{'t':0.},
+              'spacing':{'z0':500., 'dz':1000., 'dt':0.5},
+              'E_RMS':{'d2z0_dx2':0.006, 'dz0_dx':0.6, 'd3z_dx2dt':0.001, 'd2z_dxdt':0.1, 'd2z_dt2':5},
+              'reference_epoch':2, 'max_iterations':2, 'VERBOSE':False}
+    # the output for this tile exists already, so it is skipped
+    open(tile_filename(tiles[3], out_dir=str(tmp_path)),'w').close()
+    # the tile memory estimate is larger than each worker's share of the
+    # budget, but each solver is limited to its share
+    status=run_tiles(tiles, fit_args, read_data, save_function, out_dir=str(tmp_path),
+                     max_workers=2, max_memory=2.e9, tile_memory=4.e9,
+                     max_retries=2, retry_delay=0.)
+    assert status=={tiles[0]:'done', tiles[1]:'done', tiles[2]:'failed', tiles[3]:'skipped'}
+    for xy0 in tiles[0:2]:
+        with open(tile_filename(xy0, out_dir=str(tmp_path))) as fh:
+            assert float(fh.read())==1.e9
+    assert not os.path.isfile(tile_filename(tiles[2], out_dir=str(tmp_path)))
+
+    # the ledger records each attempt
+    with open(os.path.join(str(tmp_path), 'tile_ledger.csv')) as fh:
+        rows=[(float(row['x']), float(row['y']), row['status'], int(row['attempt'])) for row in csv.DictReader(fh)]
+    assert sorted(rows)==sorted([(0., 0., 'retry', 0), (0., 0., 'done', 1),
+                                 (4000., 0., 'done', 0),
+                                 (0., 4000., 'retry', 0), (0., 4000., 'retry', 1), (0., 4000., 'failed', 2),
+                                 (4000., 4000., 'skipped', 0)])
+
+    # a smaller limit in fit_args is kept
+    status=run_tiles(tiles[0:2], dict(fit_args, max_solve_memory=5.e8), read_data, save_function,
+                     out_dir=str(tmp_path), max_workers=2, max_memory=2.e9, replace=True)
+    for xy0 in tiles[0:2]:
+        with open(tile_filename(xy0, out_dir=str(tmp_path))) as fh:
+            assert float(fh.read())==5.e8
+
+def test_tile_waves():
+    # adjacent tiles are always in different waves, including for tiles
+    # centered on half multiples of the spacing, and each tile depends on
+    # exactly the adjacent tiles in earlier waves
+    for offset in [0., 0.5, 0.25, -0.5]:
+        spacing=40000.
+        tiles=[((ii+offset)*spacing, (jj+offset)*spacing) for ii in range(-3, 4) for jj in range(-3, 4)]
+        wave, depends_on = tile_waves(tiles, spacing)
+        for xy0 in tiles:
+            for xy1 in tiles:
+                dx, dy = [np.abs(xy1[0]-xy0[0])/spacing, np.abs(xy1[1]-xy0[1])/spacing]
+                if xy0 != xy1 and dx < 1.5 and dy < 1.5:
+                    assert wave[xy0] != wave[xy1]
+                    assert (xy1 in depends_on[xy0])==(wave[xy1] < wave[xy0])
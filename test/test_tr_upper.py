@@ -0,0 +1,47 @@
+import numpy as np
+import scipy.sparse as sp
+from LSsurf.inv_tr_upper import inv_tr_upper
+from LSsurf.propagate_qz_errors import propagate_qz_errors
+from LSsurf.selected_inverse import selected_inverse
+
+def make_R(N=300, density=0.01, seed=0):
+    # sparse, well-conditioned upper-triangular matrix
+    rng=np.random.default_rng(seed)
+    R=sp.triu(sp.random(N, N, density=density, random_state=seed), k=1)
+    return (R+sp.diags(rng.uniform(1, 2, N))).tocsr()
+
+def test_sparse_reach_kernels():
+    # the kernels that solve only the reachable rows of each column of Rinv
+    # match the dense inverse
+    R=make_R()
+    Rinv=np.linalg.inv(R.toarray())
+    RR, CC, VV, status = inv_tr_upper(R, R.shape[0]**2, 1.e-12)
+    assert status==0
+    Rinv_sparse=sp.coo_matrix((VV, (RR, CC)), shape=R.shape).toarray()
+    assert np.allclose(Rinv_sparse, Rinv, atol=1.e-10)
+    # columns that do not fit in a small output buffer are repeated
+    RR, CC, VV, status = inv_tr_upper(R, 50, 1.e-12)
+    assert np.allclose(sp.coo_matrix((VV, (RR, CC)), shape=R.shape).toarray(), Rinv, atol=1.e-10)
+    assert np.allclose(propagate_qz_errors(R), np.sqrt(np.sum(Rinv**2, axis=1)), rtol=1.e-10)
+
+def test_selected_inverse():
+    # the selected inverse matches (R^T R)^-1 on its pattern, which includes the diagonal
+    R=make_R()
+    C=np.linalg.inv(R.T.dot(R).toarray())
+    Z=selected_inverse(R).tocoo()
+    assert np.allclose(Z.diagonal(), np.diag(C), rtol=1.e-10)
+    assert np.allclose(Z.data, C[Z.row, Z.col], rtol=1.e-8, atol=1.e-12)
+    # the pattern of the upper triangle of R is part of the selected pattern
+    assert np.all(np.abs(sp.triu(R)).astype(bool).toarray() <= np.abs(Z).astype(bool).toarray())
+
+def test_threaded_inverse():
+    # splitting the columns among threads, or into ranges, gives the same inverse
+    R=make_R(N=500)
+    def as_array(RR, CC, VV, status):
+        return sp.coo_matrix((VV, (RR, CC)), shape=R.shape).toarray()
+    Rinv=as_array(*inv_tr_upper(R, R.shape[0]**2, 1.e-12))
+    for n_threads, nnz in [(4, R.shape[0]**2), (4, 100), (3, 1000)]:
+        assert np.array_equal(as_array(*inv_tr_upper(R, nnz, 1.e-12, n_threads)), Rinv)
+    parts=[as_array(*inv_tr_upper(R, 1000, 1.e-12, 2, first_col=c0, last_col=c1))
+           for c0, c1 in [(0, 120), (120, 121), (121, 500)]]
+    assert np.array_equal(sum(parts), Rinv)